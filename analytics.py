@@ -0,0 +1,179 @@
+"""Vectorized flight statistics over the media metadata
+
+FlightStats keeps a columnar pandas view of the fields the dashboard needs
+(type, position, capture day, altitude) plus precomputed grid keys, and a
+set of aggregates derived from it:
+
+- counts by type and by capture day
+- an altitude histogram in ALTITUDE_BIN_M bins
+- ground coverage: grid cells of COVERAGE_CELL_DEG holding media, the area
+  they span and the bounding box
+- flights per region: a flight is one capture day's media within one
+  REGION_CELL_DEG grid cell
+
+Every aggregate is a counter, so an insert adds the grouped counts of just
+the new rows and a delete subtracts those of the removed ones; ingest never
+rescans the archive. Like StoreSpatialIndex, writes from other processes
+are detected by store version and trigger a rebuild.
+"""
+import threading
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from config import ALTITUDE_BIN_M, COVERAGE_CELL_DEG, REGION_CELL_DEG
+
+FIELDS = ['id', 'type', 'lat', 'lon', 'timestamp', 'altitude']
+
+# Kilometres per degree of latitude
+KM_PER_DEG = 111.32
+
+# Aggregate name -> frame columns it counts by
+AGGREGATES = {
+    'type': ['type'],
+    'day': ['day', 'type'],
+    'altitude': ['alt_bin'],
+    'cell': ['cell_row', 'cell_col'],
+    'flight': ['region_row', 'region_col', 'day'],
+}
+
+
+def to_frame(rows):
+    """DataFrame indexed by id, with the derived columns the aggregates use"""
+    frame = pd.DataFrame.from_records(rows, columns=FIELDS)
+    frame['altitude'] = pd.to_numeric(frame['altitude'], errors='coerce').fillna(0.0)
+    frame['day'] = pd.to_datetime(frame['timestamp'].str[:10], format='%Y-%m-%d', errors='coerce')
+    frame['alt_bin'] = (np.floor(frame['altitude'] / ALTITUDE_BIN_M) * ALTITUDE_BIN_M).astype('int64')
+    frame['cell_row'] = np.floor(frame['lat'] / COVERAGE_CELL_DEG).astype('int64')
+    frame['cell_col'] = np.floor(frame['lon'] / COVERAGE_CELL_DEG).astype('int64')
+    frame['region_row'] = np.floor(frame['lat'] / REGION_CELL_DEG).astype('int64')
+    frame['region_col'] = np.floor(frame['lon'] / REGION_CELL_DEG).astype('int64')
+    return frame.drop(columns='timestamp').set_index('id')
+
+
+class FlightStats:
+    """Aggregates over a media store, kept current as records change"""
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self.rebuild()
+        store.subscribe(self._on_change)
+
+    def rebuild(self):
+        with self._lock:
+            self.version = self.store.version()
+            self.frame = to_frame(self.store.columns())
+            self._pending = []
+            self._counts = {name: Counter() for name in AGGREGATES}
+            self._bbox = None
+            self._add(self.frame)
+            self._views = {}
+
+    def _on_change(self, event, items, version):
+        with self._lock:
+            stale = version != self.version + 1
+            if not stale:
+                ids = [item['id'] for item in items]
+                if event in ('update', 'delete'):
+                    self._remove(ids)
+                if event in ('insert', 'update'):
+                    added = to_frame([tuple(item.get(f) for f in FIELDS) for item in items])
+                    self._add(added)
+                    self._pending.append(added)
+                self._views = {}
+                self.version = version
+        if stale:
+            self.rebuild()
+
+    def _add(self, frame, sign=1):
+        if sign > 0 and len(frame):
+            bbox = (frame['lat'].min(), frame['lon'].min(), frame['lat'].max(), frame['lon'].max())
+            if self._bbox is not None:
+                bbox = (min(bbox[0], self._bbox[0]), min(bbox[1], self._bbox[1]),
+                        max(bbox[2], self._bbox[2]), max(bbox[3], self._bbox[3]))
+            self._bbox = tuple(float(v) for v in bbox)
+        for name, keys in AGGREGATES.items():
+            counts = self._counts[name]
+            for key, n in frame.groupby(keys, observed=True).size().items():
+                counts[key] += sign * n
+                if not counts[key]:
+                    del counts[key]
+
+    def _remove(self, ids):
+        frame = self._consolidated()
+        removed = frame.loc[frame.index.intersection(ids)]
+        self._add(removed, sign=-1)
+        self.frame = frame.drop(removed.index)
+        # The box may have shrunk
+        self._bbox = None
+        if len(self.frame):
+            self._bbox = (float(self.frame['lat'].min()), float(self.frame['lon'].min()),
+                          float(self.frame['lat'].max()), float(self.frame['lon'].max()))
+
+    def _consolidated(self):
+        """The full frame, with rows from recent inserts appended"""
+        if self._pending:
+            self.frame = pd.concat([self.frame] + self._pending)
+            self._pending = []
+        return self.frame
+
+    def _view(self, name, build):
+        """A derived result, built once per store change"""
+        if self.store.version() != self.version:
+            self.rebuild()
+        with self._lock:
+            if name not in self._views:
+                self._views[name] = build()
+            return self._views[name]
+
+    def counts_by_type(self):
+        """{type: count}"""
+        return self._view('type', lambda: dict(self._counts['type']))
+
+    def counts_by_day(self):
+        """DataFrame of counts indexed by capture day, one column per type"""
+        def build():
+            counts = pd.Series(self._counts['day'], dtype='int64')
+            if counts.empty:
+                return pd.DataFrame()
+            return counts.unstack(fill_value=0).sort_index()
+        return self._view('day', build)
+
+    def altitude_histogram(self):
+        """Series of counts indexed by the lower edge of each altitude bin (m)"""
+        return self._view('altitude', lambda: pd.Series(self._counts['altitude'], dtype='int64').sort_index())
+
+    def coverage(self):
+        """Occupied grid cells, the ground area they span (km²) and the bounding box"""
+        def build():
+            cells = np.array(list(self._counts['cell']), dtype='float64').reshape(-1, 2)
+            side_km = COVERAGE_CELL_DEG * KM_PER_DEG
+            # Cells narrow towards the poles with the cosine of their latitude
+            lat = np.radians((cells[:, 0] + 0.5) * COVERAGE_CELL_DEG)
+            area = float(np.sum(side_km * side_km * np.cos(lat)))
+            return {'cells': len(cells), 'area_km2': area, 'bbox': self._bbox}
+        return self._view('coverage', build)
+
+    def flights_per_region(self):
+        """DataFrame of flights and media per region, busiest first
+
+        Regions are identified by the latitude/longitude of their cell centre.
+        """
+        def build():
+            flights = pd.Series(self._counts['flight'], dtype='int64')
+            if flights.empty:
+                return pd.DataFrame(columns=['lat', 'lon', 'flights', 'media'])
+            by_region = flights.groupby(level=[0, 1]).agg(['size', 'sum'])
+            by_region.columns = ['flights', 'media']
+            rows = by_region.index.get_level_values(0).to_numpy()
+            cols = by_region.index.get_level_values(1).to_numpy()
+            by_region = by_region.reset_index(drop=True)
+            by_region.insert(0, 'lat', (rows + 0.5) * REGION_CELL_DEG)
+            by_region.insert(1, 'lon', (cols + 0.5) * REGION_CELL_DEG)
+            return by_region.sort_values(['flights', 'media'], ascending=False, ignore_index=True)
+        return self._view('flights', build)
+
+    def __len__(self):
+        return sum(self._counts['type'].values())
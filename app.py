@@ -1,13 +1,28 @@
 import streamlit as st
-import folium
-from streamlit_folium import st_folium
 from datetime import datetime
-from PIL import Image
-import io
-import base64
+import math
 import os
-import json
-import uuid
+from urllib.parse import urlencode, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from config import (MEDIA_BASE_URL, MEDIA_SERVER_PUBLIC, MAP_DEFAULT_ZOOM, MAX_VIEW_MARKERS,
+                    CLUSTER_MAX_ZOOM, GALLERY_PAGE_SIZE,
+                    VIEWER_IMAGE_SIZE, TILE_PROXY, TILE_SOURCES, ORTHO_MIN_ZOOM,
+                    METRICS_HTML_SAMPLE, QUICK_VIEW_SIZE, GALLERY_THUMB_SIZE)
+from dedup import perceptual_hash
+from geo import bounds_from_leaflet, estimate_bounds, expand_bounds
+from ingest import ingest_stream
+from media_server import app_routes, media_url
+from query import area_from_geojson, to_params
+from resources import (get_archive_index, get_cluster_index, get_flight_stats, get_media_server,
+                       get_orthomosaic, get_perceptual_index, get_store, get_track_store, get_transcoder,
+                       get_warmup, register_metrics)
+from metadata import IMAGE_EXTENSIONS, POSE_FIELDS, VIDEO_EXTENSIONS, extract_many
+from thumbnails import (cache_derivatives, get_derivative, marker_source, remember_digest,
+                        thumbnail_data_uri)
+from tiles import tile_url
+from tracks import TRACK_EXTENSIONS, import_track
 
 # Page configuration
 st.set_page_config(
@@ -17,75 +32,126 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# Directories
-UPLOAD_DIR = "uploads"
-DATA_FILE = "media_data.json"
+# Per-stage timings of this rerun; see the Performance panel and /metrics
+metrics.start_run()
 
-# Ensure upload directory exists
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+warmup = get_warmup()
+# Whether browsers get media, tiles and thumbnails from the media server
+serve_media = get_media_server()
+if MEDIA_SERVER_PUBLIC and not serve_media:
+    st.error(f"The media server isn't reachable at {MEDIA_BASE_URL} (MEDIA_BASE_URL). "
+             "Media is served through Streamlit instead; check MEDIA_SERVER_HOST and MEDIA_SERVER_PORT.")
 
-def load_media_data():
-    """Load media data from JSON file"""
-    if os.path.exists(DATA_FILE):
-        try:
-            with open(DATA_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return get_sample_data()
-    return get_sample_data()
+def app_origin():
+    """Scheme and host the browser reached this app at, or None outside a session"""
+    if not st.context.url:
+        return None
+    url = urlsplit(st.context.url)
+    return f'{url.scheme}://{url.netloc}'
 
-def save_media_data(data):
-    """Save media data to JSON file"""
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=2)
+# Where browsers fetch originals and marker thumbnails: the media server,
+# server.py's routes on the app's own port, or (None) through Streamlit
+if serve_media:
+    media_base = MEDIA_BASE_URL
+elif app_routes():
+    media_base = app_origin()
+else:
+    media_base = None
+# These wait for the warm-up (or build the cache themselves if it hasn't got there)
+store = get_store()
+track_store = get_track_store()
+transcoder = get_transcoder()
+archive_index = get_archive_index()
+cluster_index = get_cluster_index()
+orthomosaic = get_orthomosaic()
+# Statistics aren't needed to draw the page, so don't wait for them on a cold start
+flight_stats = get_flight_stats() if warmup.finished('flight_stats') else None
+register_metrics()
+metrics.lap('startup')
 
 def save_uploaded_file(uploaded_file):
-    """Save uploaded file and return path"""
+    """Save uploaded file by content hash and return its IngestResult"""
     ext = uploaded_file.name.split('.')[-1].lower()
-    filename = f"{uuid.uuid4().hex[:8]}.{ext}"
-    filepath = os.path.join(UPLOAD_DIR, filename)
+    result = ingest_stream(uploaded_file, ext)
+    # The checksum was computed while streaming, so the cache needn't re-hash
+    remember_digest(result.path, result.sha256)
     
-    with open(filepath, 'wb') as f:
-        f.write(uploaded_file.getbuffer())
+    # Render the derivatives now so the marker, gallery and viewer all hit the cache
+    if ext in IMAGE_EXTENSIONS:
+        cache_derivatives(result.path, result.sha256)
     
-    return filepath
+    return result
+
+def build_media_record(name, result, meta):
+    """New media record from an upload, its extracted metadata and the map selection"""
+    ext = name.rsplit('.', 1)[-1].lower()
+    lat, lon = meta.get('lat'), meta.get('lon')
+    if lat is None or lon is None:
+        lat, lon = st.session_state.selected_lat, st.session_state.selected_lon
+    if lat is None or lon is None:
+        return None
+    item = {
+        'type': 'video' if ext in VIDEO_EXTENSIONS else 'image',
+        'title': os.path.splitext(name)[0][:60],
+        'lat': lat,
+        'lon': lon,
+        'timestamp': meta.get('timestamp') or datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'altitude': meta.get('altitude', 0),
+        'description': '',
+        'filepath': result.path,
+        'sha256': result.sha256
+    }
+    item.update({key: meta[key] for key in POSE_FIELDS if key in meta})
+    if ext in IMAGE_EXTENSIONS:
+        try:
+            item['phash'] = perceptual_hash(result.path)
+        except Exception as e:
+            print(f"Error hashing {name}: {e}")
+    return item
+
+@st.cache_resource
+def get_prefetcher():
+    """Background threads that warm the viewer cache for neighbouring stories"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
 
-def get_image_base64(filepath):
-    """Convert image to base64 for embedding in HTML"""
+def story_image(story, size):
+    """Path of the smallest derivative of a story's image (a video's poster) covering size, or None"""
+    filepath = marker_source(story)
+    if filepath is None:
+        return None
     try:
-        if filepath and os.path.exists(filepath):
-            with Image.open(filepath) as img:
-                img.thumbnail((200, 200))
-                buffer = io.BytesIO()
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    img = img.convert('RGB')
-                img.save(buffer, format='JPEG', quality=85)
-                return base64.b64encode(buffer.getvalue()).decode()
+        return get_derivative(filepath, size)
     except Exception as e:
-        print(f"Error converting image: {e}")
-    return None
+        print(f"Error creating derivative for {filepath}: {e}")
+        return None
 
-def get_sample_data():
-    """Return sample drone media data"""
-    return [
-        {
-            'id': 1, 'type': 'image', 'title': 'Coastal Cliff Aerial',
-            'lat': 34.0195, 'lon': -118.4912, 'timestamp': '2024-12-01 14:32:00',
-            'altitude': 120, 'description': 'Stunning aerial view of coastal cliffs at sunset',
-            'filepath': None
-        },
-        {
-            'id': 2, 'type': 'video', 'title': 'Downtown Flyover',
-            'lat': 34.0522, 'lon': -118.2437, 'timestamp': '2024-12-03 10:15:00',
-            'altitude': 200, 'description': 'Cinematic drone flyover of downtown Los Angeles',
-            'filepath': None
-        }
-    ]
+def prefetch_story_image(item):
+    story_image(item, VIEWER_IMAGE_SIZE)
+
+def original_link(story, label, attrs):
+    """Link to a story's full original over HTTP, or a Streamlit download when browsers can't fetch it"""
+    if media_base:
+        st.markdown(f'<a href="{media_url(story, base=media_base)}" {attrs} '
+                    f'style="color: #FFFC00; font-size: 13px;">{label}</a>',
+                    unsafe_allow_html=True)
+        return
+    filepath = story['filepath']
+    
+    def read_original():
+        with open(filepath, 'rb') as f:
+            return f.read()
+    
+    # Read on click, not on every rerun of the viewer
+    st.download_button(label, data=read_original, file_name=os.path.basename(filepath),
+                       on_click='ignore', type='tertiary')
+
+def prefetch_stories(items):
+    """Render the viewer images of items in the background so Next/Previous is instant"""
+    for item in items:
+        if item is not None:
+            get_prefetcher().submit(prefetch_story_image, item)
 
 # Initialize session state
-if 'media_data' not in st.session_state:
-    st.session_state.media_data = load_media_data()
-    
 if 'selected_lat' not in st.session_state:
     st.session_state.selected_lat = None
     
@@ -95,12 +161,24 @@ if 'selected_lon' not in st.session_state:
 if 'viewing_story' not in st.session_state:
     st.session_state.viewing_story = None
     
-if 'current_story_index' not in st.session_state:
-    st.session_state.current_story_index = 0
-
 if 'clicked_marker_id' not in st.session_state:
     st.session_state.clicked_marker_id = None
 
+if 'cluster_markers' not in st.session_state:
+    st.session_state.cluster_markers = True
+
+if 'search_area' not in st.session_state:
+    # search() arguments for the shape last drawn on the map, and that shape
+    st.session_state.search_area = {}
+    st.session_state.search_drawing = None
+
+# Keyset cursors of the gallery pages visited so far; the last is the current page
+if 'gallery_cursors' not in st.session_state:
+    st.session_state.gallery_cursors = [None]
+
+if 'gallery_filters' not in st.session_state:
+    st.session_state.gallery_filters = None
+
 # Custom CSS
 st.markdown("""
 <style>
@@ -216,146 +294,187 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-def create_story_marker(item):
-    """Create Snapchat-style story marker"""
-    filepath = item.get('filepath')
-    has_image = filepath and os.path.exists(filepath) and item['type'] == 'image'
-    
-    if has_image:
-        img_base64 = get_image_base64(filepath)
-        if img_base64:
-            html = f'''
-            <div style="
-                width: 60px;
-                height: 60px;
-                border-radius: 50%;
-                background: linear-gradient(135deg, #FFFC00 0%, #FF6B6B 50%, #4ECDC4 100%);
-                padding: 3px;
-                box-shadow: 0 4px 15px rgba(0,0,0,0.3);
-                cursor: pointer;
-            ">
-                <div style="
-                    width: 100%;
-                    height: 100%;
-                    border-radius: 50%;
-                    background-image: url('data:image/jpeg;base64,{img_base64}');
-                    background-size: cover;
-                    background-position: center;
-                    border: 2px solid white;
-                "></div>
-            </div>
-            '''
-            return folium.DivIcon(html=html, icon_size=(60, 60), icon_anchor=(30, 30))
-    
-    # Default markers
-    if item['type'] == 'video':
-        html = f'''
-        <div style="
-            width: 56px;
-            height: 56px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, #FF6D00 0%, #FFAB40 100%);
-            padding: 3px;
-            box-shadow: 0 4px 15px rgba(255, 109, 0, 0.5);
-            cursor: pointer;
-        ">
-            <div style="
-                width: 100%;
-                height: 100%;
-                border-radius: 50%;
-                background: linear-gradient(135deg, #1a1a2e 0%, #16213e 100%);
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                border: 2px solid white;
-            ">
-                <div style="
-                    width: 0;
-                    height: 0;
-                    border-left: 14px solid white;
-                    border-top: 9px solid transparent;
-                    border-bottom: 9px solid transparent;
-                    margin-left: 4px;
-                "></div>
-            </div>
-        </div>
-        '''
-    else:
-        html = f'''
-        <div style="
-            width: 52px;
-            height: 52px;
-            border-radius: 50%;
-            background: linear-gradient(135deg, #00C853 0%, #69F0AE 100%);
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            box-shadow: 0 4px 12px rgba(0, 200, 83, 0.4);
-            border: 3px solid white;
-            cursor: pointer;
-        ">
-            <svg width="24" height="24" viewBox="0 0 24 24" fill="white">
-                <circle cx="12" cy="12" r="3"/>
-                <path d="M9 2L7.17 4H4c-1.1 0-2 .9-2 2v12c0 1.1.9 2 2 2h16c1.1 0 2-.9 2-2V6c0-1.1-.9-2-2-2h-3.17L15 2H9zm3 15c-2.76 0-5-2.24-5-5s2.24-5 5-5 5 2.24 5 5-2.24 5-5 5z"/>
-            </svg>
-        </div>
-        '''
-    
-    # Add JavaScript to handle click and store in session state
-    html += f'''
-    <script>
-        document.currentScript.parentElement.onclick = function() {{
-            window.parent.postMessage({{
-                type: 'marker_clicked',
-                story_id: {item['id']}
-            }}, '*');
-        }};
-    </script>
-    '''
-    
-    return folium.DivIcon(html=html, icon_size=(60, 60), icon_anchor=(30, 30))
+def get_map_center():
+    """Center of the archive (or downtown LA when empty), fixed per session
+
+    Keeping it fixed means the base map is identical across reruns, so
+    st_folium only swaps the marker layer when data changes.
+    """
+    if 'map_center' not in st.session_state:
+        st.session_state.map_center = store.center() or (34.0522, -118.2437)
+    return st.session_state.map_center
 
 def create_map():
-    """Create the map"""
-    if st.session_state.media_data:
-        center_lat = sum(item['lat'] for item in st.session_state.media_data) / len(st.session_state.media_data)
-        center_lon = sum(item['lon'] for item in st.session_state.media_data) / len(st.session_state.media_data)
-    else:
-        center_lat, center_lon = 34.0522, -118.2437
+    """Create the base map (tile layers only; markers are added per viewport)"""
+    import folium
+    from folium.plugins import Draw
+    from markers import add_marker_styles
+    
+    center_lat, center_lon = get_map_center()
     
     m = folium.Map(
         location=[center_lat, center_lon],
-        zoom_start=11,
+        zoom_start=MAP_DEFAULT_ZOOM,
         tiles=None,
         control_scale=False
     )
+    add_marker_styles(m)
+    
+    # Base layers come through the local caching proxy when it's enabled and
+    # reachable, otherwise straight from the upstream servers
+    for layer, source in TILE_SOURCES.items():
+        folium.TileLayer(
+            tiles=tile_url(layer) if TILE_PROXY and serve_media else source['url'],
+            subdomains=source.get('subdomains', 'abc'),
+            attr=source['attr'],
+            name=source['name'],
+            max_zoom=source['max_zoom']
+        ).add_to(m)
     
-    folium.TileLayer(
-        tiles='https://{s}.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}{r}.png',
-        attr='OpenStreetMap & CARTO',
-        name='Map',
-        max_zoom=19
-    ).add_to(m)
+    # Survey stills tiled into an overlay, drawn at full detail when zoomed in
+    extent = orthomosaic.extent()
+    # The overlay's tiles only exist on the media server
+    if extent and serve_media:
+        (south, west, north, east), max_native_zoom = extent
+        folium.TileLayer(
+            tiles=orthomosaic.tile_url(),
+            attr='Survey imagery',
+            name='Survey mosaic',
+            overlay=True,
+            max_zoom=22,
+            min_native_zoom=ORTHO_MIN_ZOOM,
+            max_native_zoom=max_native_zoom,
+            bounds=[[south, west], [north, east]]
+        ).add_to(m)
     
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Satellite',
-        max_zoom=19
+    # Polygons, rectangles and circles drawn here become the search area
+    Draw(
+        draw_options={'polyline': False, 'marker': False, 'circlemarker': False},
+        edit_options={'edit': False}
     ).add_to(m)
     
-    for idx, item in enumerate(st.session_state.media_data):
-        icon = create_story_marker(item)
-        
-        folium.Marker(
-            location=[item['lat'], item['lon']],
-            icon=icon,
-            tooltip=f"👆 Click to view: {item['title']}"
-        ).add_to(m)
-    
     folium.LayerControl(position='topright').add_to(m)
     return m
 
+SEARCH_TYPES = {'All': None, 'Images': ['image'], 'Videos': ['video']}
+
+def get_search():
+    """archive_index.search() arguments from the search bar and the area drawn on the map
+
+    Read from session state so the map, drawn above the search bar, uses the
+    same search as the gallery below it.
+    """
+    search = dict(st.session_state.search_area)
+    types = SEARCH_TYPES[st.session_state.get('search_type', 'All')]
+    if types:
+        search['types'] = types
+    dates = st.session_state.get('search_dates') or ()
+    if len(dates) > 0:
+        search['start'] = dates[0].strftime('%Y-%m-%d 00:00:00')
+        search['end'] = dates[-1].strftime('%Y-%m-%d 23:59:59')
+    if st.session_state.get('search_min_altitude'):
+        search['min_altitude'] = st.session_state.search_min_altitude
+    return search
+
+def get_view_bounds():
+    """Padded bounds and zoom of the map viewport from the last st_folium result"""
+    map_state = st.session_state.get('main_map') or {}
+    bounds = bounds_from_leaflet(map_state.get('bounds'))
+    zoom = map_state.get('zoom') or MAP_DEFAULT_ZOOM
+    if bounds is None:
+        lat, lon = get_map_center()
+        bounds = estimate_bounds(lat, lon, zoom)
+    return expand_bounds(bounds), zoom
+
+def story_marker_rows(item_ids, inline_thumbs):
+    """Marker payload rows for media ids"""
+    from markers import story_row
+    rows = []
+    for item in store.get_many(item_ids):
+        filepath = marker_source(item)
+        if filepath is None:
+            rows.append(story_row(item, 0))
+        elif not inline_thumbs:
+            # The source's mtime versions the thumbnail URL, so browsers cache it safely
+            rows.append(story_row(item, int(os.path.getmtime(filepath))))
+        else:
+            # Browsers can't fetch /thumbs/, so inline the smallest derivative
+            try:
+                rows.append(story_row(item, thumbnail_data_uri(filepath)))
+            except Exception as e:
+                print(f"Error creating thumbnail for {filepath}: {e}")
+                rows.append(story_row(item, 0))
+    return rows
+
+def cluster_marker_payload(bounds, zoom, inline_thumbs):
+    """Marker payload for the precomputed clusters in view at this zoom"""
+    from markers import cluster_row
+    clusters = cluster_index.current().clusters(zoom, *bounds)
+    return {
+        's': story_marker_rows(sorted(c.single_id for c in clusters if c.count == 1), inline_thumbs),
+        'c': [cluster_row(c) for c in clusters if c.count > 1],
+    }
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def get_marker_payload(version, bounds, zoom, clustered, search, inline_thumbs):
+    """Compact marker payload (see markers.py) for a viewport and search, memoized per store version
+
+    search is a tuple of search() argument pairs; clusters are only used
+    when it is empty. inline_thumbs embeds marker thumbnails as data: URIs
+    for sessions that can't fetch /thumbs/. Reruns with unchanged data and viewport (e.g.
+    clicking a "View" button) reuse the previous result.
+    """
+    if clustered and not search and zoom <= CLUSTER_MAX_ZOOM:
+        payload = cluster_marker_payload(bounds, zoom, inline_thumbs)
+    else:
+        ids = archive_index.search(bbox=bounds, **dict(search))
+        if len(ids) > MAX_VIEW_MARKERS:
+            # Too many to draw individually; show the ones nearest the center
+            mid_lat, mid_lon = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+            rows = [archive_index.row(item_id) for item_id in ids]
+            rows.sort(key=lambda r: (r[2] - mid_lat) ** 2 + (r[3] - mid_lon) ** 2)
+            ids = [r[0] for r in rows[:MAX_VIEW_MARKERS]]
+        payload = {'s': story_marker_rows(sorted(ids), inline_thumbs), 'c': []}
+    return payload
+
+def track_popup_html(track):
+    """Popup for a flight track, linking to the media captured on it"""
+    minutes = track['duration_s'] / 60
+    html = f"<b>{track['name']}</b><br>{track['start'] or ''} · {minutes:.0f} min"
+    links = [f'<a href="?story_id={item["id"]}" target="_top">{item["title"]}</a>'
+             for item in store.get_many(track['media_ids'][:20])]
+    if links:
+        html += "<br>" + "<br>".join(links)
+    if len(track['media_ids']) > 20:
+        html += f"<br>… and {len(track['media_ids']) - 20} more"
+    return html
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def get_track_specs(version, media_version, bounds, zoom):
+    """(locations, tooltip, popup) of the tracks crossing a viewport, simplified for zoom"""
+    return [
+        (track_store.simplified(track['id'], zoom), f"✈️ {track['name']}", track_popup_html(track))
+        for track in track_store.tracks(bounds)
+    ]
+
+def create_marker_layer(bounds, zoom, search):
+    """Marker layer for the media matching search and the flight tracks inside bounds"""
+    import folium
+    from markers import MarkerPayload
+    frozen = tuple(sorted((key, tuple(value) if isinstance(value, list) else value)
+                          for key, value in search.items()))
+    payload = get_marker_payload(store.version(), bounds, zoom, st.session_state.cluster_markers, frozen,
+                                 media_base is None)
+    # Sessions can reach the app at different origins, so the thumbnail base isn't cached
+    payload = dict(payload, u=f'{media_base}/thumbs/' if media_base else '')
+    metrics.gauge('map_markers', len(payload['s']) + len(payload['c']))
+    layer = folium.FeatureGroup(name='Media')
+    for locations, tooltip, popup in get_track_specs(track_store.version(), store.version(), bounds, zoom):
+        folium.PolyLine(locations, color='#7C4DFF', weight=3, opacity=0.8,
+                        tooltip=tooltip, popup=folium.Popup(popup, max_width=300)).add_to(layer)
+    MarkerPayload(payload).add_to(layer)
+    return layer
+
 # Header
 st.markdown("""
 <div style="text-align: center; margin-bottom: 30px;">
@@ -405,17 +524,23 @@ if st.session_state.viewing_story is None:
     if 'story_id' in query_params:
         try:
             story_id = int(query_params['story_id'])
-            for idx, story in enumerate(st.session_state.media_data):
-                if story['id'] == story_id:
-                    st.session_state.viewing_story = story_id
-                    st.session_state.current_story_index = idx
-                    break
+            story = store.get(story_id)
+            if story:
+                st.session_state.viewing_story = story_id
         except:
             pass
 
+metrics.lap('page_setup')
+
 # STORY VIEWER
 if st.session_state.viewing_story is not None:
-    current_story = st.session_state.media_data[st.session_state.current_story_index]
+    current_story = store.get(st.session_state.viewing_story)
+    if current_story is None:
+        # Deleted since it was opened
+        st.session_state.viewing_story = None
+        st.rerun()
+    prev_story, next_story = store.neighbors(current_story['id'])
+    prefetch_stories([prev_story, next_story])
     
     # Create overlay
     st.markdown("""
@@ -457,8 +582,10 @@ if st.session_state.viewing_story is not None:
             if current_story['type'] == 'image':
                 # Display image
                 try:
-                    image = Image.open(current_story['filepath'])
-                    st.image(image, use_container_width=True)
+                    st.image(get_derivative(current_story['filepath'], VIEWER_IMAGE_SIZE),
+                             use_container_width=True)
+                    # Only the derivative is sent; the full original is a click away
+                    original_link(current_story, "🔍 Open original", 'target="_blank"')
                 except:
                     st.markdown(f"""
                     <div style="width: 100%; height: 100%; display: flex; flex-direction: column; align-items: center; justify-content: center; color: white;">
@@ -467,11 +594,16 @@ if st.session_state.viewing_story is not None:
                     </div>
                     """, unsafe_allow_html=True)
             else:
-                # Display video
+                # Display video, streamed with range requests from the media server
+                # or server.py's /files/ when browsers can reach them. Prefer the web-friendly proxy; the
+                # original stays downloadable.
                 try:
-                    with open(current_story['filepath'], 'rb') as f:
-                        video_bytes = f.read()
-                    st.video(video_bytes)
+                    proxy = current_story.get('proxy_path')
+                    if proxy and os.path.exists(proxy):
+                        st.video(media_url(current_story, 'proxy_path', media_base) if media_base else proxy)
+                        original_link(current_story, "⬇️ Download original", 'download')
+                    else:
+                        st.video(media_url(current_story, base=media_base) if media_base else current_story['filepath'])
                 except:
                     st.markdown(f"""
                     <div style="width: 100%; height: 100%; display: flex; flex-direction: column; align-items: center; justify-content: center; color: white;">
@@ -524,8 +656,7 @@ if st.session_state.viewing_story is not None:
     col1, col2, col3 = st.columns(3)
     with col1:
         if st.button("← Previous", key="prev_story", use_container_width=True):
-            prev_index = (st.session_state.current_story_index - 1) % len(st.session_state.media_data)
-            st.session_state.current_story_index = prev_index
+            st.session_state.viewing_story = prev_story['id']
             st.rerun()
     
     with col2:
@@ -535,9 +666,10 @@ if st.session_state.viewing_story is not None:
     
     with col3:
         if st.button("Next →", key="next_story", use_container_width=True):
-            next_index = (st.session_state.current_story_index + 1) % len(st.session_state.media_data)
-            st.session_state.current_story_index = next_index
+            st.session_state.viewing_story = next_story['id']
             st.rerun()
+    
+    metrics.lap('viewer')
 
 else:
     # Main app when not viewing a story
@@ -545,30 +677,106 @@ else:
     
     with col1:
         # Create map
-        m = create_map()
-        map_output = st_folium(m, width=None, height=600, key="main_map")
+        with metrics.timer('create_map'):
+            m = create_map()
+        # Only the marker layer changes as the user pans/zooms; st_folium
+        # swaps it in place without re-rendering the base map
+        with metrics.timer('marker_layer'):
+            marker_layer = create_marker_layer(*get_view_bounds(), get_search())
+        with metrics.timer('st_folium'):
+            from streamlit_folium import st_folium
+            map_output = st_folium(m, width=None, height=600, key="main_map",
+                                   feature_group_to_add=marker_layer,
+                                   returned_objects=['bounds', 'zoom', 'last_clicked', 'last_active_drawing'])
+        if (metrics.count('map_renders_total') - 1) % METRICS_HTML_SAMPLE == 0:
+            # st_folium has added the marker layer to m, so this is the whole map
+            metrics.gauge('map_html_bytes', len(m.get_root().render()))
+        
+        # A newly drawn shape becomes the search area
+        drawing = (map_output or {}).get('last_active_drawing')
+        if drawing and drawing != st.session_state.search_drawing:
+            st.session_state.search_drawing = drawing
+            st.session_state.search_area = area_from_geojson(drawing)
+            st.rerun()
+        if st.session_state.search_area:
+            area_cols = st.columns([4, 1])
+            with area_cols[0]:
+                st.caption("🔎 Map and gallery show only media inside the drawn area")
+            with area_cols[1]:
+                if st.button("Clear area", key="clear_search_area", use_container_width=True):
+                    st.session_state.search_area = {}
+                    st.rerun()
+        
+        # A map click sets the fallback location for uploads without GPS
+        if map_output and map_output.get('last_clicked'):
+            st.session_state.selected_lat = map_output['last_clicked']['lat']
+            st.session_state.selected_lon = map_output['last_clicked']['lng']
+        metrics.lap('map')
         
         # Quick view stories
         st.markdown("### 📱 Quick View")
         cols = st.columns(3)
-        for idx, story in enumerate(st.session_state.media_data[:6]):
+        for idx, story in enumerate(store.query(limit=6)):
             with cols[idx % 3]:
                 # Create clickable story card
                 if st.button(f"👁️ {story['title'][:15]}...", 
                            key=f"quick_view_{story['id']}",
                            use_container_width=True):
                     st.session_state.viewing_story = story['id']
-                    st.session_state.current_story_index = idx
                     st.rerun()
                 
                 # Show thumbnail if available
-                if story.get('filepath') and os.path.exists(story['filepath']) and story['type'] == 'image':
+                thumb = story_image(story, QUICK_VIEW_SIZE)
+                if thumb:
+                    st.image(thumb, use_container_width=True)
+        
+        metrics.lap('quick_view')
+        
+        # Upload media
+        with st.expander("➕ Add media"):
+            uploaded_files = st.file_uploader(
+                "Drop drone photos, videos or flight logs (.srt, .csv, .gpx)",
+                type=sorted(IMAGE_EXTENSIONS | VIDEO_EXTENSIONS | TRACK_EXTENSIONS),
+                accept_multiple_files=True,
+                key="upload_files"
+            )
+            if st.session_state.selected_lat is not None:
+                st.caption(f"📍 Files without GPS will be placed at "
+                           f"{st.session_state.selected_lat:.5f}, {st.session_state.selected_lon:.5f}")
+            else:
+                st.caption("📍 Location, altitude and time are read from EXIF/XMP; "
+                           "click the map to place files without GPS")
+            if uploaded_files and st.button("Upload", key="upload_submit", type="primary"):
+                logs = [f for f in uploaded_files if f.name.rsplit('.', 1)[-1].lower() in TRACK_EXTENSIONS]
+                uploaded_files = [f for f in uploaded_files if f not in logs]
+                for log in logs:
                     try:
-                        with Image.open(story['filepath']) as img:
-                            img.thumbnail((200, 150))
-                            st.image(img, use_container_width=True)
-                    except:
-                        pass
+                        track_id = import_track(log.name, log.getvalue().decode('utf-8', 'replace'),
+                                                store, track_store)
+                    except ValueError as e:
+                        st.warning(f"Couldn't read flight log {log.name}: {e}")
+                        continue
+                    track = track_store.get(track_id)
+                    st.toast(f"Added track {track['name']} ({len(track['media_ids'])} linked item(s))", icon="✈️")
+                results = [save_uploaded_file(f) for f in uploaded_files]
+                found = extract_many([r.path for r in results])
+                items = []
+                for uploaded_file, result in zip(uploaded_files, results):
+                    item = build_media_record(uploaded_file.name, result, found.get(result.path, {}))
+                    if item is None:
+                        st.warning(f"No location for {uploaded_file.name}: click the map and upload it again")
+                        continue
+                    if result.duplicate:
+                        st.info(f"{uploaded_file.name} is already stored; the new story shares that file")
+                    elif item.get('phash'):
+                        similar = get_perceptual_index().find(item['phash'])
+                        if similar:
+                            st.info(f"{uploaded_file.name} looks like a near-duplicate of "
+                                    + ", ".join(f"#{item_id}" for item_id, _ in similar[:5]))
+                    items.append(item)
+                if items:
+                    store.insert_many(items)
+                    st.toast(f"Added {len(items)} item(s) to the map", icon="✅")
     
     with col2:
         st.markdown("### 📍 Legend")
@@ -585,31 +793,133 @@ else:
         </div>
         """, unsafe_allow_html=True)
         
+        st.toggle("Cluster markers", key="cluster_markers",
+                  help="Group nearby stories into one marker until you zoom in")
+        
         st.markdown("---")
         st.markdown("### 📊 Stats")
-        total = len(st.session_state.media_data)
-        images = sum(1 for x in st.session_state.media_data if x['type'] == 'image')
-        videos = sum(1 for x in st.session_state.media_data if x['type'] == 'video')
-        st.metric("Total", total)
-        st.metric("Photos", images)
-        st.metric("Videos", videos)
+        if flight_stats is None:
+            st.caption("⏳ Statistics are still being computed")
+        else:
+            counts = flight_stats.counts_by_type()
+            total = sum(counts.values())
+            images = counts.get('image', 0)
+            videos = counts.get('video', 0)
+            st.metric("Total", total)
+            st.metric("Photos", images)
+            st.metric("Videos", videos)
+            st.metric("Area covered", f"{flight_stats.coverage()['area_km2']:,.1f} km²")
+        
+        jobs = transcoder.queue.jobs()
+        if jobs:
+            st.markdown("---")
+            st.markdown("### 🎞️ Processing")
+            for job in jobs:
+                if job['status'] == 'failed':
+                    st.caption(f"Video #{job['media_id']} failed (attempt {job['attempts']} of "
+                               f"{transcoder.queue.max_attempts}, retried on restart): {job['error']}")
+                else:
+                    st.progress(job['progress'], text=f"Video #{job['media_id']} · {job['status']}")
+    
+    metrics.lap('upload_and_stats')
+
+# Flight statistics
+with st.expander("📈 Flight statistics"):
+    if flight_stats is None:
+        st.caption("⏳ Statistics are still being computed")
+    else:
+        stat_cols = st.columns(2)
+        with stat_cols[0]:
+            st.markdown("**Media per day**")
+            by_day = flight_stats.counts_by_day()
+            if not by_day.empty:
+                st.bar_chart(by_day)
+            st.markdown("**Altitude (m)**")
+            histogram = flight_stats.altitude_histogram()
+            if not histogram.empty:
+                st.bar_chart(histogram.rename('media'))
+        with stat_cols[1]:
+            coverage = flight_stats.coverage()
+            st.markdown("**Coverage**")
+            st.caption(f"{coverage['cells']:,} cells of ~1 km² • {coverage['area_km2']:,.1f} km²")
+            if coverage['bbox']:
+                south, west, north, east = coverage['bbox']
+                st.caption(f"Bounds {south:.4f}, {west:.4f} → {north:.4f}, {east:.4f}")
+            st.markdown("**Flights per region**")
+            st.dataframe(flight_stats.flights_per_region().head(20), hide_index=True,
+                         use_container_width=True,
+                         column_config={'lat': st.column_config.NumberColumn(format="%.2f"),
+                                        'lon': st.column_config.NumberColumn(format="%.2f")})
+
+metrics.lap('flight_stats')
 
 # Stories tab
 st.markdown("---")
 st.markdown("## 📱 All Stories")
 
-if st.session_state.media_data:
+# Sort options: label -> (column, descending)
+GALLERY_SORTS = {
+    'Newest first': ('timestamp', True),
+    'Oldest first': ('timestamp', False),
+    'Highest altitude': ('altitude', True),
+    'Lowest altitude': ('altitude', False),
+    'Title': ('title', False),
+}
+
+# The search bar also filters the map; draw a shape on the map to search an area
+filter_cols = st.columns([1, 1, 2, 1])
+with filter_cols[0]:
+    st.selectbox("Type", list(SEARCH_TYPES), key="search_type")
+with filter_cols[1]:
+    gallery_sort = st.selectbox("Sort", list(GALLERY_SORTS), key="gallery_sort")
+with filter_cols[2]:
+    st.date_input("Date range", value=(), key="search_dates")
+with filter_cols[3]:
+    st.number_input("Min altitude (m)", min_value=0, value=0, step=10, key="search_min_altitude")
+
+search = get_search()
+if serve_media:
+    export_url = f"{MEDIA_BASE_URL}/api/media?{urlencode(to_params(search))}"
+    st.caption(f"[⬇️ Export matches as JSON]({export_url}) • [GeoJSON]({export_url}&format=geojson)")
+
+# Filtering, sorting and paging all happen in the store; only one page of
+# records is fetched and rendered per run. Area searches are answered by
+# the archive index and handed to the store as the ids to page through.
+gallery_filters = dict(search)
+if 'polygon' in search or 'near' in search:
+    gallery_filters = {'ids': archive_index.search(**search)}
+sort_column, sort_descending = GALLERY_SORTS[gallery_sort]
+
+# Changing a filter or the sort starts again from the first page
+filter_key = (gallery_sort, repr(sorted(search.items())))
+if st.session_state.gallery_filters != filter_key:
+    st.session_state.gallery_filters = filter_key
+    st.session_state.gallery_cursors = [None]
+
+total_stories = store.count(**gallery_filters)
+page_number = len(st.session_state.gallery_cursors)
+page = store.query(order=sort_column, descending=sort_descending, limit=GALLERY_PAGE_SIZE + 1,
+                   after=st.session_state.gallery_cursors[-1], **gallery_filters)
+has_next = len(page) > GALLERY_PAGE_SIZE
+page = page[:GALLERY_PAGE_SIZE]
+
+if not page:
+    st.info("No stories match these filters")
+else:
     cols = st.columns(3)
     
-    for idx, story in enumerate(st.session_state.media_data):
+    for idx, story in enumerate(page):
         with cols[idx % 3]:
+            thumb = story_image(story, GALLERY_THUMB_SIZE)
+            if thumb:
+                st.image(thumb, use_container_width=True)
+            
             # Story card
             if st.button(f"👁️ View {story['title'][:20]}...", 
                         key=f"view_{story['id']}",
                         use_container_width=True,
                         help=f"Click to view this story"):
                 st.session_state.viewing_story = story['id']
-                st.session_state.current_story_index = idx
                 st.rerun()
             
             # Story info
@@ -641,6 +951,25 @@ if st.session_state.media_data:
             </div>
             """, unsafe_allow_html=True)
 
+    # Pager
+    page_count = max(1, math.ceil(total_stories / GALLERY_PAGE_SIZE))
+    pager = st.columns([1, 2, 1])
+    with pager[0]:
+        if st.button("⬅️ Previous page", key="gallery_prev",
+                     disabled=page_number == 1, use_container_width=True):
+            st.session_state.gallery_cursors.pop()
+            st.rerun()
+    with pager[1]:
+        st.markdown(f"<div style='text-align: center; color: #666;'>Page {page_number} of {page_count} "
+                    f"• {total_stories} stories</div>", unsafe_allow_html=True)
+    with pager[2]:
+        if st.button("Next page ➡️", key="gallery_next", disabled=not has_next, use_container_width=True):
+            last = page[-1]
+            st.session_state.gallery_cursors.append((last[sort_column], last['id']))
+            st.rerun()
+
+metrics.lap('gallery')
+
 # Footer
 st.markdown("""
 <div style="text-align: center; color: #999; font-size: 12px; padding: 20px 0; margin-top: 30px;">
@@ -648,3 +977,42 @@ st.markdown("""
 </div>
 """, unsafe_allow_html=True)
  
+
+# Performance panel: the previous rerun of this session (this one is still
+# running) and process-wide totals; the same numbers are on /metrics
+with st.expander("🛠️ Performance"):
+    last_stages, last_total = st.session_state.get('last_run') or ([], 0.0)
+    perf_cols = st.columns(2)
+    with perf_cols[0]:
+        st.markdown(f"**Last rerun: {last_total * 1000:,.0f} ms**")
+        st.dataframe([{'stage': name, 'ms': round(seconds * 1000, 1)} for name, seconds in last_stages],
+                     hide_index=True, use_container_width=True)
+    with perf_cols[1]:
+        st.markdown("**All reruns**")
+        st.dataframe([{'stage': name, 'count': t['count'], 'mean ms': round(t['mean'] * 1000, 1),
+                       'max ms': round(t['max'] * 1000, 1)}
+                      for name, t in sorted(metrics.timer_stats().items())],
+                     hide_index=True, use_container_width=True)
+    counters = {name + ''.join(f"[{v}]" for _, v in labels): value for name, _, labels, value in metrics.samples()}
+    thumb_lookups = counters.get('thumbnail_cache_hits_total', 0) + counters.get('thumbnail_cache_misses_total', 0)
+    store_lookups = counters.get('store_cache_hits_total', 0) + counters.get('store_cache_misses_total', 0)
+    metric_cols = st.columns(4)
+    metric_cols[0].metric("Thumbnail cache hits",
+                          f"{counters.get('thumbnail_cache_hits_total', 0) / thumb_lookups:.0%}" if thumb_lookups else "–")
+    metric_cols[1].metric("Store cache hits",
+                          f"{counters.get('store_cache_hits_total', 0) / store_lookups:.0%}" if store_lookups else "–")
+    metric_cols[2].metric("Map HTML", f"{counters.get('map_html_bytes', 0) / 1024:,.0f} KB")
+    metric_cols[3].metric("Markers", counters.get('map_markers', 0))
+    # server.py serves /metrics and the probes on the app's own port; plain
+    # `streamlit run app.py` only has /metrics on the media server
+    app_base = app_origin() if app_routes() else None
+    st.caption(f"Prometheus metrics: {app_base or MEDIA_BASE_URL}/metrics")
+    warm = warmup.status()
+    if warm['ready']:
+        probe_note = f" • readiness probe: {app_base}/readyz" if app_base else ""
+        st.caption(f"Warm-up finished in {warm['seconds']:.1f}s{probe_note}")
+    else:
+        pending = [name for name, task in warm['tasks'].items() if task['state'] in ('pending', 'running')]
+        st.caption(f"Warming up: {', '.join(pending)}")
+
+st.session_state.last_run = metrics.finish_run()
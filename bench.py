@@ -0,0 +1,288 @@
+"""Benchmarks of the core paths over synthetic drone archives
+
+    python bench.py [--sizes 1000,10000,100000,1000000] [--backend sqlite|json]
+                    [--spread-km 50] [--files 200] [--seed 1] [--no-app]
+
+For each size a synthetic archive in the media_data.json schema is
+generated in a scratch directory: flights of 20-300 captures scattered
+within --spread-km of --center, with --files distinct dummy JPEGs shared
+between the stills and as video posters, and dummy video/proxy files, so
+nothing needs ffmpeg. Each size runs in its own process, so caches, indexes
+and background threads don't carry over between sizes.
+
+Timed paths:
+- saving and loading the JSON archive, and the SQLite import and reopen
+- building the spatial, cluster and search indexes and the flight stats
+- image derivatives at the marker, gallery and viewer sizes, cold and warm
+- story lookup: get() and neighbors(), mean per call
+- gallery: count, first page and a page deep in the archive
+- the app itself, headless via Streamlit's AppTest: a cold first run, the
+  time until its background warm-up reports ready on /readyz, a warm rerun
+  and its per-stage breakdown (create_map, st_folium, gallery, ...), and a
+  story viewer run
+
+Every measurement is appended as a tab-separated row (commit, date,
+backend, size, stage, seconds) to bench_output.txt, so results from
+different commits can be compared side by side.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_FILE = os.path.join(REPO_DIR, 'bench_output.txt')
+HEADER = 'commit\tdate\tbackend\tsize\tstage\tseconds\n'
+
+LOOKUPS = 1000
+KM_PER_DEG = 111.32
+
+
+def commit_id():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def make_files(count, rng):
+    """Dummy stills (distinct JPEGs) and one dummy video/proxy file under uploads/bench"""
+    from PIL import Image, ImageDraw
+
+    root = os.path.join('uploads', 'bench')
+    os.makedirs(root, exist_ok=True)
+    images = []
+    for i in range(count):
+        path = os.path.join(root, f'still_{i:05d}.jpg')
+        image = Image.new('RGB', (1280, 960), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x, y = rng.randrange(1280), rng.randrange(960)
+            draw.rectangle([x, y, x + rng.randrange(40, 400), y + rng.randrange(40, 300)],
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        image.save(path, quality=85)
+        images.append(path)
+    video = os.path.join(root, 'clip.mp4')
+    with open(video, 'wb') as f:
+        f.write(b'\x00\x00\x00\x18ftypmp42' + bytes(4096))
+    return images, video
+
+
+def make_archive(size, images, video, center, spread_km, rng):
+    """Records in the media_data.json schema, grouped into flights"""
+    records = []
+    start = datetime(2024, 1, 1, 8, 0, 0)
+    while len(records) < size:
+        # Each flight starts somewhere in the area and drifts from there
+        distance = spread_km * math.sqrt(rng.random())
+        bearing = rng.random() * 2 * math.pi
+        lat = center[0] + distance * math.cos(bearing) / KM_PER_DEG
+        lon = center[1] + distance * math.sin(bearing) / (KM_PER_DEG * math.cos(math.radians(center[0])))
+        when = start + timedelta(days=rng.randrange(3 * 365), minutes=rng.randrange(10 * 60))
+        altitude = rng.choice([40, 60, 80, 120, 200])
+        for _ in range(min(rng.randrange(20, 300), size - len(records))):
+            lat += rng.gauss(0, 0.0004)
+            lon += rng.gauss(0, 0.0004)
+            when += timedelta(seconds=rng.randrange(2, 30))
+            item_id = len(records) + 1
+            record = {
+                'id': item_id,
+                'type': 'video' if rng.random() < 0.15 else 'image',
+                'title': f'Flight capture {item_id}',
+                'lat': round(lat, 6),
+                'lon': round(lon, 6),
+                'timestamp': when.strftime('%Y-%m-%d %H:%M:%S'),
+                'altitude': altitude + rng.randrange(-10, 10),
+                'description': 'Synthetic benchmark capture',
+            }
+            if record['type'] == 'video':
+                record.update(filepath=video, proxy_path=video, poster_path=rng.choice(images))
+            else:
+                record['filepath'] = rng.choice(images)
+            records.append(record)
+    return records
+
+
+class Timings:
+    def __init__(self, size):
+        self.size = size
+        self.rows = []
+
+    def add(self, stage, seconds):
+        self.rows.append((stage, seconds))
+        print(f"  {self.size:>9,}  {stage:<28} {seconds * 1000:>12,.3f} ms", flush=True)
+
+    def time(self, stage, fn, repeat=1):
+        """Run fn `repeat` times and record the mean; returns the last result"""
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        self.add(stage, (time.perf_counter() - start) / repeat)
+        return result
+
+
+def run_size(size, args, results):
+    """Benchmark one archive size in a scratch directory (runs in a child process)"""
+    workdir = tempfile.mkdtemp(prefix=f'bench-{size}-', dir=args.workdir)
+    os.chdir(workdir)
+    os.environ['MEDIA_BACKEND'] = args.backend
+    sys.path.insert(0, REPO_DIR)
+    try:
+        timings = Timings(size)
+        rng = random.Random(args.seed)
+        images, video = timings.time('generate_files', lambda: make_files(args.files, rng))
+        records = timings.time('generate_archive', lambda: make_archive(
+            size, images, video, args.center, args.spread_km, rng))
+
+        from config import CLUSTER_MAX_ZOOM, CLUSTER_RADIUS_PX, DATA_FILE, GALLERY_PAGE_SIZE
+        from storage import JsonMediaStore, SqliteMediaStore, _write_json_atomic
+
+        timings.time('json_save', lambda: _write_json_atomic(DATA_FILE, records))
+        del records
+        store = timings.time('json_load', lambda: JsonMediaStore(DATA_FILE))
+        if args.backend == 'sqlite':
+            timings.time('sqlite_import', lambda: SqliteMediaStore().count())
+            store = timings.time('sqlite_open', lambda: SqliteMediaStore())
+
+        from analytics import FlightStats
+        from clustering import ClusterIndex
+        from geo import StoreSpatialIndex
+        from query import ArchiveIndex
+
+        timings.time('spatial_index', lambda: StoreSpatialIndex(store))
+        timings.time('cluster_index', lambda: StoreSpatialIndex(
+            store, lambda: ClusterIndex(max_zoom=CLUSTER_MAX_ZOOM, radius_px=CLUSTER_RADIUS_PX)))
+        timings.time('archive_index', lambda: ArchiveIndex(store))
+        timings.time('flight_stats', lambda: FlightStats(store))
+
+        from config import GALLERY_THUMB_SIZE, MARKER_THUMB_SIZE, VIEWER_IMAGE_SIZE
+        from thumbnails import get_derivative
+
+        def thumbnails():
+            for path in images:
+                for size in (MARKER_THUMB_SIZE, GALLERY_THUMB_SIZE, VIEWER_IMAGE_SIZE):
+                    get_derivative(path, size)
+        timings.time('thumbnails_cold', thumbnails)
+        timings.time('thumbnails_warm', thumbnails)
+
+        ids = [rng.randrange(1, size + 1) for _ in range(LOOKUPS)]
+        lookups = iter(ids * 2)
+        timings.time('story_get', lambda: store.get(next(lookups)), repeat=LOOKUPS)
+        timings.time('story_neighbors', lambda: store.neighbors(next(lookups)), repeat=LOOKUPS)
+
+        timings.time('gallery_count', lambda: store.count(types=['image']))
+        page = timings.time('gallery_first_page', lambda: store.query(
+            order='timestamp', descending=True, limit=GALLERY_PAGE_SIZE + 1))
+        # One extra row tells the gallery there is a next page
+        assert len(page) == min(size, GALLERY_PAGE_SIZE + 1), len(page)
+        middle = store.get(size // 2)
+        page = timings.time('gallery_deep_page', lambda: store.query(
+            order='timestamp', descending=True, limit=GALLERY_PAGE_SIZE + 1,
+            after=(middle['timestamp'], middle['id'])))
+        assert page and (page[0]['timestamp'], page[0]['id']) < (middle['timestamp'], middle['id'])
+
+        if args.app:
+            run_app(timings, ids[0], args.timeout)
+        results.put((size, timings.rows))
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def wait_ready(timeout):
+    """Poll the app port's /readyz (server.py) until it answers 200; returns whether it did
+
+    AppTest runs the script in this process, so the endpoint is called
+    directly and sees the same warm-up as the app.
+    """
+    import asyncio
+
+    from server import readyz
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if asyncio.run(readyz(None)).status_code == 200:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def run_app(timings, story_id, timeout):
+    """Run app.py headlessly and record its runs and per-stage breakdown"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(REPO_DIR, 'app.py'), default_timeout=timeout)
+    start = time.perf_counter()
+    timings.time('app_cold_run', at.run)
+    if wait_ready(timeout):
+        timings.add('app_ready', time.perf_counter() - start)
+    timings.time('app_warm_run', at.run)
+    if at.exception:
+        raise RuntimeError(f"app raised: {at.exception[0].value}")
+    # The warm run's breakdown is stored for the Performance panel
+    stages, _ = at.session_state['last_run']
+    for stage, seconds in stages:
+        timings.add(f'app:{stage}', seconds)
+    at.session_state['viewing_story'] = story_id
+    timings.time('app_viewer_run', at.run)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app over synthetic drone archives")
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma-separated archive sizes (e.g. 1000,10000,100000,1000000)")
+    parser.add_argument('--backend', choices=['sqlite', 'json'], default='sqlite')
+    parser.add_argument('--center', type=float, nargs=2, default=(34.05, -118.24), metavar=('LAT', 'LON'))
+    parser.add_argument('--spread-km', type=float, default=50.0, help="radius the flights are spread over")
+    parser.add_argument('--files', type=int, default=200, help="distinct dummy images")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-app', dest='app', action='store_false', help="skip the headless app runs")
+    parser.add_argument('--timeout', type=float, default=1800, help="seconds allowed per app run")
+    parser.add_argument('--workdir', default=None, help="where scratch archives are created")
+    parser.add_argument('--keep', action='store_true', help="keep the scratch archives")
+    parser.add_argument('--output', default=OUTPUT_FILE)
+    args = parser.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    commit, date = commit_id(), datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    print(f"Benchmarking {args.backend} at commit {commit}")
+    ctx = multiprocessing.get_context('spawn')
+    failed = False
+    for size in sizes:
+        results = ctx.Queue()
+        worker = ctx.Process(target=run_size, args=(size, args, results))
+        worker.start()
+        rows = None
+        # Drain the queue before joining so a large result can't block the child
+        while rows is None and (worker.is_alive() or not results.empty()):
+            try:
+                _, rows = results.get(timeout=1)
+            except queue.Empty:
+                pass
+        worker.join()
+        if rows is None:
+            print(f"Size {size} failed (exit code {worker.exitcode})", file=sys.stderr)
+            failed = True
+            continue
+        new_file = not os.path.exists(args.output)
+        with open(args.output, 'a') as f:
+            if new_file:
+                f.write(HEADER)
+            for stage, seconds in rows:
+                f.write(f"{commit}\t{date}\t{args.backend}\t{size}\t{stage}\t{seconds:.6f}\n")
+    print(f"Results appended to {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Bulk import of a folder or ZIP archive of drone media
+
+Each file is handled by a worker process: it is streamed into UPLOAD_DIR
+(hashing as it goes), its EXIF/XMP metadata is extracted and its derivative
+pyramid is rendered. The parent collects the resulting records and
+commits them to the store in one batched insert.
+"""
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from dedup import perceptual_hash
+from ingest import ingest_stream
+from metadata import IMAGE_EXTENSIONS, POSE_FIELDS, VIDEO_EXTENSIONS, extract_metadata
+from thumbnails import cache_derivatives, remember_digests
+
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS | VIDEO_EXTENSIONS
+
+
+def _extension(name):
+    return name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+
+
+def list_sources(path):
+    """(container, member) pairs for every media file in a folder or ZIP
+
+    container is the ZIP path for archive members and None for plain files.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            return [(path, info.filename) for info in archive.infolist()
+                    if not info.is_dir() and _extension(info.filename) in MEDIA_EXTENSIONS]
+    sources = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if _extension(name) in MEDIA_EXTENSIONS:
+                sources.append((None, os.path.join(root, name)))
+    return sources
+
+
+_archives = {}
+
+
+def _open_archive(path):
+    """ZipFile kept open per worker process so the directory is parsed once"""
+    if path not in _archives:
+        _archives[path] = zipfile.ZipFile(path)
+    return _archives[path]
+
+
+def process_source(source):
+    """Worker: store one file, extract metadata and build its derivatives"""
+    container, member = source
+    ext = _extension(member)
+    if container is None:
+        with open(member, 'rb') as f:
+            result = ingest_stream(f, ext)
+        mtime = os.path.getmtime(member)
+    else:
+        archive = _open_archive(container)
+        info = archive.getinfo(member)
+        with archive.open(info) as f:
+            result = ingest_stream(f, ext)
+        mtime = datetime(*info.date_time).timestamp()
+
+    meta = extract_metadata(result.path)
+    phash = None
+    if ext in IMAGE_EXTENSIONS:
+        try:
+            cache_derivatives(result.path, result.sha256)
+            phash = perceptual_hash(result.path)
+        except Exception as e:
+            print(f"Error creating derivatives for {member}: {e}")
+    record = {
+        'type': 'video' if ext in VIDEO_EXTENSIONS else 'image',
+        'title': os.path.splitext(os.path.basename(member))[0][:60],
+        'lat': meta.get('lat'),
+        'lon': meta.get('lon'),
+        'timestamp': meta.get('timestamp') or datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S'),
+        'altitude': meta.get('altitude', 0),
+        'description': '',
+        'filepath': result.path,
+        'sha256': result.sha256,
+    }
+    record.update({key: meta[key] for key in POSE_FIELDS if key in meta})
+    if phash:
+        record['phash'] = phash
+    return record, result
+
+
+def bulk_import(path, store, workers=None, default_location=None, progress=None):
+    """Import every media file under path (folder or ZIP) into store
+
+    Files without GPS use default_location (lat, lon) if given, otherwise
+    they are skipped. Returns a summary dict.
+    """
+    start = time.perf_counter()
+    sources = list_sources(path)
+    records, digests, skipped = [], {}, []
+    total_bytes = 0
+    duplicates, reclaimed = 0, 0
+    stored, unplaced = set(), set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(process_source, source): source for source in sources}
+        for done, future in enumerate(as_completed(futures), 1):
+            source = futures[future]
+            if progress:
+                progress(done, len(sources))
+            try:
+                record, result = future.result()
+            except Exception as e:
+                skipped.append((source[1], str(e)))
+                continue
+            if record['lat'] is None or record['lon'] is None:
+                if default_location is None:
+                    skipped.append((source[1], 'no GPS position'))
+                    if not result.duplicate:
+                        unplaced.add(result.path)
+                    continue
+                record['lat'], record['lon'] = default_location
+            # Two copies in one batch both look new to their workers
+            if result.duplicate or result.path in stored:
+                duplicates += 1
+                reclaimed += result.size
+            stored.add(result.path)
+            records.append(record)
+            digests[record['filepath']] = result.sha256
+            total_bytes += result.size
+
+    # Drop newly stored files that no imported record ended up using
+    for path in unplaced - stored:
+        os.remove(path)
+
+    # One transaction and one thumbnail-index write for the whole batch
+    records.sort(key=lambda r: (r['timestamp'], r['title']))
+    store.insert_many(records)
+    remember_digests(digests)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'imported': len(records),
+        'skipped': skipped,
+        'bytes': total_bytes,
+        'duplicates': duplicates,
+        'reclaimed_bytes': reclaimed,
+        'seconds': elapsed,
+        'files_per_second': len(sources) / elapsed if elapsed else 0.0,
+    }
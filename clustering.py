@@ -0,0 +1,117 @@
+"""Per-zoom marker clusters, maintained incrementally
+
+Points are bucketed into a Web Mercator grid at every zoom level, with cells
+`radius_px` screen pixels wide. Because a cell at zoom z splits exactly into
+four cells at zoom z+1, the levels form a hierarchy and an insert or delete
+only touches one cell per level. Each cell keeps a running aggregate (count,
+centroid sums, per-type counts) so rendering a zoom level is a lookup of the
+cells in view rather than a clustering pass.
+"""
+import math
+
+from geo import mercator_xy
+
+
+class Cluster:
+    """Running aggregate of the points in one grid cell"""
+
+    __slots__ = ('count', 'lat_sum', 'lon_sum', 'id_sum', 'types')
+
+    def __init__(self):
+        self.count = 0
+        self.lat_sum = 0.0
+        self.lon_sum = 0.0
+        self.id_sum = 0
+        self.types = {}
+
+    @property
+    def lat(self):
+        return self.lat_sum / self.count
+
+    @property
+    def lon(self):
+        return self.lon_sum / self.count
+
+    @property
+    def single_id(self):
+        """The id of the only point when count == 1"""
+        return self.id_sum if self.count == 1 else None
+
+
+class ClusterIndex:
+    """Grid clusters for zoom levels min_zoom..max_zoom"""
+
+    def __init__(self, min_zoom=0, max_zoom=15, radius_px=60):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.radius_px = radius_px
+        self._levels = {z: {} for z in range(min_zoom, max_zoom + 1)}
+        self._points = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def _scale(self, zoom):
+        # Number of cells across the world at this zoom
+        return 256 * 2 ** zoom / self.radius_px
+
+    def _cells(self, x, y):
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            scale = self._scale(zoom)
+            yield zoom, (int(x * scale), int(y * scale))
+
+    def insert(self, item_id, lat, lon, item_type=None):
+        if item_id in self._points:
+            self.remove(item_id)
+        x, y = mercator_xy(lat, lon)
+        self._points[item_id] = (lat, lon, item_type, x, y)
+        for zoom, cell in self._cells(x, y):
+            cluster = self._levels[zoom].get(cell)
+            if cluster is None:
+                cluster = self._levels[zoom][cell] = Cluster()
+            cluster.count += 1
+            cluster.lat_sum += lat
+            cluster.lon_sum += lon
+            cluster.id_sum += item_id
+            cluster.types[item_type] = cluster.types.get(item_type, 0) + 1
+
+    def remove(self, item_id):
+        point = self._points.pop(item_id, None)
+        if point is None:
+            return
+        lat, lon, item_type, x, y = point
+        for zoom, cell in self._cells(x, y):
+            cluster = self._levels[zoom][cell]
+            cluster.count -= 1
+            if cluster.count == 0:
+                del self._levels[zoom][cell]
+                continue
+            cluster.lat_sum -= lat
+            cluster.lon_sum -= lon
+            cluster.id_sum -= item_id
+            cluster.types[item_type] -= 1
+            if not cluster.types[item_type]:
+                del cluster.types[item_type]
+
+    def clusters(self, zoom, south, west, north, east):
+        """Clusters whose cell overlaps the box at a zoom level"""
+        zoom = max(self.min_zoom, min(int(zoom), self.max_zoom))
+        level = self._levels[zoom]
+        scale = self._scale(zoom)
+        x0, y0 = mercator_xy(north, west)
+        x1, y1 = mercator_xy(south, east)
+        cx0, cy0 = int(x0 * scale), int(y0 * scale)
+        cx1, cy1 = int(x1 * scale), int(y1 * scale)
+        if cx0 > cx1:
+            # Box crosses the antimeridian
+            in_x = lambda cx: cx >= cx0 or cx <= cx1
+            n_cells = (int(scale) - cx0 + cx1 + 1) * (cy1 - cy0 + 1)
+        else:
+            in_x = lambda cx: cx0 <= cx <= cx1
+            n_cells = (cx1 - cx0 + 1) * (cy1 - cy0 + 1)
+        if n_cells <= len(level):
+            xs = range(cx0, cx1 + 1) if cx0 <= cx1 else \
+                list(range(cx0, int(math.ceil(scale)))) + list(range(0, cx1 + 1))
+            cells = ((cx, cy) for cx in xs for cy in range(cy0, cy1 + 1))
+            return [level[c] for c in cells if c in level]
+        return [cluster for (cx, cy), cluster in level.items() if in_x(cx) and cy0 <= cy <= cy1]
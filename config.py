@@ -0,0 +1,133 @@
+"""Shared paths and tunables for the drone media app"""
+import os
+
+# Directories
+UPLOAD_DIR = "uploads"
+DATA_FILE = "media_data.json"
+
+# Thumbnail cache
+THUMB_DIR = os.path.join(UPLOAD_DIR, ".thumbs")
+THUMB_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Derivatives used this recently are never evicted, so paths handed out stay readable
+THUMB_EVICT_GRACE_S = 60
+
+# Media metadata store: 'sqlite' (default) or 'json'
+MEDIA_BACKEND = os.environ.get("MEDIA_BACKEND", "sqlite")
+MEDIA_DB = "media.db"
+# Flight tracks: in the media database, or a database next to the JSON archive
+TRACKS_DB = MEDIA_DB if MEDIA_BACKEND == "sqlite" else f"{os.path.splitext(DATA_FILE)[0]}_tracks.db"
+
+# Map
+MAP_DEFAULT_ZOOM = 11
+MAX_VIEW_MARKERS = 400
+
+# Marker clustering: clusters are precomputed for zooms 0..CLUSTER_MAX_ZOOM
+CLUSTER_MAX_ZOOM = 15
+CLUSTER_RADIUS_PX = 60
+
+# Upload ingest: bytes per read/write and how many uploads may stream at once.
+# Files are stored once per content hash under BLOB_DIR.
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+INGEST_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENT_INGESTS = 2
+
+# Local media server (byte-range streaming of uploads). It listens on loopback
+# unless MEDIA_SERVER_HOST says otherwise. MEDIA_BASE_URL is the address the
+# browser uses to reach it, e.g. behind a reverse proxy; only when it is set
+# do pages load media, tiles and marker thumbnails from the server. Without
+# it they go through Streamlit as before.
+MEDIA_SERVER_HOST = os.environ.get("MEDIA_SERVER_HOST", "127.0.0.1")
+MEDIA_SERVER_PORT = int(os.environ.get("MEDIA_SERVER_PORT", "8502"))
+MEDIA_SERVER_PUBLIC = bool(os.environ.get("MEDIA_BASE_URL"))
+MEDIA_BASE_URL = os.environ.get("MEDIA_BASE_URL", f"http://localhost:{MEDIA_SERVER_PORT}").rstrip("/")
+
+# Background video transcoding (requires ffmpeg on PATH)
+JOBS_DB = "jobs.db"
+TRANSCODE_WORKERS = 1
+# A job that has failed this many times isn't queued again
+TRANSCODE_MAX_ATTEMPTS = 3
+PROXY_HEIGHT = 720
+POSTER_WIDTH = 480
+
+# Perceptual-hash bit distance at or below which two stills are near-duplicates
+NEAR_DUPLICATE_DISTANCE = 4
+
+# Image derivatives: longest edges of the pyramid rendered for every still
+# and video poster, and their encoding ("webp" or "jpeg")
+DERIVATIVE_SIZES = (200, 800, 2048)
+DERIVATIVE_FORMAT = os.environ.get("DERIVATIVE_FORMAT", "webp").lower()
+DERIVATIVE_QUALITY = 82
+
+# Display sizes (including high-DPI headroom) that pick a derivative level:
+# map markers (served at /thumbs/<id>), Quick View cards, gallery cards and
+# the story viewer
+MARKER_THUMB_SIZE = (120, 120)
+QUICK_VIEW_SIZE = (200, 150)
+GALLERY_THUMB_SIZE = (640, 480)
+VIEWER_IMAGE_SIZE = (1600, 1600)
+
+# All Stories gallery: cards rendered per page
+GALLERY_PAGE_SIZE = 12
+
+# Warm-up: the newest stories whose derivatives are rendered in the
+# background when the app starts
+WARMUP_THUMBNAILS = 200
+
+# JSON backend: journal entries appended before they are folded into a new snapshot
+JSON_JOURNAL_COMPACT_ENTRIES = 500
+
+# Flight statistics: altitude histogram bin width, and grid cell sizes in
+# degrees for ground coverage (~1 km) and for grouping flights by region (~50 km)
+ALTITUDE_BIN_M = 25
+COVERAGE_CELL_DEG = 0.01
+REGION_CELL_DEG = 0.5
+
+# Map tiles. With TILE_PROXY, base layers are fetched through the media
+# server's /tiles/ proxy and cached on disk so maps keep working offline once
+# an area is seeded. It defaults to on only when browsers can reach the media
+# server (MEDIA_BASE_URL); otherwise they load tiles from upstream directly.
+# TILE_UPSTREAM_DIR replaces the internet servers with a local XYZ tree laid
+# out as <dir>/<layer>/<z>/<x>/<y>.<ext>.
+TILE_SOURCES = {
+    'map': {
+        'name': 'Map',
+        'url': 'https://{s}.basemaps.cartocdn.com/rastertiles/voyager/{z}/{x}/{y}.png',
+        'subdomains': 'abcd',
+        'ext': 'png',
+        'attr': 'OpenStreetMap & CARTO',
+        'max_zoom': 19,
+    },
+    'satellite': {
+        'name': 'Satellite',
+        'url': 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        'ext': 'jpg',
+        'attr': 'Esri',
+        'max_zoom': 19,
+    },
+}
+TILE_PROXY = os.environ.get("TILE_PROXY", "1" if MEDIA_SERVER_PUBLIC else "0") != "0"
+TILE_UPSTREAM_DIR = os.environ.get("TILE_UPSTREAM_DIR")
+TILE_CACHE_DIR = os.path.join(UPLOAD_DIR, ".tiles")
+TILE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Survey orthomosaic: nadir stills (gimbal pitch at or below NADIR_PITCH_DEG)
+# or records with an explicit 'footprint' are tiled into an XYZ overlay
+ORTHO_DIR = os.path.join(UPLOAD_DIR, "ortho")
+ORTHO_MIN_ZOOM = 12
+ORTHO_MAX_ZOOM = 21
+ORTHO_WORKERS = 2
+NADIR_PITCH_DEG = -80
+# Horizontal field of view used to size a still's ground footprint from its altitude
+CAMERA_HFOV_DEG = 84
+
+# Flight tracks (SRT/CSV/GPX telemetry) are simplified per zoom so a vertex
+# is only sent when it moves the line by at least this many pixels
+TRACK_TOLERANCE_PX = 1.5
+# Decoded tracks kept in memory per process
+TRACK_CACHE_ENTRIES = 64
+
+# Instrumentation: reruns slower than this are logged with a per-stage
+# breakdown; the generated map HTML is measured on one map render in
+# METRICS_HTML_SAMPLE (rendering it again isn't free)
+METRICS_SLOW_RERUN_S = float(os.environ.get("METRICS_SLOW_RERUN_S", "2.0"))
+METRICS_HTML_SAMPLE = 20
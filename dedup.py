@@ -0,0 +1,188 @@
+"""Duplicate and near-duplicate detection for stored media
+
+Exact duplicates are handled at ingest by content addressing (see
+ingest.py). This module adds:
+
+- perceptual_hash(): a 64-bit difference hash (dHash) of a still, stable
+  under resizing and recompression
+- PerceptualIndex: multi-index hashing over those hashes. The 64 bits are
+  split into max_distance + 1 bands; by the pigeonhole principle any hash
+  within max_distance bits of a query matches it exactly in at least one
+  band, so a lookup only compares against the few hashes sharing a band
+- dedup_report() and migrate_to_blobs() for the archive as a whole
+"""
+import os
+
+from PIL import Image
+
+from config import BLOB_DIR, NEAR_DUPLICATE_DISTANCE
+from ingest import ingest_stream
+
+
+def perceptual_hash(filepath):
+    """64-bit dHash of an image as a 16-char hex string"""
+    with Image.open(filepath) as img:
+        img.draft('L', (64, 64))
+        small = img.convert('L').resize((9, 8), Image.Resampling.LANCZOS)
+        pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:016x}"
+
+
+def hamming(a, b):
+    """Bit distance between two hex hashes"""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+class PerceptualIndex:
+    """Near-duplicate lookup of perceptual hashes by id"""
+
+    def __init__(self, max_distance=NEAR_DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        n_bands = max_distance + 1
+        width, extra = divmod(64, n_bands)
+        self._bands = []
+        shift = 64
+        for i in range(n_bands):
+            bits = width + (1 if i < extra else 0)
+            shift -= bits
+            self._bands.append((shift, (1 << bits) - 1))
+        self._tables = [{} for _ in self._bands]
+        self._hashes = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def hashes(self):
+        """(id, hex hash) pairs"""
+        return [(item_id, f"{value:016x}") for item_id, value in self._hashes.items()]
+
+    def _keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self._bands]
+
+    def add(self, item_id, phash):
+        self.remove(item_id)
+        value = int(phash, 16)
+        self._hashes[item_id] = value
+        for table, key in zip(self._tables, self._keys(value)):
+            table.setdefault(key, set()).add(item_id)
+
+    def remove(self, item_id):
+        value = self._hashes.pop(item_id, None)
+        if value is None:
+            return
+        for table, key in zip(self._tables, self._keys(value)):
+            table[key].discard(item_id)
+            if not table[key]:
+                del table[key]
+
+    def find(self, phash, exclude=None):
+        """[(id, distance)] of stored hashes within max_distance, nearest first"""
+        value = int(phash, 16)
+        candidates = set()
+        for table, key in zip(self._tables, self._keys(value)):
+            candidates |= table.get(key, set())
+        candidates.discard(exclude)
+        matches = []
+        for item_id in candidates:
+            distance = bin(value ^ self._hashes[item_id]).count('1')
+            if distance <= self.max_distance:
+                matches.append((item_id, distance))
+        return sorted(matches, key=lambda m: (m[1], m[0]))
+
+    @classmethod
+    def from_store(cls, store, max_distance=NEAR_DUPLICATE_DISTANCE):
+        index = cls(max_distance)
+        for item in store.query(types=['image']):
+            if item.get('phash'):
+                index.add(item['id'], item['phash'])
+        return index
+
+
+def dedup_report(store):
+    """Unique files, references and bytes saved by sharing stored files"""
+    refs = {}
+    for item in store.all():
+        filepath = item.get('filepath')
+        if filepath:
+            refs[filepath] = refs.get(filepath, 0) + 1
+    reclaimed = 0
+    for filepath, count in refs.items():
+        if count > 1 and os.path.exists(filepath):
+            reclaimed += os.path.getsize(filepath) * (count - 1)
+    return {
+        'unique_files': len(refs),
+        'references': sum(refs.values()),
+        'shared_files': sum(1 for c in refs.values() if c > 1),
+        'reclaimed_bytes': reclaimed,
+    }
+
+
+def near_duplicate_groups(store, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """Groups of image ids whose perceptual hashes are within max_distance"""
+    index = PerceptualIndex.from_store(store, max_distance)
+    seen, groups = set(), []
+    for item_id, phash in sorted(index.hashes()):
+        if item_id in seen:
+            continue
+        group = [item_id] + [other for other, _ in index.find(phash, exclude=item_id) if other not in seen]
+        if len(group) > 1:
+            seen.update(group)
+            groups.append(group)
+    return groups
+
+
+def migrate_to_blobs(store):
+    """Move legacy uuid-named uploads into content-addressed storage
+
+    Records are repointed at their blob, perceptual hashes are filled in for
+    stills, and the old copies are deleted once every record that used them
+    has been updated; a copy whose record fails to update is kept. Returns
+    bytes reclaimed.
+    """
+    reclaimed = 0
+    blob_root = os.path.realpath(BLOB_DIR)
+    moved = {}
+    kept = set()
+    for item in store.all():
+        filepath = item.get('filepath')
+        if not filepath:
+            continue
+        fields = {}
+        source = os.path.realpath(filepath)
+        if source in moved:
+            # Another record referenced the same legacy file
+            result = moved[source]
+            fields.update(filepath=result.path, sha256=result.sha256)
+        elif not os.path.exists(filepath):
+            continue
+        elif not source.startswith(blob_root + os.sep):
+            ext = filepath.rsplit('.', 1)[-1].lower()
+            with open(filepath, 'rb') as f:
+                result = ingest_stream(f, ext)
+            moved[source] = result
+            fields.update(filepath=result.path, sha256=result.sha256)
+        if item['type'] == 'image' and not item.get('phash'):
+            try:
+                fields['phash'] = perceptual_hash(fields.get('filepath', filepath))
+            except Exception as e:
+                print(f"Error hashing {filepath}: {e}")
+        if fields:
+            try:
+                store.update(item['id'], **fields)
+            except Exception as e:
+                print(f"Error updating record {item['id']}: {e}")
+                kept.add(source)
+    # Only now is no record left pointing at a legacy file
+    for source, result in moved.items():
+        if source in kept:
+            continue
+        os.remove(source)
+        if result.duplicate:
+            reclaimed += result.size
+    return reclaimed
@@ -0,0 +1,275 @@
+"""Geographic helpers: geohash spatial keys and an in-memory grid index"""
+import math
+import threading
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Precision 6 cells are roughly 1.2km x 0.6km
+GEOHASH_PRECISION = 6
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    """Encode a lat/lon pair as a geohash string"""
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid:
+                bits = (bits << 1) | 1
+                lon_lo = mid
+            else:
+                bits <<= 1
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                bits = (bits << 1) | 1
+                lat_lo = mid
+            else:
+                bits <<= 1
+                lat_hi = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+class SpatialIndex:
+    """Uniform lat/lon grid index of point ids
+
+    Each point lands in one cell of `cell_deg` degrees; a bounding box query
+    visits only the cells it overlaps (or the occupied cells, whichever is
+    fewer) and filters their points exactly.
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell_deg = cell_deg
+        self._cells = {}
+        self._points = {}
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    def insert(self, item_id, lat, lon, payload=None):
+        """Add or move a point; payload is returned alongside it by queries"""
+        if item_id in self._points:
+            self.remove(item_id)
+        self._points[item_id] = (lat, lon, payload)
+        self._cells.setdefault(self._cell(lat, lon), set()).add(item_id)
+
+    def remove(self, item_id):
+        point = self._points.pop(item_id, None)
+        if point is None:
+            return
+        cell = self._cell(point[0], point[1])
+        ids = self._cells.get(cell)
+        if ids is not None:
+            ids.discard(item_id)
+            if not ids:
+                del self._cells[cell]
+
+    def get(self, item_id):
+        return self._points.get(item_id)
+
+    def query_bbox(self, south, west, north, east):
+        """Return [(id, lat, lon, payload)] inside the box (west > east wraps the antimeridian)"""
+        if west > east:
+            return self.query_bbox(south, west, north, 180.0) + self.query_bbox(south, -180.0, north, east)
+        lat0, lon0 = self._cell(south, west)
+        lat1, lon1 = self._cell(north, east)
+        n_cells = (lat1 - lat0 + 1) * (lon1 - lon0 + 1)
+        if n_cells <= len(self._cells):
+            cells = ((a, b) for a in range(lat0, lat1 + 1) for b in range(lon0, lon1 + 1))
+        else:
+            cells = (c for c in self._cells if lat0 <= c[0] <= lat1 and lon0 <= c[1] <= lon1)
+        results = []
+        for cell in cells:
+            for item_id in self._cells.get(cell, ()):
+                lat, lon, payload = self._points[item_id]
+                if south <= lat <= north and west <= lon <= east:
+                    results.append((item_id, lat, lon, payload))
+        return results
+
+
+class StoreSpatialIndex:
+    """An in-memory point index kept in step with a media store
+
+    `factory` builds an empty index exposing insert(id, lat, lon, payload)
+    and remove(id); SpatialIndex by default. Writes made through the same
+    store object are applied incrementally via its change listeners; writes
+    from other processes are picked up by comparing the store version and
+    rebuilding.
+    """
+
+    def __init__(self, store, factory=SpatialIndex):
+        self.store = store
+        self.factory = factory
+        self._lock = threading.Lock()
+        self.rebuild()
+        store.subscribe(self._on_change)
+
+    def rebuild(self):
+        with self._lock:
+            index = self.factory()
+            self.version = self.store.version()
+            for item_id, lat, lon, item_type in self.store.points():
+                index.insert(item_id, lat, lon, item_type)
+            self.index = index
+
+    def _on_change(self, event, items, version):
+        with self._lock:
+            if version != self.version + 1:
+                stale = True
+            else:
+                stale = False
+                for item in items:
+                    if event == 'delete':
+                        self.index.remove(item['id'])
+                    else:
+                        self.index.insert(item['id'], item['lat'], item['lon'], item['type'])
+                self.version = version
+        if stale:
+            self.rebuild()
+
+    def current(self):
+        """The underlying index, rebuilt first if another process wrote"""
+        if self.store.version() != self.version:
+            self.rebuild()
+        return self.index
+
+    def query_bbox(self, south, west, north, east):
+        return self.current().query_bbox(south, west, north, east)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def mercator_xy(lat, lon):
+    """Project lat/lon to normalized Web Mercator x, y in [0, 1)"""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def mercator_latlon(x, y):
+    """Inverse of mercator_xy: normalized Web Mercator x, y to lat/lon"""
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return lat, x * 360.0 - 180.0
+
+
+def tiles_in_bbox(south, west, north, east, zoom):
+    """(x, y) of every XYZ tile at zoom intersecting the box"""
+    n = 2 ** zoom
+    x0, y0 = mercator_xy(north, west)
+    x1, y1 = mercator_xy(south, east)
+    xs = range(min(int(x0 * n), n - 1), min(int(x1 * n), n - 1) + 1)
+    ys = range(min(int(y0 * n), n - 1), min(int(y1 * n), n - 1) + 1)
+    return [(x, y) for x in xs for y in ys]
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(lat, lon, radius_km):
+    """(south, west, north, east) enclosing a circle; west > east when it crosses the antimeridian"""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south, north = lat - dlat, lat + dlat
+    if south <= -90.0 or north >= 90.0:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+    dlon = math.degrees(radius_km / (EARTH_RADIUS_KM * math.cos(math.radians(lat))))
+    if dlon >= 180.0:
+        return south, -180.0, north, 180.0
+    west, east = lon - dlon, lon + dlon
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return south, west, north, east
+
+
+def split_antimeridian(box):
+    """A box as one or two boxes that don't cross the antimeridian"""
+    south, west, north, east = box
+    if west <= east:
+        return [box]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def polygon_bbox(polygon):
+    """(south, west, north, east) of a [(lat, lon), ...] ring"""
+    lats = [p[0] for p in polygon]
+    lons = [p[1] for p in polygon]
+    return min(lats), min(lons), max(lats), max(lons)
+
+
+def point_in_polygon(lat, lon, polygon):
+    """Whether a point lies inside a [(lat, lon), ...] ring (even-odd rule)"""
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat):
+            crossing = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if lon < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+
+def degrees_per_pixel(zoom):
+    """Longitude degrees covered by one pixel of a Web Mercator map at zoom"""
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def estimate_bounds(lat, lon, zoom, width_px=1200, height_px=600):
+    """Approximate (south, west, north, east) visible around a map center"""
+    dlon = degrees_per_pixel(zoom) * width_px / 2
+    dlat = degrees_per_pixel(zoom) * height_px / 2 * math.cos(math.radians(lat))
+    return max(lat - dlat, -90.0), lon - dlon, min(lat + dlat, 90.0), lon + dlon
+
+
+def expand_bounds(bounds, padding=0.25):
+    """Grow a box by a fraction of its size and snap it outward to a coarse grid
+
+    Snapping means small pans produce the same box, so the marker layer built
+    from it doesn't change and isn't re-sent to the browser.
+    """
+    south, west, north, east = bounds
+    step = max(north - south, east - west, 1e-6) * padding
+    south = math.floor((south - step) / step) * step
+    north = math.ceil((north + step) / step) * step
+    west = math.floor((west - step) / step) * step
+    east = math.ceil((east + step) / step) * step
+    return max(south, -90.0), max(west, -180.0), min(north, 90.0), min(east, 180.0)
+
+
+def bounds_from_leaflet(bounds):
+    """Convert st_folium's {'_southWest': .., '_northEast': ..} to a tuple"""
+    try:
+        sw, ne = bounds['_southWest'], bounds['_northEast']
+        return sw['lat'], sw['lng'], ne['lat'], ne['lng']
+    except (KeyError, TypeError):
+        return None
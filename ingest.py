@@ -0,0 +1,100 @@
+"""Streaming, content-addressed ingest of uploaded media
+
+Uploads are copied to disk in fixed-size chunks while a SHA-256 checksum is
+computed over the same bytes, so peak memory is one chunk regardless of file
+size. Data lands in a temp file and is renamed into place only once it is
+complete and fsynced, so readers never see a partial file. A semaphore caps
+how many ingests run at once.
+
+Files are stored by content hash under BLOB_DIR
+(blobs/<first two hex chars>/<sha256>.<ext>). Uploading bytes that are
+already stored discards the new copy and returns the existing blob with
+duplicate=True, so every record referencing the same content shares one
+file.
+"""
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+from collections import namedtuple
+
+from config import BLOB_DIR, INGEST_CHUNK_SIZE, MAX_CONCURRENT_INGESTS
+
+IngestResult = namedtuple('IngestResult', ['path', 'sha256', 'size', 'duplicate'])
+
+_ingest_slots = threading.BoundedSemaphore(MAX_CONCURRENT_INGESTS)
+
+
+def copy_stream(src, dst, chunk_size=INGEST_CHUNK_SIZE):
+    """Copy a file-like object in chunks; returns (sha256 hex, bytes copied)"""
+    h = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        h.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+    return h.hexdigest(), size
+
+
+def _stream_to_temp(src, dest_dir, chunk_size):
+    """Stream src into a fsynced temp file in dest_dir; returns (tmp path, sha256, size)"""
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.ingest-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            digest, size = copy_stream(src, dst, chunk_size)
+            dst.flush()
+            os.fsync(dst.fileno())
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    return tmp_path, digest, size
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def write_atomic(src, dest_path, chunk_size=INGEST_CHUNK_SIZE):
+    """Stream src into dest_path via a temp file and rename; returns IngestResult"""
+    tmp_path, digest, size = _stream_to_temp(src, os.path.dirname(dest_path) or '.', chunk_size)
+    try:
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    return IngestResult(dest_path, digest, size, False)
+
+
+def blob_path(digest, ext, root=BLOB_DIR):
+    """Content-addressed location for a file"""
+    return os.path.join(root, digest[:2], f"{digest}.{ext}")
+
+
+def find_blob(digest, root=BLOB_DIR):
+    """Path of an already stored blob with this digest (any extension), or None"""
+    matches = glob.glob(os.path.join(root, digest[:2], f"{digest}.*"))
+    return matches[0] if matches else None
+
+
+def ingest_stream(src, ext, dest_dir=BLOB_DIR, chunk_size=INGEST_CHUNK_SIZE):
+    """Store a stream by content hash, reusing an existing identical blob"""
+    if hasattr(src, 'seek'):
+        src.seek(0)
+    with _ingest_slots:
+        tmp_path, digest, size = _stream_to_temp(src, dest_dir, chunk_size)
+    existing = find_blob(digest, dest_dir)
+    if existing:
+        _remove_quietly(tmp_path)
+        return IngestResult(existing, digest, size, True)
+    path = blob_path(digest, ext, dest_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return IngestResult(path, digest, size, False)
@@ -1,5 +1,148 @@
-def main():
-    print("Hello from repl-nix-workspace!")
+"""Command-line tools for the drone media app
+
+    python main.py import PATH [--workers N] [--lat LAT --lon LON]
+    python main.py dedup [--migrate] [--near]
+    python main.py seed-tiles [--bbox S W N E] [--zoom 10-16] [--layer map satellite]
+    python main.py ortho [--rebuild] [--workers N]
+    python main.py track LOG... [--media ID...]
+"""
+import argparse
+import os
+import shutil
+import sys
+
+from bulk_import import bulk_import
+from config import ORTHO_DIR, TILE_SOURCES
+from dedup import dedup_report, migrate_to_blobs, near_duplicate_groups
+from orthomosaic import update_mosaic
+from storage import open_store
+from tiles import archive_bbox, count_tiles, seed_tiles, zoom_range
+from tracks import TrackStore, import_track
+
+# Refuse to seed more tiles than this without --force
+SEED_TILE_LIMIT = 50000
+
+
+def cmd_import(args):
+    default_location = None
+    if args.lat is not None and args.lon is not None:
+        default_location = (args.lat, args.lon)
+
+    def progress(done, total):
+        if done % 50 == 0 or done == total:
+            print(f"  {done}/{total} files processed", file=sys.stderr)
+
+    summary = bulk_import(args.path, open_store(), workers=args.workers,
+                          default_location=default_location, progress=progress)
+    for name, reason in summary['skipped']:
+        print(f"skipped {name}: {reason}")
+    print(f"Imported {summary['imported']} file(s), {summary['bytes'] / 1e6:.1f} MB "
+          f"in {summary['seconds']:.1f}s ({summary['files_per_second']:.1f} files/s)")
+    if summary['duplicates']:
+        print(f"{summary['duplicates']} duplicate(s) stored once, "
+              f"{summary['reclaimed_bytes'] / 1e6:.1f} MB reclaimed")
+
+
+def cmd_dedup(args):
+    store = open_store()
+    if args.migrate:
+        reclaimed = migrate_to_blobs(store)
+        print(f"Moved uploads into content-addressed storage, {reclaimed / 1e6:.1f} MB reclaimed")
+    report = dedup_report(store)
+    print(f"{report['references']} record(s) reference {report['unique_files']} stored file(s); "
+          f"{report['shared_files']} file(s) are shared, saving {report['reclaimed_bytes'] / 1e6:.1f} MB")
+    if args.near:
+        for group in near_duplicate_groups(store):
+            print("near-duplicates: " + ", ".join(f"#{item_id}" for item_id in group))
+
+
+def cmd_seed_tiles(args):
+    bbox = tuple(args.bbox) if args.bbox else archive_bbox(open_store().points())
+    if bbox is None:
+        sys.exit("No media to take a bounding box from; pass --bbox SOUTH WEST NORTH EAST")
+    zooms = zoom_range(args.zoom)
+    total = count_tiles(bbox, zooms) * len(args.layer)
+    if total > SEED_TILE_LIMIT and not args.force:
+        sys.exit(f"{total} tiles requested; narrow the box or zoom range, or pass --force")
+    print(f"Seeding {total} tile(s) for {', '.join(args.layer)} over "
+          f"{bbox[0]:.4f},{bbox[1]:.4f} to {bbox[2]:.4f},{bbox[3]:.4f}, zoom {zooms.start}-{zooms.stop - 1}")
+
+    def progress(done, total):
+        if done % 500 == 0 or done == total:
+            print(f"  {done}/{total} tiles", file=sys.stderr)
+
+    summary = seed_tiles(bbox, zooms, args.layer, workers=args.workers, progress=progress)
+    print(f"{summary['fetched']} fetched, {summary['cached']} already cached, {summary['failed']} failed")
+
+
+def cmd_ortho(args):
+    if args.rebuild:
+        shutil.rmtree(ORTHO_DIR, ignore_errors=True)
+
+    def progress(done, total):
+        if done % 500 == 0 or done == total:
+            print(f"  {done}/{total} tiles", file=sys.stderr)
+
+    summary = update_mosaic(open_store(), workers=args.workers, progress=progress)
+    print(f"{summary['images']} still(s) on the mosaic, {summary['changed']} changed; "
+          f"rendered {summary['tiles']} tile(s) in {summary['seconds']:.1f}s")
+
+
+def cmd_track(args):
+    store, tracks = open_store(), TrackStore()
+    for path in args.paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        try:
+            track_id = import_track(path, text, store, tracks, media_ids=args.media)
+        except ValueError as e:
+            print(f"skipped {path}: {e}")
+            continue
+        track = tracks.get(track_id)
+        print(f"Track #{track_id} {track['name']}: {track['point_count']} point(s), "
+              f"{track['duration_s'] / 60:.1f} min, linked to {len(track['media_ids'])} media item(s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drone media mapping tools")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('import', help="bulk import a folder or ZIP archive of media")
+    p.add_argument('path', help="folder or .zip file")
+    p.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    p.add_argument('--lat', type=float, help="latitude for files without GPS")
+    p.add_argument('--lon', type=float, help="longitude for files without GPS")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser('dedup', help="report duplicate media and space reclaimed")
+    p.add_argument('--migrate', action='store_true',
+                   help="move legacy uploads into content-addressed storage first")
+    p.add_argument('--near', action='store_true', help="also list near-duplicate stills")
+    p.set_defaults(func=cmd_dedup)
+
+    p = sub.add_parser('seed-tiles', help="pre-fetch base map tiles into the offline cache")
+    p.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'),
+                   help="area to cover (default: around all media)")
+    p.add_argument('--zoom', default='10-16', help="zoom level or range, e.g. 12 or 10-16")
+    p.add_argument('--layer', nargs='+', choices=sorted(TILE_SOURCES), default=sorted(TILE_SOURCES),
+                   help="base layers to seed")
+    p.add_argument('--workers', type=int, default=8, help="parallel downloads")
+    p.add_argument('--force', action='store_true', help=f"allow more than {SEED_TILE_LIMIT} tiles")
+    p.set_defaults(func=cmd_seed_tiles)
+
+    p = sub.add_parser('ortho', help="update the survey orthomosaic tiles")
+    p.add_argument('--rebuild', action='store_true', help="discard existing tiles and re-tile everything")
+    p.add_argument('--workers', type=int, default=os.cpu_count(), help="worker processes")
+    p.set_defaults(func=cmd_ortho)
+
+    p = sub.add_parser('track', help="import flight logs (DJI .srt, .csv or .gpx) as map tracks")
+    p.add_argument('paths', nargs='+', metavar='LOG', help="telemetry files")
+    p.add_argument('--media', type=int, nargs='*', default=None,
+                   help="media ids to link (default: media captured during the flight)")
+    p.set_defaults(func=cmd_track)
+
+    args = parser.parse_args(argv)
+    args.func(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,121 @@
+"""Compact map markers
+
+Markers used to be one folium DivIcon each, carrying several hundred bytes
+of inline-styled HTML, a click <script> and, for stills, a base64 JPEG of
+8-15 KB. Now the look of every marker kind is defined once, as CSS classes
+in the map header (add_marker_styles), and the marker layer carries a
+single MarkerPayload: a JSON array of [id, lat, lon, ...] rows that a small
+script turns into Leaflet markers with shared icon templates, one click
+handler and text tooltips. Thumbnails are referenced by URL
+(/thumbs/<id>?v=<mtime>, see thumbnails.thumbnail_handler), so the
+browser fetches each once and caches it. When browsers can't fetch
+/thumbs/ a row carries its thumbnail as a data: URI instead.
+
+Payload: {'u': thumbnail URL prefix,
+          's': [[id, lat, lon, is_video, thumbnail version / data: URI / 0, title], ...],
+          'c': [[lat, lon, count, photos, videos], ...]}
+"""
+import json
+
+from branca.element import Element, MacroElement
+from jinja2 import Template
+
+# Camera glyph for stills without a thumbnail
+_CAMERA_SVG = (
+    "data:image/svg+xml,%3Csvg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 24 24' fill='white'%3E"
+    "%3Ccircle cx='12' cy='12' r='3'/%3E%3Cpath d='M9 2L7.17 4H4c-1.1 0-2 .9-2 2v12c0 1.1.9 2 2 2h16c1.1 0 "
+    "2-.9 2-2V6c0-1.1-.9-2-2-2h-3.17L15 2H9zm3 15c-2.76 0-5-2.24-5-5s2.24-5 5-5 5 2.24 5 5-2.24 5-5 5z'/%3E%3C/svg%3E"
+)
+
+MARKER_CSS = f"""<style>
+.sm-marker {{ box-sizing: border-box; border-radius: 50%; cursor: pointer; }}
+.sm-marker > i {{ display: flex; align-items: center; justify-content: center; box-sizing: border-box;
+  width: 100%; height: 100%; border-radius: 50%; border: 2px solid white; font-style: normal;
+  background-size: cover; background-position: center; }}
+.sm-image {{ background: linear-gradient(135deg, #00C853 0%, #69F0AE 100%); border: 3px solid white;
+  box-shadow: 0 4px 12px rgba(0, 200, 83, 0.4); }}
+.sm-image > i {{ border: none; background: url("{_CAMERA_SVG}") center / 24px no-repeat; }}
+.sm-image.sm-thumb {{ padding: 3px; border: none; box-shadow: 0 4px 15px rgba(0,0,0,0.3);
+  background: linear-gradient(135deg, #FFFC00 0%, #FF6B6B 50%, #4ECDC4 100%); }}
+.sm-image.sm-thumb > i {{ border: 2px solid white; background-size: cover; background-position: center; }}
+.sm-video {{ padding: 3px; background: linear-gradient(135deg, #FF6D00 0%, #FFAB40 100%);
+  box-shadow: 0 4px 15px rgba(255, 109, 0, 0.5); }}
+.sm-video > i {{ background-color: #16213e; }}
+.sm-video > i::after {{ content: ''; width: 0; height: 0; margin-left: 4px; border-left: 14px solid white;
+  border-top: 9px solid transparent; border-bottom: 9px solid transparent;
+  filter: drop-shadow(0 0 3px rgba(0,0,0,0.6)); }}
+.sm-cluster {{ padding: 3px; box-shadow: 0 4px 15px rgba(0,0,0,0.3);
+  background: linear-gradient(135deg, #FFFC00 0%, #FF6B6B 50%, #4ECDC4 100%); }}
+.sm-cluster > i {{ flex-direction: column; background: #000; color: white; font-family: sans-serif;
+  line-height: 1.1; }}
+.sm-cluster b {{ font-weight: 800; font-size: 15px; }}
+.sm-cluster small {{ font-size: 9px; opacity: 0.85; }}
+</style>"""
+
+
+def add_marker_styles(m):
+    """Define the marker classes once, in the map's header"""
+    m.get_root().header.add_child(Element(MARKER_CSS), name='marker_styles')
+
+
+def story_row(item, thumb_version):
+    """Payload row for one story
+
+    thumb_version is the thumbnail's version, a data: URI to inline it, or 0
+    when the story has no thumbnail.
+    """
+    return [item['id'], round(item['lat'], 6), round(item['lon'], 6), int(item['type'] == 'video'),
+            thumb_version, item['title'][:60]]
+
+
+def cluster_row(cluster):
+    """Payload row for a cluster of stories"""
+    return [round(cluster.lat, 6), round(cluster.lon, 6), cluster.count,
+            cluster.types.get('image', 0), cluster.types.get('video', 0)]
+
+
+class MarkerPayload(MacroElement):
+    """Builds the markers of a payload in the browser, inside its parent layer"""
+
+    _template = Template("""
+{% macro script(this, kwargs) %}
+(function(layer, data) {
+    function tip(text) {
+        var span = document.createElement('span');
+        span.textContent = text;
+        return span;
+    }
+    data.s.forEach(function(s) {
+        var size = s[4] ? 60 : (s[3] ? 56 : 52);
+        var thumb = typeof s[4] === 'string' ? s[4] : data.u + s[0] + '?v=' + s[4];
+        var inner = s[4] ? '<i style="background-image:url(' + thumb + ')"></i>' : '<i></i>';
+        var icon = L.divIcon({
+            className: 'sm-marker ' + (s[3] ? 'sm-video' : 'sm-image') + (s[4] ? ' sm-thumb' : ''),
+            html: inner, iconSize: [size, size]
+        });
+        L.marker([s[1], s[2]], {icon: icon})
+            .bindTooltip(tip('👆 Click to view: ' + s[5]))
+            .on('click', function() {
+                window.parent.postMessage({type: 'marker_clicked', story_id: s[0]}, '*');
+            })
+            .addTo(layer);
+    });
+    data.c.forEach(function(c) {
+        var size = Math.floor(Math.min(44 + 10 * Math.log10(c[2]), 80));
+        var icon = L.divIcon({
+            className: 'sm-marker sm-cluster', iconSize: [size, size],
+            html: '<i><b>' + c[2] + '</b><small>📷' + c[3] + ' 🎬' + c[4] + '</small></i>'
+        });
+        L.marker([c[0], c[1]], {icon: icon})
+            .bindTooltip(tip(c[2] + ' stories here, zoom in to see them'))
+            .addTo(layer);
+    });
+})({{ this._parent.get_name() }}, {{ this.data }});
+{% endmacro %}
+""")
+
+    def __init__(self, payload):
+        super().__init__()
+        self._name = 'MarkerPayload'
+        # '</' can't end a <script> the payload may be embedded in
+        self.data = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
@@ -0,0 +1,210 @@
+"""Local HTTP server for media files, with byte-range support
+
+Streamlit ships media to the browser over its websocket, which means reading
+the whole file into Python first. Instead the app runs this small threaded
+server alongside Streamlit and points <video> elements at it. It honours
+`Range: bytes=...` requests, so players can seek and begin playback after
+the first chunk, and it streams from disk in fixed-size chunks.
+
+Routes are registered by path prefix with register_route(); the app
+registers media_handler() at /files/, which only serves files a media record
+references. The server binds MEDIA_SERVER_HOST (loopback by default) and
+browsers are only pointed at it when MEDIA_BASE_URL is configured
+(MEDIA_SERVER_PUBLIC); otherwise server.py serves the same paths on the app's
+own port (see routes.py), and plain `streamlit run app.py` falls back to
+Streamlit.
+"""
+import mimetypes
+import os
+import re
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit
+
+from config import MEDIA_BASE_URL, MEDIA_SERVER_HOST, MEDIA_SERVER_PORT, UPLOAD_DIR
+
+CHUNK_SIZE = 256 * 1024
+# Record fields whose files /files/ serves
+MEDIA_FIELDS = ('filepath', 'proxy_path', 'poster_path')
+
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+_routes = {}
+_app_routes = False
+_server = None
+_server_lock = threading.Lock()
+
+
+def mount_app_routes():
+    """Record that server.py serves /files/ and /thumbs/ on the app's own port"""
+    global _app_routes
+    _app_routes = True
+
+
+def app_routes():
+    """Whether browsers can fetch /files/ and /thumbs/ from the app's own origin"""
+    return _app_routes
+
+
+def register_route(prefix, handler):
+    """Serve GET requests under prefix with handler(request, subpath)"""
+    _routes[prefix] = handler
+
+
+def parse_range(header, size):
+    """Parse a single-range Range header into (start, end) inclusive, or None
+
+    Returns 'invalid' for an unsatisfiable range.
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return 'invalid'
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return 'invalid'
+    return start, min(end, size - 1)
+
+
+def send_file(request, path, content_type=None, cache_control='public, max-age=3600'):
+    """Send a file, honouring Range and streaming it in chunks"""
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        request.send_error(404)
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range == 'invalid':
+            request.send_response(416)
+            request.send_header('Content-Range', f'bytes */{size}')
+            request.end_headers()
+            return
+        if byte_range is None:
+            start, end = 0, size - 1
+            request.send_response(200)
+        else:
+            start, end = byte_range
+            request.send_response(206)
+            request.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        length = end - start + 1 if size else 0
+        request.send_header('Content-Type', content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        request.send_header('Content-Length', str(length))
+        request.send_header('Accept-Ranges', 'bytes')
+        request.send_header('Cache-Control', cache_control)
+        request.send_header('Access-Control-Allow-Origin', '*')
+        request.end_headers()
+        if request.command == 'HEAD':
+            return
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            try:
+                request.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # Players routinely abort a range request when seeking
+                return
+            remaining -= len(chunk)
+
+
+def upload_path(filepath):
+    """Real path of a file under UPLOAD_DIR, or None outside it or in a dot-directory"""
+    root = os.path.realpath(UPLOAD_DIR)
+    path = os.path.realpath(filepath)
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        return None
+    # Caches and indexes (.thumbs, .tiles) live in dot-directories
+    if any(part.startswith('.') for part in os.path.relpath(path, root).split(os.sep)):
+        return None
+    return path
+
+
+def record_file(store, item_id, name, fields=MEDIA_FIELDS):
+    """Path of the file named name that one of record item_id's fields points at, or None"""
+    item = store.get(item_id)
+    for field in fields:
+        if item and item.get(field) and os.path.basename(item[field]) == name:
+            return upload_path(item[field])
+    return None
+
+
+def media_handler(store, fields=MEDIA_FIELDS):
+    """Handler for /files/<id>/<name>: a file one of a record's fields points at"""
+    def handle(request, subpath):
+        item_id, _, name = subpath.partition('/')
+        path = record_file(store, int(item_id), name, fields) if item_id.isdigit() else None
+        if path is None:
+            request.send_error(404)
+            return
+        send_file(request, path)
+    return handle
+
+
+class MediaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path)
+        for prefix in sorted(_routes, key=len, reverse=True):
+            if path.startswith(prefix):
+                _routes[prefix](self, path[len(prefix):])
+                return
+        self.send_error(404)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_media_server(host=MEDIA_SERVER_HOST, port=MEDIA_SERVER_PORT):
+    """Start the server in a daemon thread; safe to call more than once
+
+    If the port is already taken (e.g. another app process started it)
+    that server is assumed to be serving the same files.
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), MediaRequestHandler)
+            except OSError as e:
+                print(f"Media server not started on {host}:{port}: {e}")
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name='media-server', daemon=True).start()
+        return _server
+
+
+def check_reachable(base_url=MEDIA_BASE_URL, timeout=2):
+    """Whether anything answers HTTP at base_url, as seen from this process"""
+    try:
+        urllib.request.urlopen(urllib.request.Request(f"{base_url}/healthz", method='HEAD'), timeout=timeout)
+    except urllib.error.HTTPError:
+        # Any HTTP response means the server is there
+        return True
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def media_url(item, field='filepath', base=MEDIA_BASE_URL):
+    """Browser-facing URL for the file in one of a record's fields"""
+    return f"{base}/files/{item['id']}/{quote(os.path.basename(item[field]))}"
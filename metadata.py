@@ -0,0 +1,178 @@
+"""GPS, altitude and capture-time extraction from image EXIF/XMP
+
+DJI stills carry position and capture time in EXIF and the flight-relative
+altitude in an XMP packet (drone-dji:RelativeAltitude). extract_metadata()
+merges both into the media record fields:
+
+    {'lat': .., 'lon': .., 'altitude': .., 'timestamp': 'YYYY-MM-DD HH:MM:SS'}
+
+plus the camera pose ('gimbal_pitch', 'yaw' in degrees) when the XMP has
+it; POSE_FIELDS are copied onto media records so nadir survey stills can be
+placed on the orthomosaic. Fields that can't be found are left out. extract_many() runs extraction
+over a batch of files in a process pool.
+"""
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'tif', 'tiff', 'webp', 'dng'}
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'm4v', 'avi', 'mkv'}
+
+# Camera pose fields extract_metadata() may return, kept on media records
+POSE_FIELDS = ('gimbal_pitch', 'yaw')
+
+# EXIF tag ids
+GPS_IFD = 0x8825
+EXIF_IFD = 0x8769
+TAG_DATETIME = 306
+TAG_DATETIME_ORIGINAL = 36867
+
+# The XMP packet sits near the start of the file; don't read past this
+XMP_SCAN_BYTES = 512 * 1024
+_XMP_RE = re.compile(rb'<x:xmpmeta.*?</x:xmpmeta>', re.DOTALL)
+
+
+def _ratio(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+
+def _dms_to_degrees(dms, ref):
+    try:
+        degrees = _ratio(dms[0]) + _ratio(dms[1]) / 60 + _ratio(dms[2]) / 3600
+    except (TypeError, IndexError):
+        return None
+    if ref in ('S', 'W', b'S', b'W'):
+        degrees = -degrees
+    return degrees
+
+
+def _normalize_timestamp(value):
+    """'2024:12:01 14:32:00' -> '2024-12-01 14:32:00'"""
+    if isinstance(value, bytes):
+        value = value.decode(errors='ignore')
+    if not value:
+        return None
+    value = value.strip().rstrip('\x00')
+    match = re.match(r'(\d{4})[:-](\d{2})[:-](\d{2})[ T](\d{2}):(\d{2}):(\d{2})', value)
+    if not match:
+        return None
+    return '{}-{}-{} {}:{}:{}'.format(*match.groups())
+
+
+def read_exif(filepath):
+    """Position, GPS altitude and capture time from EXIF"""
+    meta = {}
+    with Image.open(filepath) as img:
+        exif = img.getexif()
+        gps = exif.get_ifd(GPS_IFD)
+        if gps:
+            lat = _dms_to_degrees(gps.get(2), gps.get(1))
+            lon = _dms_to_degrees(gps.get(4), gps.get(3))
+            if lat is not None and lon is not None and not (lat == 0 and lon == 0):
+                meta['lat'], meta['lon'] = lat, lon
+            altitude = _ratio(gps.get(6))
+            if altitude is not None:
+                # GPSAltitudeRef 1 means below sea level
+                meta['gps_altitude'] = -altitude if gps.get(5) in (1, b'\x01') else altitude
+        timestamp = _normalize_timestamp(exif.get_ifd(EXIF_IFD).get(TAG_DATETIME_ORIGINAL)) or \
+            _normalize_timestamp(exif.get(TAG_DATETIME))
+        if timestamp:
+            meta['timestamp'] = timestamp
+    return meta
+
+
+def _xmp_value(packet, name):
+    """Value of an XMP property written either as an attribute or an element"""
+    match = re.search(rb'[\s:]' + name + rb'="([^"]*)"', packet) or \
+        re.search(rb'<[\w-]*:?' + name + rb'>([^<]*)<', packet)
+    return match.group(1).decode(errors='ignore').strip() if match else None
+
+
+def read_xmp(filepath):
+    """Drone fields from the XMP packet (DJI drone-dji namespace)"""
+    with open(filepath, 'rb') as f:
+        head = f.read(XMP_SCAN_BYTES)
+    match = _XMP_RE.search(head)
+    if not match:
+        return {}
+    packet = match.group(0)
+    meta = {}
+    relative = _ratio(_xmp_value(packet, rb'RelativeAltitude'))
+    if relative is not None:
+        meta['relative_altitude'] = relative
+    absolute = _ratio(_xmp_value(packet, rb'AbsoluteAltitude'))
+    if absolute is not None:
+        meta['absolute_altitude'] = absolute
+    lat = _ratio(_xmp_value(packet, rb'GpsLatitude'))
+    # Some DJI firmware spells it "Longtitude"
+    lon = _ratio(_xmp_value(packet, rb'GpsLongitude') or _xmp_value(packet, rb'GpsLongtitude'))
+    if lat is not None and lon is not None and not (lat == 0 and lon == 0):
+        meta['lat'], meta['lon'] = lat, lon
+    timestamp = _normalize_timestamp(_xmp_value(packet, rb'DateTimeOriginal') or _xmp_value(packet, rb'CreateDate'))
+    if timestamp:
+        meta['timestamp'] = timestamp
+    pitch = _ratio(_xmp_value(packet, rb'GimbalPitchDegree'))
+    if pitch is not None:
+        meta['gimbal_pitch'] = pitch
+    # Where the top of the frame points, clockwise from north
+    yaw = _ratio(_xmp_value(packet, rb'GimbalYawDegree') or _xmp_value(packet, rb'FlightYawDegree'))
+    if yaw is not None:
+        meta['yaw'] = yaw
+    return meta
+
+
+def extract_metadata(filepath):
+    """Record fields (lat, lon, altitude, timestamp) found in an image file"""
+    ext = filepath.rsplit('.', 1)[-1].lower()
+    if ext not in IMAGE_EXTENSIONS:
+        return {}
+    exif, xmp = {}, {}
+    try:
+        exif = read_exif(filepath)
+    except Exception as e:
+        print(f"Error reading EXIF from {filepath}: {e}")
+    try:
+        xmp = read_xmp(filepath)
+    except OSError as e:
+        print(f"Error reading XMP from {filepath}: {e}")
+
+    meta = {}
+    for source in (xmp, exif):
+        for key in ('lat', 'lon', 'timestamp'):
+            if key in source and key not in meta:
+                meta[key] = source[key]
+    # Height above the takeoff point is what the app shows as altitude;
+    # fall back to GPS (sea-level) altitude when the drone didn't record it
+    altitude = xmp.get('relative_altitude', exif.get('gps_altitude', xmp.get('absolute_altitude')))
+    if altitude is not None:
+        meta['altitude'] = round(altitude, 1)
+    for key in POSE_FIELDS:
+        if key in xmp:
+            meta[key] = xmp[key]
+    return meta
+
+
+def extract_many(filepaths, workers=None):
+    """{path: metadata} for many files, parsed in a process pool"""
+    filepaths = list(filepaths)
+    if len(filepaths) < 4:
+        return {path: extract_metadata(path) for path in filepaths}
+    # Spawned rather than forked: the app process runs other threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return dict(zip(filepaths, pool.map(extract_metadata, filepaths, chunksize=16)))
+
+
+def extract_folder(folder, workers=None):
+    """{path: metadata} for every image under a folder"""
+    paths = []
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.join(root, name))
+    return extract_many(paths, workers)
@@ -0,0 +1,198 @@
+"""Timers and counters for the app's hot paths
+
+Stages of a Streamlit rerun are wrapped in `with timer('stage'):`, or for
+long top-level sections of the script, closed with lap('stage'). Each
+observation goes into a process-wide histogram (Prometheus buckets, sum,
+count and max) and into the current rerun's breakdown, which the debug
+panel shows and which is logged when a rerun is slower than
+METRICS_SLOW_RERUN_S.
+
+Counters are bumped with count(), gauges set with gauge(), and other
+modules' own statistics (thumbnail and tile caches, the store's read cache)
+are pulled in at scrape time by collectors added with add_collector().
+server.py serves everything in Prometheus text format at /metrics on the
+app's port, and the media server at its own /metrics.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from config import METRICS_SLOW_RERUN_S
+from media_server import register_route
+
+PREFIX = 'dronemap_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_gauges = {}
+_collectors = []
+_local = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds):
+    """Record one duration for a stage"""
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+        timer['count'] += 1
+        timer['sum'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                timer['buckets'][i] += 1
+    run = getattr(_local, 'run', None)
+    if run is not None:
+        run.append((name, seconds))
+
+
+@contextmanager
+def timer(name):
+    """Time the enclosed block as stage `name`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def lap(name):
+    """Record the time since start_run() or the previous lap as stage `name`"""
+    start = getattr(_local, 'lap_start', None)
+    if start is None:
+        return
+    now = time.perf_counter()
+    observe(name, now - start)
+    _local.lap_start = now
+
+
+def count(name, n=1, **labels):
+    """Add n to a counter; returns its new value"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+        return _counters[key]
+
+
+def gauge(name, value, **labels):
+    """Set a gauge to its latest value"""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def add_collector(collect):
+    """Register collect() -> [(name, kind, labels, value)], called on every scrape
+
+    kind is 'counter' or 'gauge'.
+    """
+    _collectors.append(collect)
+
+
+def start_run():
+    """Begin collecting the stage breakdown of a rerun on this thread"""
+    _local.run = []
+    _local.run_start = _local.lap_start = time.perf_counter()
+
+
+def finish_run():
+    """End the rerun: record its total time and return [(stage, seconds)] plus the total
+
+    Slow reruns are logged with their breakdown.
+    """
+    run = getattr(_local, 'run', None)
+    if run is None:
+        return [], 0.0
+    total = time.perf_counter() - _local.run_start
+    _local.run = _local.lap_start = None
+    observe('rerun', total)
+    if total > METRICS_SLOW_RERUN_S:
+        stages = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in run)
+        print(f"Slow rerun: {total * 1000:.0f}ms ({stages})")
+    return run, total
+
+
+def timer_stats():
+    """{stage: {'count', 'sum', 'max', 'mean'}}"""
+    with _lock:
+        return {name: {'count': t['count'], 'sum': t['sum'], 'max': t['max'],
+                       'mean': t['sum'] / t['count'] if t['count'] else 0.0}
+                for name, t in _timers.items()}
+
+
+def samples():
+    """[(name, kind, labels, value)] for every counter, gauge and collected value
+
+    labels is a sorted tuple of (key, value) pairs.
+    """
+    with _lock:
+        found = [(name, 'counter', labels, value) for (name, labels), value in _counters.items()]
+        found += [(name, 'gauge', labels, value) for (name, labels), value in _gauges.items()]
+    for collect in _collectors:
+        try:
+            found += [(name, kind, tuple(sorted(labels.items())), value)
+                      for name, kind, labels, value in collect()]
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+    return sorted(found, key=lambda s: (s[0], s[2]))
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        timers = {name: dict(t, buckets=list(t['buckets'])) for name, t in _timers.items()}
+
+    if timers:
+        name = PREFIX + 'stage_seconds'
+        lines += [f'# HELP {name} Time spent in each stage of a rerun', f'# TYPE {name} histogram']
+        for stage, t in sorted(timers.items()):
+            labels = (('stage', stage),)
+            for bound, n in zip(BUCKETS, t['buckets']):
+                lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {n}')
+            lines.append(f'{name}_bucket{_labels(labels, [("le", "+Inf")])} {t["count"]}')
+            lines.append(f'{name}_sum{_labels(labels)} {t["sum"]:.6f}')
+            lines.append(f'{name}_count{_labels(labels)} {t["count"]}')
+        lines += [f'# TYPE {PREFIX}stage_max_seconds gauge']
+        lines += [f'{PREFIX}stage_max_seconds{_labels([("stage", stage)])} {t["max"]:.6f}'
+                  for stage, t in sorted(timers.items())]
+
+    typed = set()
+    for name, kind, labels, value in samples():
+        if name not in typed:
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+            typed.add(name)
+        lines.append(f'{PREFIX}{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(request, subpath):
+    """/metrics"""
+    if subpath:
+        request.send_error(404)
+        return
+    data = render_prometheus().encode()
+    request.send_response(200)
+    request.send_header('Content-Type', CONTENT_TYPE)
+    request.send_header('Content-Length', str(len(data)))
+    request.send_header('Cache-Control', 'no-cache')
+    request.end_headers()
+    if request.command != 'HEAD':
+        request.wfile.write(data)
+
+
+register_route('/metrics', serve_metrics)
@@ -0,0 +1,402 @@
+"""XYZ tile pyramid built from georeferenced survey stills
+
+A still is placed on the mosaic when its record has an explicit
+'footprint' (south, west, north, east) or when it was shot looking straight
+down (gimbal_pitch at or below NADIR_PITCH_DEG). For the latter the ground
+footprint is sized from altitude and CAMERA_HFOV_DEG and rotated by the
+camera yaw.
+
+update_mosaic() keeps a manifest of placed stills under ORTHO_DIR. Each run
+compares the requested records against it and re-renders only the tiles
+under footprints that appeared, moved or disappeared, from ORTHO_MIN_ZOOM
+down to each still's native resolution. Tiles are rendered in a process
+pool; each tile composites every overlapping still, oldest first and
+upsampled where the still is coarser than the zoom, so the result doesn't
+depend on which run drew it. Tiles are PNGs with transparency at
+ORTHO_DIR/<z>/<x>/<y>.png and are served by the media server at /ortho/
+(OrthoMosaic.serve_tile).
+
+A tile only exists at zooms where some still under it is native, while the
+map layer goes up to the finest still's zoom. serve_tile() answers for a
+missing tile by upscaling the matching part of the nearest lower-zoom tile,
+so coarse stills stay visible wherever finer ones extend the zoom range.
+
+OrthoMosaic runs update_mosaic() in a background thread whenever stills
+are added, changed or removed.
+"""
+import io
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from PIL import Image
+
+from config import (CAMERA_HFOV_DEG, MEDIA_BASE_URL, NADIR_PITCH_DEG, ORTHO_DIR, ORTHO_MAX_ZOOM,
+                    ORTHO_MIN_ZOOM, ORTHO_WORKERS)
+from geo import mercator_latlon, tiles_in_bbox
+from media_server import send_file
+
+TILE_SIZE = 256
+EARTH_CIRCUMFERENCE_M = 40075016.686
+M_PER_DEG = EARTH_CIRCUMFERENCE_M / 360
+# Seconds to wait for a burst of uploads to settle before re-tiling
+DEBOUNCE_SECONDS = 2
+
+
+def _manifest_path(root):
+    return os.path.join(root, 'manifest.json')
+
+
+def load_manifest(root=ORTHO_DIR):
+    try:
+        with open(_manifest_path(root)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'version': 0, 'images': {}}
+
+
+def _save_manifest(manifest, root):
+    os.makedirs(root, exist_ok=True)
+    tmp = f"{_manifest_path(root)}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, _manifest_path(root))
+
+
+def native_zoom(lat, gsd):
+    """Zoom whose ground resolution at lat is closest to gsd metres/pixel"""
+    return round(math.log2(EARTH_CIRCUMFERENCE_M * math.cos(math.radians(lat)) / (TILE_SIZE * gsd)))
+
+
+def survey_entry(item):
+    """Manifest entry placing a still on the mosaic, or None if it can't be placed"""
+    filepath = item.get('filepath')
+    if item.get('type') != 'image' or not filepath or not os.path.exists(filepath):
+        return None
+    footprint = item.get('footprint')
+    pitch = item.get('gimbal_pitch')
+    altitude = item.get('altitude') or 0
+    if not footprint and (pitch is None or pitch > NADIR_PITCH_DEG or altitude <= 0):
+        return None
+    try:
+        with Image.open(filepath) as img:
+            width, height = img.size
+    except Exception as e:
+        print(f"Error reading {filepath}: {e}")
+        return None
+
+    if footprint:
+        south, west, north, east = footprint
+        lat, lon, yaw = (south + north) / 2, (west + east) / 2, 0.0
+        gsd_x = (east - west) * M_PER_DEG * math.cos(math.radians(lat)) / width
+        gsd_y = (north - south) * M_PER_DEG / height
+    else:
+        lat, lon, yaw = item['lat'], item['lon'], float(item.get('yaw') or 0)
+        gsd_x = gsd_y = 2 * altitude * math.tan(math.radians(CAMERA_HFOV_DEG) / 2) / width
+    entry = {
+        'id': item['id'], 'filepath': filepath, 'mtime': os.path.getmtime(filepath),
+        'timestamp': item.get('timestamp', ''), 'width': width, 'height': height,
+        'lat': lat, 'lon': lon, 'yaw': yaw, 'gsd_x': gsd_x, 'gsd_y': gsd_y,
+    }
+    # Bounding box of the (possibly rotated) frame
+    corners = [_ground_point(entry, u, v) for u in (0, width) for v in (0, height)]
+    lats = [c[0] for c in corners]
+    lons = [c[1] for c in corners]
+    entry['bbox'] = [min(lats), min(lons), max(lats), max(lons)]
+    entry['max_zoom'] = min(max(native_zoom(lat, min(gsd_x, gsd_y)), ORTHO_MIN_ZOOM), ORTHO_MAX_ZOOM)
+    return entry
+
+
+def _ground_point(entry, u, v):
+    """lat/lon of image pixel (u, v)"""
+    yaw = math.radians(entry['yaw'])
+    right = (u - entry['width'] / 2) * entry['gsd_x']
+    up = (entry['height'] / 2 - v) * entry['gsd_y']
+    east = right * math.cos(yaw) + up * math.sin(yaw)
+    north = -right * math.sin(yaw) + up * math.cos(yaw)
+    lat = entry['lat'] + north / M_PER_DEG
+    lon = entry['lon'] + east / (M_PER_DEG * math.cos(math.radians(entry['lat'])))
+    return lat, lon
+
+
+def _image_point(entry, lat, lon):
+    """Image pixel (u, v) at lat/lon; the inverse of _ground_point"""
+    yaw = math.radians(entry['yaw'])
+    north = (lat - entry['lat']) * M_PER_DEG
+    east = (lon - entry['lon']) * M_PER_DEG * math.cos(math.radians(entry['lat']))
+    right = east * math.cos(yaw) - north * math.sin(yaw)
+    up = east * math.sin(yaw) + north * math.cos(yaw)
+    return entry['width'] / 2 + right / entry['gsd_x'], entry['height'] / 2 - up / entry['gsd_y']
+
+
+def _tile_corner(z, x, y):
+    n = 2 ** z
+    return mercator_latlon(x / n, y / n)
+
+
+def _overlaps(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+@lru_cache(maxsize=8)
+def _load_source(filepath, mtime, factor):
+    """Source image decoded at 1/factor scale as RGBA, kept for the next tiles"""
+    with Image.open(filepath) as img:
+        size = (max(img.width // factor, 1), max(img.height // factor, 1))
+        # draft() lets the JPEG decoder downscale while decoding
+        img.draft('RGB', size)
+        img = img.convert('RGBA')
+        if img.size != size:
+            img = img.resize(size, Image.Resampling.BILINEAR)
+    return img
+
+
+def render_tile(job):
+    """Worker: composite every overlapping still into one tile; returns its path or None"""
+    z, x, y, sources, path = job
+    tile = Image.new('RGBA', (TILE_SIZE, TILE_SIZE))
+    top_left, top_right, bottom_left = _tile_corner(z, x, y), _tile_corner(z, x + 1, y), _tile_corner(z, x, y + 1)
+    for entry in sources:
+        # Decode no finer than this zoom needs
+        tile_gsd = EARTH_CIRCUMFERENCE_M * math.cos(math.radians(entry['lat'])) / (TILE_SIZE * 2 ** z)
+        scale = tile_gsd / min(entry['gsd_x'], entry['gsd_y'])
+        factor = 1 << min(max(int(math.log2(scale)), 0), 5) if scale > 1 else 1
+        try:
+            img = _load_source(entry['filepath'], entry['mtime'], factor)
+        except Exception as e:
+            print(f"Error reading {entry['filepath']}: {e}")
+            continue
+        sx, sy = img.width / entry['width'], img.height / entry['height']
+        (u0, v0), (u1, v1), (u2, v2) = [_image_point(entry, *corner)
+                                        for corner in (top_left, top_right, bottom_left)]
+        # Tile pixels map to source pixels by an affine transform, close
+        # enough to exact over the small extent of one tile
+        data = (
+            (u1 - u0) * sx / TILE_SIZE, (u2 - u0) * sx / TILE_SIZE, u0 * sx,
+            (v1 - v0) * sy / TILE_SIZE, (v2 - v0) * sy / TILE_SIZE, v0 * sy,
+        )
+        tile.alpha_composite(img.transform(tile.size, Image.Transform.AFFINE, data, Image.Resampling.BILINEAR))
+
+    if tile.getbbox() is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tile-', suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        tile.save(f, format='PNG', optimize=False)
+    os.replace(tmp, path)
+    return path
+
+
+def tile_file(z, x, y, root=ORTHO_DIR):
+    return os.path.join(root, str(z), str(x), f"{y}.png")
+
+
+def update_mosaic(store, ids=None, root=ORTHO_DIR, workers=ORTHO_WORKERS, progress=None):
+    """Bring the tile pyramid in line with the store
+
+    ids limits the check to those records (e.g. just uploaded or deleted);
+    None checks every image. Returns {'images', 'changed', 'tiles', 'seconds'}.
+    """
+    start = time.perf_counter()
+    manifest = load_manifest(root)
+    images = manifest['images']
+    items = store.query(types=['image']) if ids is None else store.get_many(ids)
+    present = {str(item['id']) for item in items}
+    checked = set(images) if ids is None else {str(i) for i in ids}
+
+    changed = []
+    for item in items:
+        key = str(item['id'])
+        entry = survey_entry(item)
+        old = images.get(key)
+        if entry == old:
+            continue
+        if old:
+            changed.append(images.pop(key))
+        if entry:
+            images[key] = entry
+            changed.append(entry)
+    for key in checked - present:
+        if key in images:
+            changed.append(images.pop(key))
+
+    summary = {'images': len(images), 'changed': len(changed), 'tiles': 0, 'seconds': 0.0}
+    if not changed:
+        return summary
+
+    # Bucket stills by ORTHO_MIN_ZOOM tile so finding a tile's sources is cheap
+    buckets = {}
+    for entry in images.values():
+        for xy in tiles_in_bbox(*entry['bbox'], ORTHO_MIN_ZOOM):
+            buckets.setdefault(xy, []).append(entry)
+
+    # Every tile under a changed footprint, at each zoom that footprint is
+    # native, and where finer stills overlapping it are (it's drawn under them)
+    affected = set()
+    for entry in changed:
+        for z in range(ORTHO_MIN_ZOOM, entry['max_zoom'] + 1):
+            affected.update((z, x, y) for x, y in tiles_in_bbox(*entry['bbox'], z))
+        finer = {id(e): e for xy in tiles_in_bbox(*entry['bbox'], ORTHO_MIN_ZOOM) for e in buckets.get(xy, [])
+                 if e['max_zoom'] > entry['max_zoom'] and _overlaps(e['bbox'], entry['bbox'])}
+        for other in finer.values():
+            overlap = (max(entry['bbox'][0], other['bbox'][0]), max(entry['bbox'][1], other['bbox'][1]),
+                       min(entry['bbox'][2], other['bbox'][2]), min(entry['bbox'][3], other['bbox'][3]))
+            for z in range(entry['max_zoom'] + 1, other['max_zoom'] + 1):
+                affected.update((z, x, y) for x, y in tiles_in_bbox(*overlap, z))
+
+    jobs = []
+    for z, x, y in affected:
+        shift = z - ORTHO_MIN_ZOOM
+        top_left, bottom_right = _tile_corner(z, x, y), _tile_corner(z, x + 1, y + 1)
+        bounds = (bottom_right[0], top_left[1], top_left[0], bottom_right[1])
+        sources = sorted(
+            (e for e in buckets.get((x >> shift, y >> shift), []) if _overlaps(e['bbox'], bounds)),
+            key=lambda e: (e['timestamp'], e['id']))
+        if not any(z <= e['max_zoom'] for e in sources):
+            # No still is native here: serve_tile upscales a lower zoom instead
+            sources = []
+        jobs.append((z, x, y, sources, tile_file(z, x, y, root)))
+    # Tiles sharing a source land in the same worker chunk and reuse its decode
+    jobs.sort(key=lambda job: ([e['id'] for e in job[3]], job[0], job[1], job[2]))
+
+    if workers > 1 and len(jobs) >= 32:
+        # Spawned rather than forked: the app process runs other threads
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        results = pool.map(render_tile, jobs, chunksize=16)
+    else:
+        pool, results = None, map(render_tile, jobs)
+    try:
+        for done, _ in enumerate(results, 1):
+            if progress:
+                progress(done, len(jobs))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    manifest['version'] += 1
+    _save_manifest(manifest, root)
+    summary.update(tiles=len(jobs), seconds=time.perf_counter() - start)
+    return summary
+
+
+def upscaled_tile(z, x, y, root=ORTHO_DIR):
+    """PNG bytes of tile z/x/y cut from the nearest lower-zoom tile and upscaled, or None"""
+    for parent_z in range(z - 1, ORTHO_MIN_ZOOM - 1, -1):
+        shift = z - parent_z
+        path = tile_file(parent_z, x >> shift, y >> shift, root)
+        try:
+            with Image.open(path) as parent:
+                parent.load()
+        except FileNotFoundError:
+            continue
+        size = TILE_SIZE >> shift
+        if size == 0:
+            return None
+        left, top = (x % (1 << shift)) * size, (y % (1 << shift)) * size
+        tile = parent.crop((left, top, left + size, top + size)).resize(
+            (TILE_SIZE, TILE_SIZE), Image.Resampling.BILINEAR)
+        buffer = io.BytesIO()
+        tile.save(buffer, format='PNG')
+        return buffer.getvalue()
+    return None
+
+
+def mosaic_extent(manifest):
+    """(bbox, max_zoom) over all placed stills, or None"""
+    entries = list(manifest['images'].values())
+    if not entries:
+        return None
+    bbox = (min(e['bbox'][0] for e in entries), min(e['bbox'][1] for e in entries),
+            max(e['bbox'][2] for e in entries), max(e['bbox'][3] for e in entries))
+    return bbox, max(e['max_zoom'] for e in entries)
+
+
+class OrthoMosaic:
+    """Re-tiles the mosaic in the background as survey stills come and go"""
+
+    def __init__(self, store, root=ORTHO_DIR, workers=ORTHO_WORKERS):
+        self.store = store
+        self.root = root
+        self.workers = workers
+        self.manifest = load_manifest(root)
+        self.running = False
+        self._pending = None  # ids to check, or 'all'
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, name='orthomosaic', daemon=True).start()
+        store.subscribe(self._on_change)
+
+    def _on_change(self, event, items, version):
+        if event == 'delete':
+            self.refresh(item['id'] for item in items)
+        else:
+            self.refresh(item['id'] for item in items if item.get('type') == 'image')
+
+    def refresh(self, ids=None):
+        """Queue a re-check of some records, or of every image when ids is None"""
+        ids = None if ids is None else set(ids)
+        if ids == set():
+            return
+        with self._lock:
+            if ids is None or self._pending == 'all':
+                self._pending = 'all'
+            else:
+                self._pending = (self._pending or set()) | ids
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(DEBOUNCE_SECONDS)
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, None
+            if pending is None:
+                continue
+            self.running = True
+            try:
+                update_mosaic(self.store, None if pending == 'all' else pending, self.root, self.workers)
+            except Exception as e:
+                print(f"Orthomosaic update failed: {e}")
+            finally:
+                self.manifest = load_manifest(self.root)
+                self.running = False
+
+    def extent(self):
+        return mosaic_extent(self.manifest)
+
+    def tile_url(self):
+        """Leaflet URL template; the version busts browser caches after re-tiling"""
+        return f"{MEDIA_BASE_URL}/ortho/{{z}}/{{x}}/{{y}}.png?v={self.manifest['version']}"
+
+    def serve_tile(self, request, subpath):
+        """/ortho/<z>/<x>/<y>.png"""
+        try:
+            z, x, name = subpath.split('/')
+            z, x, y = int(z), int(x), int(name.split('.')[0])
+        except ValueError:
+            request.send_error(404)
+            return
+        path = tile_file(z, x, y, self.root)
+        if os.path.exists(path) or z > ORTHO_MAX_ZOOM:
+            send_file(request, path, 'image/png')
+            return
+        data = upscaled_tile(z, x, y, self.root)
+        if data is None:
+            request.send_error(404)
+            return
+        request.send_response(200)
+        request.send_header('Content-Type', 'image/png')
+        request.send_header('Content-Length', str(len(data)))
+        request.send_header('Cache-Control', 'public, max-age=3600')
+        request.end_headers()
+        if request.command != 'HEAD':
+            request.wfile.write(data)
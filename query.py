@@ -0,0 +1,305 @@
+"""Spatial and time-range search over the media archive
+
+ArchiveIndex keeps two in-memory indexes of every record, in step with the
+store the same way StoreSpatialIndex is:
+
+- a SpatialIndex grid of positions, for boxes, radii and polygons
+- the (timestamp, id) pairs in sorted order, for time ranges
+
+A search starts from whichever index narrows it most: the time slice
+(found by bisection, so its size is known up front) when it is small,
+otherwise the grid cells under the search area. Remaining conditions are
+checked only on those candidates, and results come back in capture order.
+
+The map, the gallery and the /api/media export are all driven by it.
+"""
+import bisect
+import json
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from geo import SpatialIndex, haversine_km, point_in_polygon, polygon_bbox, radius_bbox, split_antimeridian
+from media_server import media_url
+
+# Scan the time slice instead of the grid when it holds less than this
+# fraction of the archive
+TIME_SLICE_FRACTION = 0.1
+
+API_PAGE_SIZE = 500
+API_MAX_PAGE_SIZE = 5000
+EXPORT_FIELDS = ('id', 'type', 'title', 'description', 'lat', 'lon', 'timestamp', 'altitude',
+                 'gimbal_pitch', 'yaw')
+
+
+def _intersect(a, b):
+    """Intersection of two (south, west, north, east) boxes that don't wrap"""
+    if a is None:
+        return b
+    return max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+
+
+def _search_boxes(bbox=None, near=None, radius_km=None, polygon=None):
+    """Non-wrapping boxes covering the spatial conditions; None if there are none"""
+    boxes = None
+    for box in [bbox, radius_bbox(*near, radius_km) if near else None,
+                polygon_bbox(polygon) if polygon else None]:
+        if box is None:
+            continue
+        parts = split_antimeridian(box)
+        if boxes is None:
+            boxes = parts
+        else:
+            boxes = [_intersect(a, b) for a in boxes for b in parts]
+            boxes = [b for b in boxes if b[0] <= b[2] and b[1] <= b[3]]
+    return boxes
+
+
+class ArchiveIndex:
+    """Grid and timestamp indexes over a media store, kept current as records change"""
+
+    def __init__(self, store, cell_deg=0.05):
+        self.store = store
+        self.cell_deg = cell_deg
+        self._lock = threading.Lock()
+        self.rebuild()
+        store.subscribe(self._on_change)
+
+    def rebuild(self):
+        with self._lock:
+            self.version = self.store.version()
+            self.grid = SpatialIndex(self.cell_deg)
+            self._rows = {}
+            for row in self.store.columns():
+                self._insert(row)
+            self._timeline = sorted((row[4], item_id) for item_id, row in self._rows.items())
+
+    def _insert(self, row):
+        """Add or replace an (id, type, lat, lon, timestamp, altitude) row"""
+        item_id, item_type, lat, lon, timestamp, altitude = row
+        row = (item_id, item_type, lat, lon, timestamp or '', altitude or 0)
+        self._rows[item_id] = row
+        self.grid.insert(item_id, lat, lon, row)
+
+    def _remove(self, item_id):
+        row = self._rows.pop(item_id, None)
+        if row is None:
+            return
+        self.grid.remove(item_id)
+        key = (row[4], item_id)
+        pos = bisect.bisect_left(self._timeline, key)
+        if pos < len(self._timeline) and self._timeline[pos] == key:
+            del self._timeline[pos]
+
+    def _on_change(self, event, items, version):
+        with self._lock:
+            stale = version != self.version + 1
+            if not stale:
+                for item in items:
+                    self._remove(item['id'])
+                    if event != 'delete':
+                        self._insert((item['id'], item['type'], item['lat'], item['lon'],
+                                      item.get('timestamp'), item.get('altitude')))
+                        bisect.insort(self._timeline, (self._rows[item['id']][4], item['id']))
+                self.version = version
+        if stale:
+            self.rebuild()
+
+    def _current(self):
+        if self.store.version() != self.version:
+            self.rebuild()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def row(self, item_id):
+        """(id, type, lat, lon, timestamp, altitude) of a record, or None"""
+        return self._rows.get(item_id)
+
+    def search(self, bbox=None, near=None, radius_km=None, polygon=None, start=None, end=None,
+               min_altitude=None, max_altitude=None, types=None):
+        """Ids of matching records in (timestamp, id) order
+
+        bbox is (south, west, north, east); near is (lat, lon) with radius_km;
+        polygon is a [(lat, lon), ...] ring; start/end are 'YYYY-MM-DD
+        HH:MM:SS' strings. Every condition given must hold.
+        """
+        if near is not None and radius_km is None:
+            raise ValueError("near needs radius_km")
+        self._current()
+        with self._lock:
+            boxes = _search_boxes(bbox, near, radius_km, polygon)
+            timeline = self._timeline
+            lo = bisect.bisect_left(timeline, (start,)) if start else 0
+            hi = bisect.bisect_right(timeline, (end, float('inf'))) if end else len(timeline)
+            if boxes is not None and (hi - lo) > TIME_SLICE_FRACTION * len(timeline):
+                # The grid only returns points inside the boxes
+                rows = [hit[3] for box in boxes for hit in self.grid.query_bbox(*box)]
+                from_grid = True
+            else:
+                rows = [self._rows[item_id] for _, item_id in timeline[lo:hi]]
+                from_grid = False
+
+        results = []
+        for row in rows:
+            item_id, item_type, lat, lon, timestamp, altitude = row
+            if types and item_type not in types:
+                continue
+            if from_grid and ((start and timestamp < start) or (end and timestamp > end)):
+                continue
+            if min_altitude is not None and altitude < min_altitude:
+                continue
+            if max_altitude is not None and altitude > max_altitude:
+                continue
+            if not from_grid and boxes is not None and not any(
+                    b[0] <= lat <= b[2] and b[1] <= lon <= b[3] for b in boxes):
+                continue
+            if near is not None and haversine_km(near[0], near[1], lat, lon) > radius_km:
+                continue
+            if polygon and not point_in_polygon(lat, lon, polygon):
+                continue
+            results.append(row)
+        if from_grid:
+            results.sort(key=lambda r: (r[4], r[0]))
+        return [row[0] for row in results]
+
+
+def _floats(value, count=None):
+    numbers = [float(v) for v in value.split(',')]
+    if count is not None and len(numbers) != count:
+        raise ValueError(f"Expected {count} comma-separated numbers, got {value!r}")
+    return numbers
+
+
+def parse_params(params):
+    """Search keyword arguments from query-string parameters
+
+    near=LAT,LON&radius_km=R, polygon=LAT,LON;LAT,LON;..., bbox=S,W,N,E,
+    start/end (dates or timestamps), min_altitude, max_altitude and
+    type=image,video. Raises ValueError for malformed values.
+    """
+    search = {}
+    if params.get('bbox'):
+        search['bbox'] = tuple(_floats(params['bbox'], 4))
+    if params.get('near'):
+        search['near'] = tuple(_floats(params['near'], 2))
+        search['radius_km'] = float(params.get('radius_km') or 1.0)
+    if params.get('polygon'):
+        ring = [tuple(_floats(point, 2)) for point in params['polygon'].split(';') if point]
+        if len(ring) < 3:
+            raise ValueError("A polygon needs at least three points")
+        search['polygon'] = ring
+    if params.get('start'):
+        search['start'] = params['start'].replace('T', ' ')
+    if params.get('end'):
+        end = params['end'].replace('T', ' ')
+        # A bare date includes the whole day
+        search['end'] = end + ' 23:59:59' if len(end) == 10 else end
+    for key in ('min_altitude', 'max_altitude'):
+        if params.get(key):
+            search[key] = float(params[key])
+    if params.get('type'):
+        search['types'] = params['type'].split(',')
+    return search
+
+
+def export_record(item):
+    """Public fields of a record, with a URL for its file"""
+    record = {key: item[key] for key in EXPORT_FIELDS if item.get(key) is not None}
+    if item.get('filepath'):
+        record['url'] = media_url(item)
+    return record
+
+
+def geojson(records):
+    """GeoJSON FeatureCollection of exported records"""
+    return {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [r['lon'], r['lat']]},
+            'properties': {k: v for k, v in r.items() if k not in ('lat', 'lon')},
+        } for r in records],
+    }
+
+
+def api_handler(index, store):
+    """Handler for /api/media: search results as JSON, or GeoJSON with format=geojson
+
+    Results are in capture order, API_PAGE_SIZE at a time (limit= up to
+    API_MAX_PAGE_SIZE); pass the response's `next` value as after= for the
+    following page. An after= id that isn't in the results (e.g. deleted
+    since) is a 400, so clients restart rather than silently repeat pages.
+    """
+    def handle(request, subpath):
+        if subpath not in ('', 'media'):
+            request.send_error(404)
+            return
+        params = {k: v[-1] for k, v in parse_qs(urlsplit(request.path).query).items()}
+        try:
+            search = parse_params(params)
+            limit = int(params.get('limit') or API_PAGE_SIZE)
+            after = int(params['after']) if params.get('after') else None
+            if not 1 <= limit <= API_MAX_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {API_MAX_PAGE_SIZE}")
+        except ValueError as e:
+            request.send_error(400, str(e))
+            return
+        ids = index.search(**search)
+        try:
+            first = ids.index(after) + 1 if after is not None else 0
+        except ValueError:
+            request.send_error(400, f"after={after} is not in the results")
+            return
+        page = ids[first:first + limit]
+        by_id = {item['id']: item for item in store.get_many(page)}
+        records = [export_record(by_id[item_id]) for item_id in page if item_id in by_id]
+        if params.get('format') == 'geojson':
+            body = geojson(records)
+        else:
+            body = {'count': len(ids), 'items': records}
+        body['next'] = page[-1] if page and first + limit < len(ids) else None
+        data = json.dumps(body).encode()
+        request.send_response(200)
+        request.send_header('Content-Type', 'application/geo+json' if params.get('format') == 'geojson'
+                            else 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.send_header('Cache-Control', 'no-cache')
+        request.send_header('Access-Control-Allow-Origin', '*')
+        request.end_headers()
+        if request.command != 'HEAD':
+            request.wfile.write(data)
+    return handle
+
+
+def area_from_geojson(feature):
+    """Search arguments for a shape drawn on the map, or {} if it isn't one
+
+    Polygons and rectangles become polygon=; circles (a Point with a radius
+    in metres) become near= and radius_km=.
+    """
+    geometry = (feature or {}).get('geometry') or {}
+    if geometry.get('type') == 'Polygon':
+        ring = [(lat, lon) for lon, lat in geometry['coordinates'][0]]
+        if len(ring) > 1 and ring[0] == ring[-1]:
+            ring = ring[:-1]
+        return {'polygon': ring} if len(ring) >= 3 else {}
+    radius = ((feature or {}).get('properties') or {}).get('radius')
+    if geometry.get('type') == 'Point' and radius:
+        lon, lat = geometry['coordinates']
+        return {'near': (lat, lon), 'radius_km': radius / 1000}
+    return {}
+
+
+def to_params(search):
+    """Query-string parameters for search arguments (the inverse of parse_params)"""
+    params = {}
+    for key, value in search.items():
+        if key in ('bbox', 'near'):
+            params[key] = ','.join(f'{v:.6f}' for v in value)
+        elif key == 'polygon':
+            params[key] = ';'.join(f'{lat:.6f},{lon:.6f}' for lat, lon in value)
+        elif key == 'types':
+            params['type'] = ','.join(value)
+        else:
+            params[key] = str(value)
+    return params
@@ -0,0 +1,192 @@
+"""Process-wide resources shared by every session of the app
+
+The store, indexes, background workers and the media server are each
+created once per process by a st.cache_resource getter. app.py calls them
+on every rerun and gets the cached object; get_warmup() builds them in the
+background. server.py starts the warm-up when the process starts, so the
+first visitor doesn't find the caches cold.
+
+The modules imported here stay eager although several pull in Pillow or
+numpy: server.py imports this module at process start, so their import
+cost is paid before the first visit rather than in it.
+"""
+import logging
+import os
+
+import streamlit as st
+
+import metrics
+from clustering import ClusterIndex
+from config import (UPLOAD_DIR, MEDIA_BASE_URL, MEDIA_SERVER_PUBLIC, CLUSTER_MAX_ZOOM, CLUSTER_RADIUS_PX,
+                    MARKER_THUMB_SIZE, WARMUP_THUMBNAILS)
+from dedup import PerceptualIndex
+from geo import StoreSpatialIndex
+from media_server import check_reachable, media_handler, register_route, start_media_server
+from orthomosaic import OrthoMosaic
+from query import ArchiveIndex, api_handler
+from storage import CachedMediaStore, open_store
+from transcode import TranscodeWorkerPool
+from thumbnails import cache_stats, get_derivative, marker_source, thumbnail_handler
+from tiles import tile_stats
+from tracks import TrackStore
+from warmup import Warmup
+
+# Cached functions called outside a script run (the warm-up thread, server.py's
+# startup hook on the main thread) warn that there is no ScriptRunContext;
+# they don't need one
+logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').addFilter(
+    lambda record: record.threadName not in ('warmup', 'MainThread'))
+
+
+@st.cache_resource
+def get_store():
+    """Open the media metadata store once per server process
+
+    All sessions read through one shared, version-invalidated cache; session
+    state only holds each viewer's own selection, filters and paging. The
+    media server serves the files its records reference at /files/ and
+    marker thumbnails at /thumbs/.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    store = CachedMediaStore(open_store())
+    register_route('/files/', media_handler(store))
+    register_route('/thumbs/', thumbnail_handler(store))
+    return store
+
+
+@st.cache_resource
+def get_archive_index():
+    """Spatial and timestamp indexes behind map, gallery and /api/media searches"""
+    index = ArchiveIndex(get_store())
+    register_route('/api/', api_handler(index, get_store()))
+    return index
+
+
+@st.cache_resource
+def get_cluster_index():
+    """Per-zoom marker clusters, shared by all sessions"""
+    return StoreSpatialIndex(
+        get_store(),
+        lambda: ClusterIndex(max_zoom=CLUSTER_MAX_ZOOM, radius_px=CLUSTER_RADIUS_PX)
+    )
+
+
+@st.cache_resource
+def get_media_server():
+    """Start the byte-range media server once per process
+
+    Returns whether pages should load media from it, which needs
+    MEDIA_BASE_URL to be configured and the server to answer there.
+    """
+    start_media_server()
+    if not MEDIA_SERVER_PUBLIC:
+        return False
+    if not check_reachable():
+        print(f"ERROR: media server unreachable at {MEDIA_BASE_URL}; serving media through Streamlit")
+        return False
+    return True
+
+
+@st.cache_resource
+def get_transcoder():
+    """Background proxy/poster workers (the warm-up queues videos still missing a proxy)"""
+    return TranscodeWorkerPool(get_store())
+
+
+@st.cache_resource
+def get_perceptual_index():
+    """Near-duplicate index of still-image hashes, kept current on insert/delete"""
+    index = PerceptualIndex.from_store(get_store())
+    
+    def on_change(event, items, version):
+        for item in items:
+            if event == 'delete':
+                index.remove(item['id'])
+            elif item.get('phash'):
+                index.add(item['id'], item['phash'])
+    
+    get_store().subscribe(on_change)
+    return index
+
+
+@st.cache_resource
+def get_orthomosaic():
+    """Survey tile pyramid, re-tiled in the background as stills arrive"""
+    mosaic = OrthoMosaic(get_store())
+    register_route('/ortho/', mosaic.serve_tile)
+    mosaic.refresh()
+    return mosaic
+
+
+@st.cache_resource
+def get_flight_stats():
+    """Columnar flight statistics, updated incrementally as media is added"""
+    # pandas is only imported once statistics are first needed
+    from analytics import FlightStats
+    return FlightStats(get_store())
+
+
+@st.cache_resource
+def get_track_store():
+    """Flight tracks imported from telemetry logs"""
+    return TrackStore()
+
+
+@st.cache_resource
+def register_metrics():
+    """Expose the caches' own statistics on /metrics, once per process"""
+    def collect():
+        samples = [(f'thumbnail_cache_{key}_total', 'counter', {}, value) for key, value in cache_stats().items()]
+        tiles = tile_stats()
+        samples += [(f'tile_cache_{key}_total', 'counter', {}, tiles[key])
+                    for key in ('hits', 'misses', 'errors', 'evictions')]
+        samples.append(('tile_cache_bytes', 'gauge', {}, tiles['bytes']))
+        store = get_store()
+        samples += [('store_cache_hits_total', 'counter', {}, store.hits),
+                    ('store_cache_misses_total', 'counter', {}, store.misses),
+                    ('media_items', 'gauge', {}, len(get_archive_index()))]
+        return samples
+    metrics.add_collector(collect)
+
+
+def import_map_modules():
+    """Import the map's modules, which the map code only imports when it first runs"""
+    import folium.plugins
+    import markers
+    import streamlit_folium
+
+
+def warm_flight_stats():
+    """Build the flight statistics and load the chart library their expander uses"""
+    get_flight_stats()
+    # st.bar_chart imports altair on first use
+    import altair
+
+
+def warm_derivatives():
+    """Render the derivative pyramids of the newest stories"""
+    for item in get_store().query(order='timestamp', descending=True, limit=WARMUP_THUMBNAILS):
+        filepath = marker_source(item)
+        if filepath:
+            get_derivative(filepath, MARKER_THUMB_SIZE)
+
+
+@st.cache_resource
+def get_warmup():
+    """Build the shared caches in the background, in the order the first page needs them
+
+    server.py starts it when the process starts; under a plain
+    `streamlit run app.py` the first run of the script does. server.py's
+    /readyz answers 200 once it has finished.
+    """
+    warmup = Warmup([
+        ('store', get_store),
+        ('indexes', lambda: (get_archive_index(), get_cluster_index(), get_track_store())),
+        ('map_modules', import_map_modules),
+        ('orthomosaic', get_orthomosaic),
+        ('flight_stats', warm_flight_stats),
+        ('perceptual_index', get_perceptual_index),
+        ('transcode_queue', lambda: get_transcoder().enqueue_missing()),
+        ('derivatives', warm_derivatives),
+    ])
+    return warmup.start()
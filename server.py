@@ -0,0 +1,78 @@
+"""ASGI entry point: the app, warmed up at process start, with probes and media
+
+`streamlit run server.py` serves app.py exactly like `streamlit run app.py`
+but starts the media server and the cache warm-up (see warmup.py) when the
+process starts rather than on the first visit, and answers /healthz,
+/readyz and /metrics on the Streamlit port, where orchestrators, Prometheus
+and the deployment can reach them.
+
+It also serves originals at /files/<id>/<name> (with byte ranges, so videos
+seek and stream) and marker thumbnails at /thumbs/<id> on the same port, so
+the app streams media without a second public port. Streamlit reserves
+/media/ for itself, hence /files/.
+"""
+from contextlib import asynccontextmanager
+
+import streamlit as st
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import metrics
+from media_server import mount_app_routes, record_file
+from resources import get_media_server, get_store, get_warmup, register_metrics
+from thumbnails import CONTENT_TYPE, THUMB_CACHE_CONTROL, marker_thumbnail
+from warmup import liveness, readiness
+
+
+@asynccontextmanager
+async def lifespan(app):
+    mount_app_routes()
+    get_warmup()
+    get_media_server()
+    yield
+
+
+def probe(check):
+    """Starlette endpoint answering with check(warmup)"""
+    async def endpoint(request):
+        status, body = check(get_warmup())
+        return JSONResponse(body, status_code=status, headers={'Cache-Control': 'no-store'})
+    return endpoint
+
+
+healthz = probe(liveness)
+readyz = probe(readiness)
+
+
+def prometheus(request):
+    """Process metrics in Prometheus text format (see metrics.py)"""
+    register_metrics()
+    return PlainTextResponse(metrics.render_prometheus(), media_type=metrics.CONTENT_TYPE,
+                             headers={'Cache-Control': 'no-cache'})
+
+
+def media_file(request):
+    """A file one of a record's fields points at; FileResponse honours Range"""
+    path = record_file(get_store(), request.path_params['item_id'], request.path_params['name'])
+    if path is None:
+        return Response(status_code=404)
+    return FileResponse(path, headers={'Cache-Control': 'public, max-age=3600'})
+
+
+def marker_thumb(request):
+    """The derivative of a story covering a marker's size"""
+    path = marker_thumbnail(get_store(), request.path_params['item_id'])
+    if path is None:
+        return Response(status_code=404)
+    return FileResponse(path, media_type=CONTENT_TYPE, headers={'Cache-Control': THUMB_CACHE_CONTROL})
+
+
+# Sync endpoints run in Starlette's thread pool, so store lookups and
+# derivative renders don't block the event loop
+app = st.App('app.py', lifespan=lifespan, routes=[
+    Route('/healthz', healthz, methods=['GET', 'HEAD']),
+    Route('/readyz', readyz, methods=['GET', 'HEAD']),
+    Route('/metrics', prometheus, methods=['GET', 'HEAD']),
+    Route('/files/{item_id:int}/{name}', media_file, methods=['GET', 'HEAD']),
+    Route('/thumbs/{item_id:int}', marker_thumb, methods=['GET', 'HEAD']),
+])
@@ -0,0 +1,780 @@
+"""Media metadata storage backends
+
+Two interchangeable backends implement the same small interface:
+
+- SqliteMediaStore: embedded SQLite database in WAL mode with indexes on
+  id, timestamp, type and a geohash spatial key. Inserts and updates touch
+  only the affected rows. On first open it imports the legacy JSON file.
+- JsonMediaStore: the original JSON file, now written as an append-only
+  journal with periodic atomic compaction, kept for small deployments and
+  for exporting.
+
+Use open_store() to get the backend selected in config. CachedMediaStore
+wraps either backend with a read cache that one server process shares
+between all of its sessions.
+"""
+import bisect
+import copy
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: in-process locking only
+    fcntl = None
+
+from config import DATA_FILE, JSON_JOURNAL_COMPACT_ENTRIES, MEDIA_BACKEND, MEDIA_DB
+from geo import geohash_encode
+
+# Columns stored natively; any other keys on a record go into `extra`
+COLUMNS = ('id', 'type', 'title', 'lat', 'lon', 'timestamp', 'altitude', 'description', 'filepath')
+
+SORT_COLUMNS = {'id', 'timestamp', 'title', 'altitude', 'type'}
+# What a missing (None) value sorts as; SQLite stores these in its place
+SORT_DEFAULTS = {'id': 0, 'timestamp': '', 'title': '', 'altitude': 0, 'type': ''}
+
+
+def sort_value(order, value):
+    """A record's value of sort column order, with None replaced by the column's default"""
+    return SORT_DEFAULTS[order] if value is None else value
+
+
+def get_sample_data():
+    """Return sample drone media data"""
+    return [
+        {
+            'id': 1, 'type': 'image', 'title': 'Coastal Cliff Aerial',
+            'lat': 34.0195, 'lon': -118.4912, 'timestamp': '2024-12-01 14:32:00',
+            'altitude': 120, 'description': 'Stunning aerial view of coastal cliffs at sunset',
+            'filepath': None
+        },
+        {
+            'id': 2, 'type': 'video', 'title': 'Downtown Flyover',
+            'lat': 34.0522, 'lon': -118.2437, 'timestamp': '2024-12-03 10:15:00',
+            'altitude': 200, 'description': 'Cinematic drone flyover of downtown Los Angeles',
+            'filepath': None
+        }
+    ]
+
+
+def load_json_file(path=DATA_FILE):
+    """Load a media list from a JSON file, or None if it doesn't exist
+
+    A file that exists but can't be parsed raises ValueError rather than
+    being treated as empty, so a damaged archive is never replaced by
+    sample data.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise ValueError(f"{path} is not valid JSON ({e}); restore it from a backup or move it aside") from e
+
+
+def _write_json_atomic(path, data):
+    """Write JSON to a temp file, fsync it and rename it over path"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class MediaStore:
+    """Change notification shared by the backends
+
+    Listeners are called as fn(event, items, version) after each committed
+    write, with event one of 'insert', 'update' or 'delete'.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def subscribe(self, fn):
+        self._listeners.append(fn)
+
+    def _notify(self, event, items, version):
+        for fn in self._listeners:
+            try:
+                fn(event, items, version)
+            except Exception as e:
+                print(f"Store listener failed: {e}")
+
+    def neighbors(self, item_id):
+        """(previous, next) records around item_id in timestamp order
+
+        Wraps around at either end. Each side is a single keyset lookup on
+        (timestamp, id), so it stays correct when records are added or
+        removed between calls. Returns (None, None) for an unknown id.
+        """
+        item = self.get(item_id)
+        if item is None:
+            return None, None
+        cursor = (item.get('timestamp'), item_id)
+        prev = self.query(order='timestamp', descending=True, limit=1, after=cursor) or \
+            self.query(order='timestamp', descending=True, limit=1)
+        next_ = self.query(order='timestamp', limit=1, after=cursor) or \
+            self.query(order='timestamp', limit=1)
+        return prev[0], next_[0]
+
+
+class SqliteMediaStore(MediaStore):
+    """Media metadata in SQLite (WAL) with one connection per thread"""
+
+    def __init__(self, path=MEDIA_DB, json_path=DATA_FILE):
+        super().__init__()
+        self.path = path
+        self.json_path = json_path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._init_schema()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._conn()
+        with conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS media (
+                    id INTEGER PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    title TEXT NOT NULL DEFAULT '',
+                    lat REAL NOT NULL,
+                    lon REAL NOT NULL,
+                    timestamp TEXT NOT NULL DEFAULT '',
+                    altitude REAL NOT NULL DEFAULT 0,
+                    description TEXT NOT NULL DEFAULT '',
+                    filepath TEXT,
+                    geohash TEXT NOT NULL,
+                    extra TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_media_timestamp ON media(timestamp, id);
+                CREATE INDEX IF NOT EXISTS idx_media_type ON media(type);
+                CREATE INDEX IF NOT EXISTS idx_media_geohash ON media(geohash);
+                CREATE INDEX IF NOT EXISTS idx_media_lat_lon ON media(lat, lon);
+                CREATE INDEX IF NOT EXISTS idx_media_altitude ON media(altitude, id);
+                CREATE INDEX IF NOT EXISTS idx_media_title ON media(title, id);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            ''')
+            # Databases created before altitude was NOT NULL
+            conn.execute('UPDATE media SET altitude = 0 WHERE altitude IS NULL')
+        if self._get_meta('json_imported') is None:
+            self._import_json()
+
+    def _get_meta(self, key):
+        row = self._conn().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else None
+
+    def _set_meta(self, conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _bump_version(self, conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('version', '1') "
+                     "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+    def version(self):
+        """Counter bumped by every committed write, across processes"""
+        return int(self._get_meta('version') or 0)
+
+    def _import_json(self):
+        """One-time import of the legacy JSON file (or sample data)"""
+        if os.path.exists(self.json_path) or os.path.exists(f"{self.json_path}.journal"):
+            # Reading through the JSON backend replays any journal on top
+            items = JsonMediaStore(self.json_path).all()
+        else:
+            items = get_sample_data()
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                if conn.execute('SELECT COUNT(*) FROM media').fetchone()[0] == 0:
+                    conn.executemany(self._insert_sql(), [self._to_row(item) for item in items])
+                    self._bump_version(conn)
+                self._set_meta(conn, 'json_imported', 1)
+
+    @staticmethod
+    def _insert_sql():
+        return ('INSERT INTO media (id, type, title, lat, lon, timestamp, altitude, description, '
+                'filepath, geohash, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+    @staticmethod
+    def _to_row(item):
+        extra = {k: v for k, v in item.items() if k not in COLUMNS}
+        return (
+            item.get('id'), item['type'], item.get('title') or '',
+            float(item['lat']), float(item['lon']), item.get('timestamp') or '',
+            item.get('altitude') or 0, item.get('description', ''), item.get('filepath'),
+            geohash_encode(float(item['lat']), float(item['lon'])),
+            json.dumps(extra) if extra else None,
+        )
+
+    @staticmethod
+    def _from_row(row):
+        item = {k: row[k] for k in COLUMNS}
+        if float(item['altitude']).is_integer():
+            item['altitude'] = int(item['altitude'])
+        if row['extra']:
+            item.update(json.loads(row['extra']))
+        return item
+
+    def get(self, item_id):
+        """Fetch one record by id, or None"""
+        row = self._conn().execute('SELECT * FROM media WHERE id = ?', (item_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def get_many(self, item_ids):
+        """Fetch records by id, in the order given (missing ids are skipped)"""
+        found = {}
+        item_ids = list(item_ids)
+        for i in range(0, len(item_ids), 500):
+            chunk = item_ids[i:i + 500]
+            sql = f"SELECT * FROM media WHERE id IN ({','.join('?' * len(chunk))})"
+            for row in self._conn().execute(sql, chunk):
+                found[row['id']] = self._from_row(row)
+        return [found[i] for i in item_ids if i in found]
+
+    def points(self):
+        """Lightweight (id, lat, lon, type) tuples for building indexes"""
+        return self._conn().execute('SELECT id, lat, lon, type FROM media').fetchall()
+
+    def columns(self):
+        """(id, type, lat, lon, timestamp, altitude) tuples for analytics"""
+        sql = 'SELECT id, type, lat, lon, timestamp, altitude FROM media'
+        return [tuple(row) for row in self._conn().execute(sql)]
+
+    def count(self, **filters):
+        """Number of records, optionally matching query() filters"""
+        where, params = self._where(**filters)
+        sql = 'SELECT COUNT(*) FROM media'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self._conn().execute(sql, params).fetchone()[0]
+
+    def counts_by_type(self):
+        """Return {type: count}"""
+        rows = self._conn().execute('SELECT type, COUNT(*) AS n FROM media GROUP BY type')
+        return {row['type']: row['n'] for row in rows}
+
+    def center(self):
+        """Mean lat/lon of all records, or None when empty"""
+        row = self._conn().execute('SELECT AVG(lat) AS lat, AVG(lon) AS lon FROM media').fetchone()
+        if row['lat'] is None:
+            return None
+        return row['lat'], row['lon']
+
+    @staticmethod
+    def _where(types=None, bbox=None, start=None, end=None, min_altitude=None, max_altitude=None, ids=None):
+        """SQL WHERE clause and parameters for the query filters"""
+        where, params = [], []
+        if ids is not None:
+            # One parameter however many ids, e.g. a spatial search result
+            where.append('id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(list(ids)))
+        if types:
+            where.append(f"type IN ({','.join('?' * len(types))})")
+            params.extend(types)
+        if bbox:
+            south, west, north, east = bbox
+            where.append('lat BETWEEN ? AND ?')
+            params.extend([south, north])
+            if west <= east:
+                where.append('lon BETWEEN ? AND ?')
+                params.extend([west, east])
+            else:
+                # Box crosses the antimeridian
+                where.append('(lon >= ? OR lon <= ?)')
+                params.extend([west, east])
+        if start:
+            where.append('timestamp >= ?')
+            params.append(start)
+        if end:
+            where.append('timestamp <= ?')
+            params.append(end)
+        if min_altitude is not None:
+            where.append('altitude >= ?')
+            params.append(min_altitude)
+        if max_altitude is not None:
+            where.append('altitude <= ?')
+            params.append(max_altitude)
+        return where, params
+
+    def query(self, order='id', descending=False, limit=None, offset=0, after=None, **filters):
+        """Return records matching the filters
+
+        Filters are types, bbox (south, west, north, east), start/end
+        (compared against the 'YYYY-MM-DD HH:MM:SS' timestamp strings),
+        min_altitude/max_altitude and ids (only these records). `after` is a keyset cursor: the
+        (order value, id) of the last row of the previous page, which makes
+        every page cost the same however deep it is. A None order value
+        stands for the column's default (SORT_DEFAULTS), as stored.
+        """
+        if order not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort by {order!r}")
+        where, params = self._where(**filters)
+        direction = 'DESC' if descending else 'ASC'
+        if after is not None:
+            where.append(f"({order}, id) {'<' if descending else '>'} (?, ?)")
+            params.extend([sort_value(order, after[0]), after[1]])
+        sql = 'SELECT * FROM media'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY {order} {direction}, id {direction}'
+        if limit is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            params.extend([limit, offset])
+        return [self._from_row(row) for row in self._conn().execute(sql, params)]
+
+    def all(self):
+        return self.query()
+
+    def index_of(self, item_id):
+        """Position of a record in id order"""
+        return self._conn().execute('SELECT COUNT(*) FROM media WHERE id < ?', (item_id,)).fetchone()[0]
+
+    def at(self, index):
+        """Record at a position in id order, or None"""
+        rows = self.query(limit=1, offset=index)
+        return rows[0] if rows else None
+
+    def next_id(self):
+        row = self._conn().execute('SELECT MAX(id) FROM media').fetchone()
+        return (row[0] or 0) + 1
+
+    def insert(self, item):
+        """Insert one record, assigning an id if it has none; returns the record"""
+        return self.insert_many([item])[0]
+
+    def insert_many(self, items):
+        """Insert records in a single transaction"""
+        items = [dict(item) for item in items]
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                next_id = self.next_id()
+                for item in items:
+                    if item.get('id') is None:
+                        item['id'] = next_id
+                        next_id += 1
+                    else:
+                        next_id = max(next_id, item['id'] + 1)
+                conn.executemany(self._insert_sql(), [self._to_row(item) for item in items])
+                version = self._bump_version(conn)
+        self._notify('insert', items, version)
+        return items
+
+    def update(self, item_id, **fields):
+        """Update fields on one record; returns the updated record or None"""
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                current = self.get(item_id)
+                if current is None:
+                    return None
+                current.update(fields)
+                row = self._to_row(current)
+                conn.execute(
+                    'UPDATE media SET type = ?, title = ?, lat = ?, lon = ?, timestamp = ?, altitude = ?, '
+                    'description = ?, filepath = ?, geohash = ?, extra = ? WHERE id = ?',
+                    row[1:] + (item_id,))
+                version = self._bump_version(conn)
+        self._notify('update', [current], version)
+        return current
+
+    def delete(self, item_id):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute('DELETE FROM media WHERE id = ?', (item_id,))
+                version = self._bump_version(conn)
+        self._notify('delete', [{'id': item_id}], version)
+
+    def export_json(self, path):
+        """Write all records to a JSON file"""
+        _write_json_atomic(path, self.all())
+
+
+class JsonMediaStore(MediaStore):
+    """Legacy backend: a JSON snapshot plus an append-only journal
+
+    Every write appends one JSON line to <path>.journal and fsyncs it while
+    holding an exclusive lock on <path>.lock, so writers in other threads
+    and processes are serialized and a write costs one small append instead
+    of rewriting the archive. Entries other processes appended are replayed
+    before each write and whenever version() is checked.
+
+    Once compact_every entries have accumulated they are folded into a new
+    snapshot, written to a temp file and renamed over the old one, and the
+    journal is emptied. Replaying an entry that is already in the snapshot
+    leaves the record unchanged (inserts overwrite by id, updates set fields,
+    deletes ignore missing ids), so a crash between the rename and the
+    truncate loses nothing. A torn last line left by a crash mid-append is
+    dropped on the next locked load.
+    """
+
+    def __init__(self, path=DATA_FILE, compact_every=JSON_JOURNAL_COMPACT_ENTRIES):
+        super().__init__()
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.lock_path = f"{path}.lock"
+        self.compact_every = compact_every
+        self._version = 0
+        self._lock = threading.RLock()
+        with self._locked():
+            self._load()
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access for this thread and, where supported, this process"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _snapshot_id(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def _load(self):
+        """Read the snapshot and replay the journal; call with the lock held"""
+        items = load_json_file(self.path)
+        if items is None:
+            items = []
+            if not os.path.exists(self.journal_path):
+                # First run: persist the sample archive so every process starts from it
+                items = get_sample_data()
+                _write_json_atomic(self.path, items)
+        self._items = items
+        self._snapshot = self._snapshot_id()
+        self._journal_offset = 0
+        self._journal_entries = 0
+        self._reindex()
+        self._replay(repair=True)
+        self._version += 1
+
+    def _replay(self, repair=False):
+        """Apply journal entries appended since the last read
+
+        With repair (lock held) a torn final line is truncated away; without
+        it, it is left for its writer to finish.
+        """
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    raise ValueError(f"Corrupt entry in {self.journal_path} at byte {self._journal_offset}")
+                self._apply(entry)
+            self._journal_offset += len(line) + 1
+        if repair and end < len(data):
+            print(f"Dropping incomplete last entry of {self.journal_path}")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(self._journal_offset)
+
+    def _refresh(self, repair=False):
+        """Pick up writes made by other processes"""
+        if self._snapshot_id() != self._snapshot:
+            # Another process compacted the journal into a new snapshot
+            self._load()
+        else:
+            self._replay(repair)
+
+    def _apply(self, entry):
+        op = entry['op']
+        if op == 'insert':
+            for item in entry['items']:
+                old = self._by_id.get(item['id'])
+                if old is not None:
+                    self._items.remove(old)
+                    self._timeline.remove(self._timeline_key(old))
+                self._items.append(item)
+                self._by_id[item['id']] = item
+                bisect.insort(self._timeline, self._timeline_key(item))
+        elif op == 'update':
+            item = self._by_id.get(entry['id'])
+            if item is not None:
+                fields = entry['fields']
+                if 'timestamp' in fields:
+                    self._timeline.remove(self._timeline_key(item))
+                    bisect.insort(self._timeline, (fields['timestamp'] or '', item['id']))
+                item.update(fields)
+        elif op == 'delete':
+            item = self._by_id.pop(entry['id'], None)
+            if item is not None:
+                self._items.remove(item)
+                self._timeline.remove(self._timeline_key(item))
+        self._journal_entries += 1
+        self._version += 1
+
+    def _write(self, entry):
+        """Append an entry to the journal and apply it; call with the lock held"""
+        line = (json.dumps(entry) + '\n').encode()
+        with open(self.journal_path, 'ab') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_offset += len(line)
+        self._apply(entry)
+        if self._journal_entries >= self.compact_every:
+            self._compact()
+        return self._version
+
+    def compact(self):
+        """Fold the journal into a fresh snapshot"""
+        with self._locked():
+            self._refresh(repair=True)
+            self._compact()
+
+    def _compact(self):
+        _write_json_atomic(self.path, self._items)
+        self._snapshot = self._snapshot_id()
+        with open(self.journal_path, 'wb') as f:
+            os.fsync(f.fileno())
+        self._journal_offset = 0
+        self._journal_entries = 0
+
+    def _reindex(self):
+        # id -> record, and (timestamp, id) keys kept sorted for navigation
+        self._by_id = {x['id']: x for x in self._items}
+        self._timeline = sorted(self._timeline_key(x) for x in self._items)
+
+    @staticmethod
+    def _timeline_key(item):
+        return item.get('timestamp') or '', item['id']
+
+    def get(self, item_id):
+        item = self._by_id.get(item_id)
+        return dict(item) if item is not None else None
+
+    def version(self):
+        with self._lock:
+            self._refresh()
+            return self._version
+
+    def get_many(self, item_ids):
+        return [dict(self._by_id[i]) for i in item_ids if i in self._by_id]
+
+    def points(self):
+        return [(x['id'], x['lat'], x['lon'], x['type']) for x in self._items]
+
+    def columns(self):
+        return [(x['id'], x['type'], x['lat'], x['lon'], x.get('timestamp', ''), x.get('altitude') or 0)
+                for x in self._items]
+
+    def _candidates(self, filters):
+        """Records to test against the filters: just the listed ones when ids is given"""
+        ids = filters.get('ids')
+        if ids is None:
+            return self._items
+        return [self._by_id[item_id] for item_id in set(ids) if item_id in self._by_id]
+
+    def count(self, **filters):
+        if not filters:
+            return len(self._items)
+        return sum(1 for x in self._candidates(filters) if self._matches(x, **filters))
+
+    def counts_by_type(self):
+        counts = {}
+        for item in self._items:
+            counts[item['type']] = counts.get(item['type'], 0) + 1
+        return counts
+
+    def center(self):
+        if not self._items:
+            return None
+        n = len(self._items)
+        return sum(x['lat'] for x in self._items) / n, sum(x['lon'] for x in self._items) / n
+
+    @staticmethod
+    def _matches(x, types=None, bbox=None, start=None, end=None, min_altitude=None, max_altitude=None, ids=None):
+        # ids is applied by _candidates
+        if types and x['type'] not in types:
+            return False
+        if bbox:
+            south, west, north, east = bbox
+            if not south <= x['lat'] <= north:
+                return False
+            if west <= east and not west <= x['lon'] <= east:
+                return False
+            if west > east and not (x['lon'] >= west or x['lon'] <= east):
+                return False
+        if start and x.get('timestamp', '') < start:
+            return False
+        if end and x.get('timestamp', '') > end:
+            return False
+        altitude = x.get('altitude') or 0
+        if min_altitude is not None and altitude < min_altitude:
+            return False
+        if max_altitude is not None and altitude > max_altitude:
+            return False
+        return True
+
+    def query(self, order='id', descending=False, limit=None, offset=0, after=None, **filters):
+        if order not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort by {order!r}")
+        # Records may lack a value; sort them as SQLite stores them
+        key = lambda x: (sort_value(order, x.get(order)), x['id'])
+        items = [x for x in self._candidates(filters) if self._matches(x, **filters)]
+        if after is not None:
+            after = (sort_value(order, after[0]), after[1])
+            items = [x for x in items if (key(x) < after if descending else key(x) > after)]
+        items = sorted(items, key=key, reverse=descending)
+        if limit is not None:
+            items = items[offset:offset + limit]
+        return [dict(x) for x in items]
+
+    def neighbors(self, item_id):
+        item = self._by_id.get(item_id)
+        if item is None:
+            return None, None
+        timeline = self._timeline
+        pos = bisect.bisect_left(timeline, self._timeline_key(item))
+        prev_id = timeline[pos - 1][1]
+        next_id = timeline[(pos + 1) % len(timeline)][1]
+        return dict(self._by_id[prev_id]), dict(self._by_id[next_id])
+
+    def all(self):
+        return self.query()
+
+    def index_of(self, item_id):
+        return sum(1 for x in self._items if x['id'] < item_id)
+
+    def at(self, index):
+        rows = self.query(limit=1, offset=index)
+        return rows[0] if rows else None
+
+    def next_id(self):
+        return max(self._by_id, default=0) + 1
+
+    def insert(self, item):
+        return self.insert_many([item])[0]
+
+    def insert_many(self, items):
+        items = [dict(item) for item in items]
+        with self._locked():
+            self._refresh(repair=True)
+            next_id = self.next_id()
+            for item in items:
+                if item.get('id') is None:
+                    item['id'] = next_id
+                    next_id += 1
+            version = self._write({'op': 'insert', 'items': items})
+        self._notify('insert', items, version)
+        return items
+
+    def update(self, item_id, **fields):
+        with self._locked():
+            self._refresh(repair=True)
+            if item_id not in self._by_id:
+                return None
+            version = self._write({'op': 'update', 'id': item_id, 'fields': fields})
+            updated = dict(self._by_id[item_id])
+        self._notify('update', [updated], version)
+        return updated
+
+    def delete(self, item_id):
+        with self._locked():
+            self._refresh(repair=True)
+            if item_id not in self._by_id:
+                return
+            version = self._write({'op': 'delete', 'id': item_id})
+        self._notify('delete', [{'id': item_id}], version)
+
+    def export_json(self, path):
+        with self._lock:
+            _write_json_atomic(path, self._items)
+
+
+class CachedMediaStore:
+    """Process-wide read cache in front of a media store
+
+    Results of the read methods are memoized per store version. Any write,
+    whether made through this process or another (e.g. the import CLI),
+    bumps the version and drops every cached result the next time a read
+    checks it. Everything else is passed through to the wrapped store.
+    Callers get copies, so a session can't alter what other sessions see.
+    """
+
+    CACHED = {'get', 'get_many', 'count', 'counts_by_type', 'center', 'query', 'neighbors'}
+
+    def __init__(self, store, max_entries=2048):
+        self.store = store
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._version = None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if name not in self.CACHED:
+            return attr
+
+        def cached(*args, **kwargs):
+            return copy.deepcopy(self._read(name, attr, args, kwargs))
+        return cached
+
+    def _read(self, name, fn, args, kwargs):
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        version = self.store.version()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        result = fn(*args, **kwargs)
+        with self._lock:
+            # A reader that already saw a newer version has moved on; don't
+            # put an older result back
+            if self._version == version:
+                self._entries[key] = result
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return result
+
+
+def open_store(backend=MEDIA_BACKEND):
+    """Open the configured media store backend"""
+    if backend == 'sqlite':
+        return SqliteMediaStore()
+    if backend == 'json':
+        return JsonMediaStore()
+    raise ValueError(f"Unknown media backend: {backend!r}")
@@ -0,0 +1,15 @@
+import json
+
+import pytest
+
+from storage import JsonMediaStore, SqliteMediaStore
+
+
+@pytest.fixture(params=['sqlite', 'json'])
+def empty_store(request, tmp_path):
+    """An empty store of each backend"""
+    json_path = tmp_path / 'media_data.json'
+    json_path.write_text(json.dumps([]))
+    if request.param == 'sqlite':
+        return SqliteMediaStore(str(tmp_path / 'media.db'), str(json_path))
+    return JsonMediaStore(str(json_path))
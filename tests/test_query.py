@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from geo import haversine_km, point_in_polygon
+from query import ArchiveIndex
+
+TIMESTAMPS = [f'2024-{month:02d}-{day:02d} {hour:02d}:00:00'
+              for month in (1, 4, 7, 10) for day in (1, 15) for hour in (6, 18)]
+
+
+def make_records(n, seed=3):
+    """Records clustered around a few places, two of them on the antimeridian"""
+    rng = random.Random(seed)
+    centers = [(34.05, -118.25), (-17.8, 179.9), (-16.5, -179.8), (51.5, -0.1), (0.0, 0.0)]
+    records = []
+    for i in range(1, n + 1):
+        lat, lon = rng.choice(centers)
+        lon += rng.uniform(-0.5, 0.5)
+        lon = (lon + 180) % 360 - 180
+        records.append({
+            'id': i, 'type': rng.choice(['image', 'video']), 'title': f'r{i}', 'description': '',
+            'lat': lat + rng.uniform(-0.5, 0.5), 'lon': lon,
+            'timestamp': rng.choice(TIMESTAMPS), 'altitude': rng.choice([0, 15, 60, 120, 400]),
+            'filepath': None,
+        })
+    return records
+
+
+def brute_force(records, bbox=None, near=None, radius_km=None, polygon=None, start=None, end=None,
+                min_altitude=None, max_altitude=None, types=None):
+    """What search() should return, checking every record"""
+    hits = []
+    for x in records:
+        if bbox:
+            south, west, north, east = bbox
+            in_lon = west <= x['lon'] <= east if west <= east else (x['lon'] >= west or x['lon'] <= east)
+            if not (south <= x['lat'] <= north and in_lon):
+                continue
+        if near and haversine_km(near[0], near[1], x['lat'], x['lon']) > radius_km:
+            continue
+        if polygon and not point_in_polygon(x['lat'], x['lon'], polygon):
+            continue
+        if (start and x['timestamp'] < start) or (end and x['timestamp'] > end):
+            continue
+        if (min_altitude is not None and x['altitude'] < min_altitude) or \
+                (max_altitude is not None and x['altitude'] > max_altitude):
+            continue
+        if types and x['type'] not in types:
+            continue
+        hits.append(x)
+    return [x['id'] for x in sorted(hits, key=lambda x: (x['timestamp'], x['id']))]
+
+
+SEARCHES = [
+    {},
+    {'bbox': (33.8, -118.6, 34.3, -118.0)},
+    {'bbox': (-18.5, 179.5, -16.0, -179.5)},
+    {'bbox': (-90, 170.0, 90, -170.0), 'types': ['video']},
+    {'near': (34.05, -118.25), 'radius_km': 20},
+    {'near': (-17.0, 179.95), 'radius_km': 120},
+    {'near': (51.5, -0.1), 'radius_km': 30, 'min_altitude': 50, 'max_altitude': 200},
+    {'polygon': [(33.7, -118.7), (34.4, -118.4), (33.9, -117.8)]},
+    {'polygon': [(51.0, -0.6), (52.0, -0.6), (52.0, 0.4), (51.0, 0.4)], 'near': (51.5, -0.1), 'radius_km': 25},
+    {'start': '2024-04-01 00:00:00', 'end': '2024-04-15 06:00:00'},
+    {'start': '2024-07-01', 'bbox': (-1, -1, 1, 1)},
+    {'end': '2024-01-15 18:00:00', 'near': (0.0, 0.0), 'radius_km': 40, 'types': ['image']},
+    # Narrow time windows scan the timeline instead of the grid
+    {'bbox': (-18.5, 179.5, -16.0, -179.5), 'start': '2024-10-01', 'end': '2024-10-01 12:00:00'},
+    {'near': (-17.0, 179.95), 'radius_km': 120, 'start': '2024-07-15', 'end': '2024-07-15 12:00:00'},
+    {'polygon': [(33.7, -118.7), (34.4, -118.4), (33.9, -117.8)], 'start': '2024-04-15 00:00:00',
+     'end': '2024-04-15 12:00:00'},
+]
+
+
+@pytest.fixture
+def indexed(empty_store):
+    records = make_records(600)
+    empty_store.insert_many(records)
+    return ArchiveIndex(empty_store), empty_store, records
+
+
+@pytest.mark.parametrize('search', SEARCHES)
+def test_search_matches_brute_force(indexed, search):
+    index, _, records = indexed
+    assert index.search(**search) == brute_force(records, **search)
+
+
+def test_search_follows_store_changes(indexed):
+    index, store, records = indexed
+    new = dict(records[0], id=1000, lat=-17.0, lon=-179.99, timestamp='2024-12-31 23:00:00')
+    store.insert(new)
+    store.delete(records[1]['id'])
+    store.update(records[2]['id'], lat=-17.1, lon=179.99)
+    current = store.all()
+    for search in SEARCHES:
+        assert index.search(**search) == brute_force(current, **search)
+
+
+def test_near_needs_radius(indexed):
+    index, _, _ = indexed
+    with pytest.raises(ValueError):
+        index.search(near=(0, 0))
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+from PIL import Image
+from starlette.requests import Request
+
+import server
+import thumbnails
+from storage import JsonMediaStore
+from warmup import Warmup
+
+
+def call(endpoint, path_params=None, headers=()):
+    """Response of a server.py endpoint to a GET"""
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': list(headers),
+                       'query_string': b'', 'path_params': path_params or {}})
+    response = endpoint(request)
+    return asyncio.run(response) if asyncio.iscoroutine(response) else response
+
+
+def body(response):
+    return json.loads(response.body)
+
+
+@pytest.fixture
+def warmup(monkeypatch):
+    """A warm-up whose one task waits for release.set()"""
+    release = threading.Event()
+    warmup = Warmup([('slow', release.wait)]).start()
+    monkeypatch.setattr(server, 'get_warmup', lambda: warmup)
+    yield warmup, release
+    release.set()
+
+
+def test_readyz_waits_for_the_warmup(warmup):
+    warmup, release = warmup
+    response = call(server.readyz)
+    assert response.status_code == 503
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert body(response)['tasks']['slow']['state'] == 'running'
+    release.set()
+    warmup._done.wait(5)
+    response = call(server.readyz)
+    assert response.status_code == 200
+    assert body(response)['ready'] is True
+    assert body(response)['tasks']['slow']['state'] == 'done'
+
+
+def test_healthz_is_live_while_warming_up(warmup):
+    warmup, release = warmup
+    response = call(server.healthz)
+    assert response.status_code == 200
+    assert body(response) == {'status': 'ok', 'ready': False}
+
+
+def test_failed_task_doesnt_block_readiness(monkeypatch):
+    def fail():
+        raise RuntimeError('no store')
+    warmup = Warmup([('broken', fail)]).start()
+    warmup._done.wait(5)
+    monkeypatch.setattr(server, 'get_warmup', lambda: warmup)
+    response = call(server.readyz)
+    assert response.status_code == 200
+    assert body(response)['tasks']['broken'] == {'state': 'failed', 'seconds': pytest.approx(0, abs=1),
+                                                 'error': 'no store'}
+
+
+def test_metrics(monkeypatch):
+    monkeypatch.setattr(server, 'register_metrics', lambda: None)
+    server.metrics.count('test_probe_requests')
+    response = call(server.prometheus)
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert b'test_probe_requests' in response.body
+
+
+@pytest.fixture
+def media_store(tmp_path, monkeypatch):
+    """A JSON store with one image record, served by server.py"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(thumbnails, '_local', threading.local())
+    monkeypatch.setattr(thumbnails, '_cache_bytes', None)
+    os.makedirs('uploads')
+    Image.new('RGB', (800, 600), 'red').save('uploads/photo.jpg')
+    with open('uploads/.hidden.jpg', 'wb') as f:
+        f.write(b'x')
+    with open('media_data.json', 'w') as f:
+        json.dump([], f)
+    store = JsonMediaStore('media_data.json')
+    store.insert({'id': 1, 'type': 'image', 'title': 'Photo', 'lat': 1.0, 'lon': 2.0,
+                  'timestamp': '2024-01-01 00:00:00', 'altitude': 10, 'description': '',
+                  'filepath': 'uploads/photo.jpg'})
+    store.insert({'id': 2, 'type': 'image', 'title': 'Hidden', 'lat': 1.0, 'lon': 2.0,
+                  'timestamp': '2024-01-01 00:00:00', 'altitude': 10, 'description': '',
+                  'filepath': 'uploads/.hidden.jpg'})
+    monkeypatch.setattr(server, 'get_store', lambda: store)
+    return store
+
+
+def test_files_serves_record_files_only(media_store):
+    response = call(server.media_file, {'item_id': 1, 'name': 'photo.jpg'})
+    assert response.status_code == 200
+    assert response.path == os.path.realpath('uploads/photo.jpg')
+    assert call(server.media_file, {'item_id': 1, 'name': 'other.jpg'}).status_code == 404
+    assert call(server.media_file, {'item_id': 3, 'name': 'photo.jpg'}).status_code == 404
+    # Dot-directories and dot-files under uploads are caches and indexes
+    assert call(server.media_file, {'item_id': 2, 'name': '.hidden.jpg'}).status_code == 404
+
+
+def test_thumbs(media_store):
+    response = call(server.marker_thumb, {'item_id': 1})
+    assert response.status_code == 200
+    assert response.media_type == server.CONTENT_TYPE
+    assert 'immutable' in response.headers['Cache-Control']
+    with Image.open(response.path) as thumb:
+        assert max(thumb.size) <= 200
+    assert call(server.marker_thumb, {'item_id': 3}).status_code == 404
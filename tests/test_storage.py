@@ -0,0 +1,123 @@
+import json
+import random
+
+import pytest
+
+from storage import SORT_DEFAULTS, JsonMediaStore, SqliteMediaStore
+
+SORTS = [(order, descending) for order in ('id', 'timestamp', 'title', 'altitude', 'type')
+         for descending in (False, True)]
+
+
+def make_records(n, seed=1):
+    """Records with repeated and missing sort values"""
+    rng = random.Random(seed)
+    records = []
+    for i in range(1, n + 1):
+        records.append({
+            'id': i,
+            'type': rng.choice(['image', 'video']),
+            'title': rng.choice(['Alpha', 'Beta', 'Gamma', None]),
+            'lat': rng.uniform(-60, 60),
+            'lon': rng.uniform(-180, 180),
+            'timestamp': rng.choice(['2024-01-01 10:00:00', '2024-03-05 12:30:00', '2024-06-01 08:00:00', None]),
+            'altitude': rng.choice([10, 55.5, 120, None]),
+            'description': '',
+            'filepath': None,
+        })
+    return records
+
+
+def expected_ids(records, order, descending):
+    """Ids in (order value, id) order, missing values sorting as their default"""
+    def key(x):
+        value = x.get(order)
+        return (SORT_DEFAULTS[order] if value is None else value, x['id'])
+    return [x['id'] for x in sorted(records, key=key, reverse=descending)]
+
+
+@pytest.fixture
+def store(empty_store):
+    records = make_records(40)
+    empty_store.insert_many(records)
+    return empty_store, records
+
+
+@pytest.mark.parametrize('order,descending', SORTS)
+def test_query_order(store, order, descending):
+    store, records = store
+    ids = [x['id'] for x in store.query(order=order, descending=descending)]
+    assert ids == expected_ids(records, order, descending)
+
+
+@pytest.mark.parametrize('order,descending', SORTS)
+def test_keyset_pages_cover_every_record_once(store, order, descending):
+    """Paging with the last row's raw value as cursor, as the gallery does"""
+    store, records = store
+    ids, cursor = [], None
+    while True:
+        page = store.query(order=order, descending=descending, limit=7, after=cursor)
+        if not page:
+            break
+        ids += [x['id'] for x in page]
+        cursor = (page[-1][order], page[-1]['id'])
+    assert ids == expected_ids(records, order, descending)
+
+
+@pytest.mark.parametrize('order', ['title', 'altitude', 'timestamp'])
+def test_cursor_with_null_value(store, order):
+    store, records = store
+    expected = expected_ids(records, order, False)
+    missing = [x for x in records if x[order] is None]
+    assert missing
+    last = missing[0]
+    rest = store.query(order=order, after=(None, last['id']))
+    assert [x['id'] for x in rest] == expected[expected.index(last['id']) + 1:]
+
+
+def test_query_filters_and_limit(store):
+    store, records = store
+    page = store.query(order='altitude', types=['video'], min_altitude=50, limit=5)
+    matching = [x for x in records if x['type'] == 'video' and (x['altitude'] or 0) >= 50]
+    assert [x['id'] for x in page] == expected_ids(matching, 'altitude', False)[:5]
+
+
+def test_backends_agree(tmp_path):
+    records = make_records(60, seed=7)
+    json_path = tmp_path / 'media_data.json'
+    json_path.write_text(json.dumps([]))
+    stores = [SqliteMediaStore(str(tmp_path / 'media.db'), str(json_path)), JsonMediaStore(str(json_path))]
+    for s in stores:
+        s.insert_many(records)
+    for order, descending in SORTS:
+        sqlite_ids, json_ids = ([x['id'] for x in s.query(order=order, descending=descending)] for s in stores)
+        assert sqlite_ids == json_ids, (order, descending)
+
+
+
+def test_neighbors_follow_timestamps_and_wrap(store):
+    store, records = store
+    timeline = expected_ids(records, 'timestamp', False)
+    for pos, item_id in enumerate(timeline):
+        prev, next_ = store.neighbors(item_id)
+        assert prev['id'] == timeline[pos - 1]
+        assert next_['id'] == timeline[(pos + 1) % len(timeline)]
+
+
+def test_neighbors_unknown_id(store):
+    store, _ = store
+    assert store.neighbors(9999) == (None, None)
+
+
+def test_neighbors_see_inserts_and_deletes(store):
+    store, records = store
+    timeline = expected_ids(records, 'timestamp', False)
+    middle = timeline[len(timeline) // 2]
+    store.delete(middle)
+    prev, next_ = store.neighbors(timeline[len(timeline) // 2 - 1])
+    assert next_['id'] == timeline[len(timeline) // 2 + 1]
+    store.insert({'id': 100, 'type': 'image', 'title': 'Late', 'lat': 0, 'lon': 0,
+                  'timestamp': '2099-01-01 00:00:00', 'altitude': 1, 'description': '', 'filepath': None})
+    prev, next_ = store.neighbors(100)
+    assert prev['id'] == timeline[-1]
+    assert next_['id'] == timeline[0]
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import thumbnails
+from config import DERIVATIVE_SIZES, MARKER_THUMB_SIZE
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Run in an empty directory, so uploads/.thumbs is a fresh cache"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(thumbnails, '_local', threading.local())
+    monkeypatch.setattr(thumbnails, '_cache_bytes', None)
+    os.makedirs('uploads')
+
+
+def make_image(name, color):
+    path = os.path.join('uploads', name)
+    Image.new('RGB', (1200, 900), color).save(path)
+    return path
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def derivative_files():
+    return sorted(os.path.join(root, name) for root, _, files in os.walk(thumbnails.THUMB_DIR)
+                  for name in files if name.endswith(thumbnails.CACHED_SUFFIXES))
+
+
+def indexed_paths():
+    return {row[0] for row in thumbnails._index().execute('SELECT path FROM digests')}
+
+
+def test_source_digest_is_remembered(monkeypatch):
+    path = make_image('a.png', 'red')
+    digest = thumbnails.source_digest(path)
+    assert digest == thumbnails.file_digest(path)
+    monkeypatch.setattr(thumbnails, 'file_digest', lambda filepath: pytest.fail('re-hashed'))
+    assert thumbnails.source_digest(path) == digest
+
+
+def test_source_digest_rehashes_changed_file():
+    path = make_image('a.png', 'red')
+    first = thumbnails.source_digest(path)
+    Image.new('RGB', (50, 50), 'blue').save(path)
+    assert thumbnails.source_digest(path) != first
+
+
+def test_legacy_json_index_is_imported():
+    path = make_image('a.png', 'red')
+    st = os.stat(path)
+    os.makedirs(thumbnails.THUMB_DIR)
+    with open(thumbnails.LEGACY_INDEX_FILE, 'w') as f:
+        json.dump({os.path.abspath(path): {'size': st.st_size, 'mtime': st.st_mtime_ns, 'digest': 'f' * 64}}, f)
+    assert thumbnails.source_digest(path) == 'f' * 64
+    assert not os.path.exists(thumbnails.LEGACY_INDEX_FILE)
+
+
+def test_eviction_spares_recently_used_derivatives():
+    old = make_image('old.png', 'red')
+    new = make_image('new.png', 'blue')
+    old_path = thumbnails.get_derivative(old, MARKER_THUMB_SIZE)
+    for path in derivative_files():
+        age(path, thumbnails.THUMB_EVICT_GRACE_S + 10)
+    new_path = thumbnails.get_derivative(new, MARKER_THUMB_SIZE, max_bytes=1)
+    # Over budget, but everything new.png just rendered was handed out
+    assert os.path.exists(new_path)
+    assert not os.path.exists(old_path)
+    assert len(derivative_files()) == len(DERIVATIVE_SIZES)
+
+
+def test_hit_touches_derivative():
+    path = make_image('a.png', 'red')
+    thumb = thumbnails.get_derivative(path, MARKER_THUMB_SIZE)
+    age(thumb, 3600)
+    assert thumbnails.get_derivative(path, MARKER_THUMB_SIZE) == thumb
+    assert os.path.getmtime(thumb) > time.time() - 60
+
+
+def test_missing_level_is_a_miss():
+    path = make_image('a.png', 'red')
+    thumb = thumbnails.get_derivative(path, MARKER_THUMB_SIZE)
+    os.remove(thumb)
+    assert thumbnails.get_derivative(path, MARKER_THUMB_SIZE) == thumb
+    assert os.path.exists(thumb)
+
+
+def test_eviction_prunes_index():
+    kept = make_image('kept.png', 'red')
+    evicted = make_image('evicted.png', 'green')
+    deleted = make_image('deleted.png', 'blue')
+    for path in (kept, evicted, deleted):
+        thumbnails.get_derivative(path, MARKER_THUMB_SIZE)
+    evicted_digest = thumbnails.source_digest(evicted)
+    for edge in DERIVATIVE_SIZES:
+        age(thumbnails.derivative_path(evicted_digest, edge), thumbnails.THUMB_EVICT_GRACE_S + 10)
+    os.remove(deleted)
+    # The next miss over budget evicts
+    trigger = make_image('trigger.png', 'white')
+    thumbnails.get_derivative(trigger, MARKER_THUMB_SIZE, max_bytes=1)
+    assert not os.path.exists(thumbnails.derivative_path(evicted_digest, DERIVATIVE_SIZES[0]))
+    assert indexed_paths() == {os.path.abspath(kept), os.path.abspath(trigger)}
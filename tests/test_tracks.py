@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from tracks import TrackStore
+
+
+def flight(lat, lon, n=20, step=0.001):
+    """(t_ms, lat, lon, alt) samples of a short straight flight"""
+    return [(i * 1000, lat + i * step, lon + i * step, 50.0) for i in range(n)]
+
+
+@pytest.fixture
+def track_store(tmp_path):
+    return TrackStore(str(tmp_path / 'tracks.db'))
+
+
+def test_tracks_in_bbox(track_store):
+    la = track_store.add('la', None, flight(34.0, -118.3))
+    track_store.add('tokyo', None, flight(35.6, 139.7))
+    assert [t['id'] for t in track_store.tracks((33.9, -118.5, 34.2, -118.0))] == [la]
+    assert track_store.tracks((0, 0, 1, 1)) == []
+
+
+def test_tracks_in_bbox_across_antimeridian(track_store):
+    fiji = track_store.add('fiji', None, flight(-17.8, 178.4))
+    samoa = track_store.add('samoa', None, flight(-13.8, -171.8))
+    track_store.add('la', None, flight(34.0, -118.3))
+    ids = [t['id'] for t in track_store.tracks((-20.0, 170.0, -10.0, -170.0))]
+    assert ids == [fiji, samoa]
+
+
+def test_cache_follows_deletes(track_store):
+    first = track_store.add('first', None, flight(34.0, -118.3))
+    assert len(track_store.points(first)) == 20
+    track_store.delete(first)
+    assert track_store.points(first) is None
+    # The id is reused, so the cache must not hand back the old samples
+    second = track_store.add('second', None, flight(35.0, -117.0, n=5))
+    assert second == first
+    assert len(track_store.points(second)) == 5
+
+
+def test_concurrent_loads(track_store):
+    ids = [track_store.add(f't{i}', None, flight(34.0 + i, -118.0)) for i in range(80)]
+    errors = []
+
+    def load():
+        try:
+            for track_id in ids:
+                assert track_store.simplified(track_id, 14)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
@@ -0,0 +1,328 @@
+"""Content-addressed on-disk cache of image derivatives
+
+Every still (and video poster) gets a small pyramid of derivatives, one
+per DERIVATIVE_SIZES longest edge (200, 800 and 2048 px), encoded as WebP
+(JPEG if Pillow lacks WebP). The levels are rendered together from a
+single decode of the original. Markers, galleries and the story viewer ask
+get_derivative() for the display size they need and get the smallest
+level that covers it; the full original is only sent when a user asks for
+it.
+
+Derivatives are keyed by the SHA-256 of the source file, so identical
+uploads share one pyramid and any change to the source produces a new key.
+A stat index (path -> size, mtime, digest) in SQLite avoids re-hashing
+unchanged originals on every rerun. The cache directory is capped in bytes
+and evicts least recently used entries first, sparing those used in the
+last THUMB_EVICT_GRACE_S seconds so a path just handed out stays readable.
+Eviction also drops index entries for deleted sources and for sources
+whose derivatives are all gone.
+
+thumbnail_handler() serves the map markers' thumbnails over the media
+server by story id (server.py serves marker_thumbnail() on the app's port
+too), so pages reference them by URL instead of inlining them. When
+browsers can reach neither, thumbnail_data_uri() inlines the smallest level
+instead.
+"""
+import base64
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image, features
+
+from config import (BLOB_DIR, DERIVATIVE_FORMAT, DERIVATIVE_QUALITY, DERIVATIVE_SIZES, MARKER_THUMB_SIZE,
+                    THUMB_DIR, THUMB_CACHE_MAX_BYTES, THUMB_EVICT_GRACE_S)
+from media_server import send_file
+
+CHUNK_SIZE = 1024 * 1024
+INDEX_DB = os.path.join(THUMB_DIR, "index.db")
+# The stat index of earlier versions, imported into INDEX_DB once
+LEGACY_INDEX_FILE = os.path.join(THUMB_DIR, "index.json")
+
+# Pillow can be built without WebP
+if DERIVATIVE_FORMAT == 'webp' and features.check('webp'):
+    ENCODER, EXTENSION, CONTENT_TYPE = 'WEBP', 'webp', 'image/webp'
+else:
+    ENCODER, EXTENSION, CONTENT_TYPE = 'JPEG', 'jpg', 'image/jpeg'
+# Marker URLs carry the source's mtime, so thumbnails never change under one
+THUMB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Files the size cap applies to (.jpg also covers thumbnails from before the pyramid)
+CACHED_SUFFIXES = ('.jpg', '.webp')
+
+_lock = threading.Lock()
+_local = threading.local()
+_cache_bytes = None
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def file_digest(filepath):
+    """Return the SHA-256 hex digest of a file, read in fixed-size chunks"""
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _index():
+    """This thread's connection to the stat index, created on first use"""
+    conn = getattr(_local, 'conn', None)
+    # Forked workers (bulk import) must not share their parent's connection
+    if conn is None or _local.pid != os.getpid():
+        os.makedirs(THUMB_DIR, exist_ok=True)
+        conn = sqlite3.connect(INDEX_DB, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS digests (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    digest TEXT NOT NULL
+                )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_digests_digest ON digests(digest)')
+        _import_legacy_index(conn)
+        _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+def _import_legacy_index(conn):
+    """Move the JSON stat index of earlier versions into SQLite"""
+    try:
+        with open(LEGACY_INDEX_FILE, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO digests (path, size, mtime, digest) VALUES (?, ?, ?, ?)',
+                         [(path, e['size'], e['mtime'], e['digest']) for path, e in index.items()])
+    try:
+        os.remove(LEGACY_INDEX_FILE)
+    except OSError:
+        pass
+
+
+def source_digest(filepath):
+    """Digest of a source file, re-hashed only when its size or mtime changes"""
+    # Content-addressed blobs are named by their digest and never change
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    if len(stem) == 64 and _is_blob(filepath):
+        return stem
+    st = os.stat(filepath)
+    row = _index().execute('SELECT size, mtime, digest FROM digests WHERE path = ?',
+                           (os.path.abspath(filepath),)).fetchone()
+    if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+        return row[2]
+    digest = file_digest(filepath)
+    remember_digests({filepath: digest})
+    return digest
+
+
+def _is_blob(filepath):
+    return os.path.realpath(filepath).startswith(os.path.realpath(BLOB_DIR) + os.sep)
+
+
+def remember_digest(filepath, digest):
+    """Record a digest computed elsewhere (e.g. while streaming an upload)"""
+    remember_digests({filepath: digest})
+
+
+def remember_digests(digests):
+    """Record many {filepath: digest} pairs in one transaction"""
+    rows = []
+    for filepath, digest in digests.items():
+        st = os.stat(filepath)
+        rows.append((os.path.abspath(filepath), st.st_size, st.st_mtime_ns, digest))
+    conn = _index()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO digests (path, size, mtime, digest) VALUES (?, ?, ?, ?)', rows)
+
+
+def derivative_path(digest, edge):
+    """Cache location of one level of a source's pyramid"""
+    name = f"{digest}_{edge}_q{DERIVATIVE_QUALITY}.{EXTENSION}"
+    return os.path.join(THUMB_DIR, digest[:2], name)
+
+
+def _cache_size():
+    global _cache_bytes
+    if _cache_bytes is None:
+        total = 0
+        for root, _, files in os.walk(THUMB_DIR):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files if f.endswith(CACHED_SUFFIXES))
+        _cache_bytes = total
+    return _cache_bytes
+
+
+def _touch(paths):
+    """Mark derivatives as just used; False if any of them is gone"""
+    try:
+        for path in paths:
+            os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+def _evict(max_bytes):
+    """Drop least recently used thumbnails until the cache fits in max_bytes
+
+    Call with _lock held. Thumbnails used within THUMB_EVICT_GRACE_S are
+    kept even if that leaves the cache over budget for a while.
+    """
+    global _cache_bytes
+    entries = []
+    for root, _, files in os.walk(THUMB_DIR):
+        for name in files:
+            if name.endswith(CACHED_SUFFIXES):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    # Evict down to 90% so a full cache doesn't evict on every miss
+    target = int(max_bytes * 0.9)
+    recent = time.time() - THUMB_EVICT_GRACE_S
+    evicted = set()
+    for mtime, size, path in entries:
+        if total <= target or mtime > recent:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            _stats['evictions'] += 1
+            evicted.add(os.path.basename(path).split('_')[0])
+        except OSError:
+            pass
+    _cache_bytes = total
+    _prune_index(evicted)
+
+
+def _prune_index(evicted):
+    """Forget deleted sources and evicted digests with no derivative left"""
+    conn = _index()
+    gone = [(digest,) for digest in evicted
+            if not any(os.path.exists(derivative_path(digest, edge)) for edge in DERIVATIVE_SIZES)]
+    missing = [(path,) for (path,) in conn.execute('SELECT path FROM digests') if not os.path.exists(path)]
+    with conn:
+        conn.executemany('DELETE FROM digests WHERE digest = ?', gone)
+        conn.executemany('DELETE FROM digests WHERE path = ?', missing)
+
+
+def derivative_edge(size):
+    """Smallest pyramid level whose longest edge covers a (width, height) display size"""
+    return next((edge for edge in DERIVATIVE_SIZES if edge >= max(size)), DERIVATIVE_SIZES[-1])
+
+
+def render_derivatives(filepath, edges):
+    """Decode a source image once and return {edge: encoded bytes} for pyramid levels"""
+    encoded = {}
+    with Image.open(filepath) as img:
+        # draft() lets the JPEG decoder downscale while decoding
+        img.draft('RGB', (max(edges), max(edges)))
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        # Each level is downscaled from the one above it
+        for edge in sorted(edges, reverse=True):
+            img.thumbnail((edge, edge))
+            buffer = io.BytesIO()
+            img.save(buffer, format=ENCODER, quality=DERIVATIVE_QUALITY)
+            encoded[edge] = buffer.getvalue()
+    return encoded
+
+
+def get_derivative(filepath, size, max_bytes=THUMB_CACHE_MAX_BYTES):
+    """Path of the smallest cached derivative covering a display size, rendering the pyramid on a miss"""
+    edge = derivative_edge(size)
+    return cache_derivatives(filepath, source_digest(filepath), [edge], max_bytes)[edge]
+
+
+def cache_derivatives(filepath, digest, edges=DERIVATIVE_SIZES, max_bytes=THUMB_CACHE_MAX_BYTES):
+    """{edge: path} of derivatives of a source whose digest is already known
+
+    A miss renders every missing level of the pyramid from one decode. The
+    returned paths were touched, so eviction spares them for
+    THUMB_EVICT_GRACE_S. Safe to call from worker processes.
+    """
+    global _cache_bytes
+    paths = {edge: derivative_path(digest, edge) for edge in DERIVATIVE_SIZES}
+    # Under the lock this process can't evict between the check and the
+    # touch; a level another process evicted fails the touch and is a miss
+    with _lock:
+        hit = _touch(paths[edge] for edge in edges)
+    if hit:
+        _stats['hits'] += 1
+        return {edge: paths[edge] for edge in edges}
+
+    _stats['misses'] += 1
+    missing = [edge for edge, path in paths.items() if not os.path.exists(path)]
+    added = 0
+    for edge, data in render_derivatives(filepath, missing).items():
+        path = paths[edge]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        added += len(data)
+
+    with _lock:
+        # Levels that were already cached are handed out too
+        _touch(paths[edge] for edge in edges)
+        if _cache_bytes is None:
+            _cache_size()
+        else:
+            _cache_bytes += added
+        if _cache_bytes > max_bytes:
+            _evict(max_bytes)
+    return {edge: paths[edge] for edge in edges}
+
+
+def cache_stats():
+    """Hit/miss/eviction counters for this process"""
+    return dict(_stats)
+
+
+def marker_source(item):
+    """The image a story's derivatives are made from (a video's poster), or None"""
+    # Videos show their poster frame once the transcoder has made one
+    filepath = item.get('poster_path') if item['type'] == 'video' else item.get('filepath')
+    return filepath if filepath and os.path.exists(filepath) else None
+
+
+def thumbnail_data_uri(filepath, size=MARKER_THUMB_SIZE):
+    """data: URI of the derivative of a source covering a marker's size"""
+    with open(get_derivative(filepath, size), 'rb') as f:
+        return f"data:{CONTENT_TYPE};base64,{base64.b64encode(f.read()).decode()}"
+
+
+def marker_thumbnail(store, item_id, size=MARKER_THUMB_SIZE):
+    """Path of the derivative covering a marker's size for story item_id, or None"""
+    item = store.get(item_id)
+    filepath = marker_source(item) if item else None
+    if filepath is None:
+        return None
+    try:
+        return get_derivative(filepath, size)
+    except Exception as e:
+        print(f"Error making thumbnail for {filepath}: {e}")
+        return None
+
+
+def thumbnail_handler(store, size=MARKER_THUMB_SIZE):
+    """Handler for /thumbs/<id>: the derivative of a story covering a marker's size
+
+    Marker URLs carry the source's mtime (?v=...), so responses can be
+    cached by the browser indefinitely.
+    """
+    def handle(request, subpath):
+        path = marker_thumbnail(store, int(subpath), size) if subpath.isdigit() else None
+        if path is None:
+            request.send_error(404)
+            return
+        send_file(request, path, CONTENT_TYPE, cache_control=THUMB_CACHE_CONTROL)
+    return handle
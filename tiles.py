@@ -0,0 +1,198 @@
+"""Caching proxy for base map tiles
+
+The map's base layers are requested from the media server at
+/tiles/<layer>/<z>/<x>/<y>.<ext> instead of straight from CARTO/Esri. A
+tile is served from the XYZ disk cache under TILE_CACHE_DIR when present,
+otherwise fetched from the layer's upstream once, written atomically and
+kept. The cache is capped at TILE_CACHE_MAX_BYTES and evicts the least
+recently used tiles first (hits touch the file's mtime).
+
+seed_tiles() fills the cache for a bounding box and zoom range ahead of a
+deployment without connectivity. With TILE_UPSTREAM_DIR set, tiles come
+from a local XYZ directory instead of the internet and aren't copied.
+"""
+import os
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (MEDIA_BASE_URL, TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES, TILE_SOURCES,
+                    TILE_UPSTREAM_DIR)
+from geo import tiles_in_bbox
+from media_server import register_route, send_file
+
+USER_AGENT = 'drone-media-map tile cache'
+FETCH_TIMEOUT = 10
+
+_lock = threading.Lock()
+_cache_bytes = None
+_stats = {'hits': 0, 'misses': 0, 'errors': 0, 'evictions': 0}
+
+
+def tile_path(layer, z, x, y, root=TILE_CACHE_DIR):
+    """Cache location of a tile"""
+    return os.path.join(root, layer, str(z), str(x), f"{y}.{TILE_SOURCES[layer]['ext']}")
+
+
+def upstream_url(layer, z, x, y):
+    source = TILE_SOURCES[layer]
+    subdomains = source.get('subdomains') or 'a'
+    return source['url'].format(s=subdomains[(x + y) % len(subdomains)], z=z, x=x, y=y)
+
+
+def _cache_size():
+    global _cache_bytes
+    if _cache_bytes is None:
+        total = 0
+        for root, _, files in os.walk(TILE_CACHE_DIR):
+            total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        _cache_bytes = total
+    return _cache_bytes
+
+
+def _evict(max_bytes):
+    """Drop least recently used tiles until the cache fits in max_bytes"""
+    global _cache_bytes
+    entries = []
+    for root, _, files in os.walk(TILE_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    # Evict down to 90% so a full cache doesn't evict on every miss
+    target = int(max_bytes * 0.9)
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            _stats['evictions'] += 1
+        except OSError:
+            pass
+    _cache_bytes = total
+
+
+def fetch_upstream(layer, z, x, y):
+    """Tile bytes from the layer's upstream server"""
+    request = urllib.request.Request(upstream_url(layer, z, x, y), headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+        return response.read()
+
+
+def get_tile(layer, z, x, y, max_bytes=TILE_CACHE_MAX_BYTES):
+    """Path of a tile on disk, fetching and caching it on a miss; None if unavailable"""
+    global _cache_bytes
+    if TILE_UPSTREAM_DIR:
+        path = tile_path(layer, z, x, y, TILE_UPSTREAM_DIR)
+        return path if os.path.exists(path) else None
+
+    path = tile_path(layer, z, x, y)
+    if os.path.exists(path):
+        _stats['hits'] += 1
+        # Touch so eviction sees this tile as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    _stats['misses'] += 1
+    try:
+        data = fetch_upstream(layer, z, x, y)
+    except OSError as e:
+        _stats['errors'] += 1
+        print(f"Tile {layer}/{z}/{x}/{y} unavailable: {e}")
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tile-', suffix='.part')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    with _lock:
+        if _cache_bytes is None:
+            # The first walk already counts the tile just written
+            _cache_size()
+        else:
+            _cache_bytes += len(data)
+        if _cache_bytes > max_bytes:
+            _evict(max_bytes)
+    return path
+
+
+def tile_stats():
+    """Hit/miss/error/eviction counters and the cache size in bytes"""
+    with _lock:
+        return dict(_stats, bytes=_cache_size())
+
+
+def serve_tile(request, subpath):
+    """/tiles/<layer>/<z>/<x>/<y>.<ext>"""
+    try:
+        layer, z, x, name = subpath.split('/')
+        z, x, y = int(z), int(x), int(name.split('.')[0])
+    except ValueError:
+        request.send_error(404)
+        return
+    if layer not in TILE_SOURCES or not 0 <= z <= TILE_SOURCES[layer]['max_zoom'] \
+            or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        request.send_error(404)
+        return
+    path = get_tile(layer, z, x, y)
+    if path is None:
+        request.send_error(502, 'Tile unavailable')
+        return
+    send_file(request, path, cache_control='public, max-age=604800')
+
+
+register_route('/tiles/', serve_tile)
+
+
+def tile_url(layer):
+    """Leaflet URL template for a layer served through the proxy"""
+    return f"{MEDIA_BASE_URL}/tiles/{layer}/{{z}}/{{x}}/{{y}}.{TILE_SOURCES[layer]['ext']}"
+
+
+def count_tiles(bbox, zooms):
+    return sum(len(tiles_in_bbox(*bbox, z)) for z in zooms)
+
+
+def seed_tiles(bbox, zooms, layers=None, workers=8, progress=None):
+    """Fetch every tile of the given layers covering bbox at each zoom into the cache
+
+    Returns {'tiles', 'fetched', 'cached', 'failed'}.
+    """
+    layers = layers or list(TILE_SOURCES)
+    jobs = [(layer, z, x, y) for layer in layers for z in zooms for x, y in tiles_in_bbox(*bbox, z)]
+    summary = {'tiles': len(jobs), 'fetched': 0, 'cached': 0, 'failed': 0}
+
+    def seed(job):
+        if os.path.exists(tile_path(*job)):
+            return 'cached'
+        return 'fetched' if get_tile(*job) else 'failed'
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for done, outcome in enumerate(pool.map(seed, jobs), 1):
+            summary[outcome] += 1
+            if progress:
+                progress(done, len(jobs))
+    return summary
+
+
+def zoom_range(spec):
+    """'12' or '10-15' -> range of zoom levels"""
+    first, _, last = spec.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+def archive_bbox(points, margin_deg=0.02):
+    """Box around every (id, lat, lon, type) point, with a margin"""
+    if not points:
+        return None
+    lats = [p[1] for p in points]
+    lons = [p[2] for p in points]
+    return (max(min(lats) - margin_deg, -85.0), max(min(lons) - margin_deg, -180.0),
+            min(max(lats) + margin_deg, 85.0), min(max(lons) + margin_deg, 180.0))
@@ -0,0 +1,386 @@
+"""Flight tracks: parsing, compact storage and per-zoom simplification
+
+Telemetry comes from DJI SRT subtitles, CSV flight logs or GPX files and is
+parsed into (time offset, lat, lon, altitude) samples. Tracks are stored in
+MEDIA_DB's `tracks` table, one row per flight:
+
+- samples are quantized (1e-6 degrees, decimetres, milliseconds),
+  delta-encoded as int32 and zlib-compressed, so a 10 Hz log costs a few
+  bytes per sample
+- each vertex also gets a Douglas–Peucker importance: the tolerance (in
+  normalized Web Mercator units) below which it would be dropped. It is
+  computed once at ingest; simplifying for a zoom level is then a single
+  comparison against a tolerance of TRACK_TOLERANCE_PX pixels at that zoom
+- media captured during the flight is linked to it by timestamp
+
+A 30-minute 10 Hz log has 18,000 samples; measured on synthetic flights,
+about 20 vertices survive at zoom 11 and a few hundred at zoom 18.
+"""
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+import zlib
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from config import TRACK_CACHE_ENTRIES, TRACK_TOLERANCE_PX, TRACKS_DB
+from geo import mercator_xy, split_antimeridian
+
+TRACK_EXTENSIONS = {'srt', 'csv', 'gpx'}
+
+_SRT_TIME_RE = re.compile(r'(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?)')
+_SRT_CUE_RE = re.compile(r'(\d{2}):(\d{2}):(\d{2})[,.](\d{3})\s*-->')
+_SRT_FIELD_RE = re.compile(r'\[?(latitude|longitude|rel_alt|altitude)\s*:\s*(-?[\d.]+)')
+# Older firmware: GPS(lon,lat,alt) and BAROMETER:height
+_SRT_GPS_RE = re.compile(r'GPS\s*\(\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)\s*,\s*(-?[\d.]+)')
+_SRT_BARO_RE = re.compile(r'BAROMETER\s*:\s*(-?[\d.]+)')
+
+
+def _parse_time(value):
+    """datetime from the usual log formats, or None"""
+    value = (value or '').strip().replace('T', ' ').rstrip('Z')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S.%f',
+                '%Y/%m/%d %H:%M:%S', '%m/%d/%Y %I:%M:%S.%f %p', '%m/%d/%Y %I:%M:%S %p'):
+        try:
+            return datetime.strptime(value.replace(',', '.').split('+')[0], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_srt(text):
+    """Samples from a DJI SRT subtitle track"""
+    samples = []
+    for block in re.split(r'\n\s*\n', text.replace('\r', '')):
+        fields = {k: float(v) for k, v in _SRT_FIELD_RE.findall(block)}
+        gps = _SRT_GPS_RE.search(block)
+        if 'latitude' in fields and 'longitude' in fields:
+            lat, lon = fields['latitude'], fields['longitude']
+            alt = fields.get('rel_alt', fields.get('altitude', 0.0))
+        elif gps:
+            lon, lat, alt = (float(v) for v in gps.groups())
+            baro = _SRT_BARO_RE.search(block)
+            alt = float(baro.group(1)) if baro else alt
+        else:
+            continue
+        if lat == 0 and lon == 0:
+            continue
+        when = _SRT_TIME_RE.search(block)
+        when = _parse_time(when.group(1)) if when else None
+        cue = _SRT_CUE_RE.search(block)
+        offset = None
+        if cue:
+            h, m, s, ms = (int(v) for v in cue.groups())
+            offset = ((h * 60 + m) * 60 + s) * 1000 + ms
+        samples.append((when, offset, lat, lon, alt))
+    return samples
+
+
+def _column(header, *names):
+    """First header matching any of names (case-insensitive prefix)"""
+    for name in names:
+        for column in header:
+            if column.strip().lower().startswith(name):
+                return column
+    return None
+
+
+def parse_csv(text):
+    """Samples from a CSV flight log with latitude/longitude columns"""
+    reader = csv.DictReader(text.splitlines())
+    header = reader.fieldnames or []
+    lat_col = _column(header, 'latitude', 'lat')
+    lon_col = _column(header, 'longitude', 'lon', 'lng')
+    if not lat_col or not lon_col:
+        raise ValueError("CSV has no latitude/longitude columns")
+    alt_col = _column(header, 'height_above_takeoff', 'altitude', 'alt', 'height')
+    time_col = _column(header, 'datetime', 'timestamp', 'date', 'time')
+    samples = []
+    for row in reader:
+        try:
+            lat, lon = float(row[lat_col]), float(row[lon_col])
+        except (TypeError, ValueError):
+            continue
+        if lat == 0 and lon == 0:
+            continue
+        try:
+            alt = float(row[alt_col]) if alt_col else 0.0
+        except (TypeError, ValueError):
+            alt = 0.0
+        when = _parse_time(row.get(time_col)) if time_col else None
+        offset = None
+        if when is None and time_col:
+            # Elapsed milliseconds, as in "time(millisecond)"
+            try:
+                offset = int(float(row[time_col]))
+            except (TypeError, ValueError):
+                pass
+        samples.append((when, offset, lat, lon, alt))
+    return samples
+
+
+def parse_gpx(text):
+    """Samples from the track points of a GPX file"""
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError as e:
+        raise ValueError(f"Invalid GPX: {e}")
+    samples = []
+    for element in root.iter():
+        if not element.tag.endswith('trkpt') and not element.tag.endswith('rtept'):
+            continue
+        try:
+            lat, lon = float(element.get('lat')), float(element.get('lon'))
+            alt, when = 0.0, None
+            for child in element:
+                if child.tag.endswith('ele'):
+                    alt = float(child.text)
+                elif child.tag.endswith('time'):
+                    when = _parse_time(child.text)
+        except TypeError:
+            # float(None): a missing lat/lon attribute or an empty <ele>
+            raise ValueError("Invalid GPX: track point without lat, lon or ele")
+        samples.append((when, None, lat, lon, alt))
+    return samples
+
+
+PARSERS = {'srt': parse_srt, 'csv': parse_csv, 'gpx': parse_gpx}
+
+
+def parse_track(name, text):
+    """(start datetime or None, [(t_ms, lat, lon, alt)]) from a log's name and contents"""
+    ext = name.rsplit('.', 1)[-1].lower()
+    if ext not in PARSERS:
+        raise ValueError(f"Unsupported track format: {name}")
+    samples = PARSERS[ext](text)
+    if not samples:
+        raise ValueError(f"No positions found in {name}")
+    start = next((s[0] for s in samples if s[0] is not None), None)
+    points = []
+    for i, (when, offset, lat, lon, alt) in enumerate(samples):
+        if when is not None and start is not None:
+            t = int((when - start).total_seconds() * 1000)
+        elif offset is not None:
+            t = offset
+        else:
+            t = i
+        points.append((t, lat, lon, alt))
+    return start, points
+
+
+def encode_points(points):
+    """Quantize, delta-encode and compress (t_ms, lat, lon, alt) samples"""
+    q = np.array([(t, round(lat * 1e6), round(lon * 1e6), round(alt * 10)) for t, lat, lon, alt in points],
+                 dtype=np.int64)
+    deltas = np.diff(q, axis=0, prepend=np.zeros((1, 4), dtype=np.int64))
+    return zlib.compress(deltas.astype(np.int32).tobytes(), 6)
+
+
+def decode_points(blob):
+    """Inverse of encode_points: an (n, 4) float array of t_ms, lat, lon, alt"""
+    deltas = np.frombuffer(zlib.decompress(blob), dtype=np.int32).reshape(-1, 4)
+    q = np.cumsum(deltas.astype(np.int64), axis=0)
+    return q * np.array([1, 1e-6, 1e-6, 0.1])
+
+
+def dp_importance(xy):
+    """Douglas–Peucker tolerance at which each vertex stops being kept
+
+    Endpoints are always kept (inf). A vertex's value never exceeds that of
+    the split above it, so keeping `importance >= tol` gives exactly the
+    Douglas–Peucker result for tol.
+    """
+    n = len(xy)
+    importance = np.zeros(n)
+    importance[0] = importance[-1] = np.inf
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        i, j, cap = stack.pop()
+        if j <= i + 1:
+            continue
+        a, b = xy[i], xy[j]
+        seg = xy[i + 1:j]
+        ab = b - a
+        length = np.hypot(*ab)
+        if length == 0:
+            dist = np.hypot(*(seg - a).T)
+        else:
+            dist = np.abs(ab[0] * (seg[:, 1] - a[1]) - ab[1] * (seg[:, 0] - a[0])) / length
+        k = int(np.argmax(dist))
+        value = min(float(dist[k]), cap)
+        importance[i + 1 + k] = value
+        stack.append((i, i + 1 + k, value))
+        stack.append((i + 1 + k, j, value))
+    return importance
+
+
+def zoom_tolerance(zoom):
+    """Douglas–Peucker tolerance for zoom, in normalized Mercator units"""
+    return TRACK_TOLERANCE_PX / (256 * 2 ** zoom)
+
+
+SUMMARY_COLUMNS = 'id, name, start, end, duration_s, point_count, south, west, north, east, media_ids'
+
+
+class TrackStore:
+    """Flight tracks in SQLite (TRACKS_DB: the media database, or one beside a JSON archive)"""
+
+    def __init__(self, path=TRACKS_DB):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS tracks (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    start TEXT,
+                    end TEXT,
+                    duration_s REAL NOT NULL,
+                    point_count INTEGER NOT NULL,
+                    south REAL NOT NULL,
+                    west REAL NOT NULL,
+                    north REAL NOT NULL,
+                    east REAL NOT NULL,
+                    points BLOB NOT NULL,
+                    importance BLOB NOT NULL,
+                    media_ids TEXT NOT NULL DEFAULT '[]'
+                );
+                CREATE INDEX IF NOT EXISTS idx_tracks_start ON tracks(start);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            ''')
+        # Decoded tracks of one version(): ids are reused after a delete.
+        # Sessions share the store, so the cache is guarded by a lock.
+        self._cache = {}
+        self._cache_version = None
+        self._cache_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _bump_version(self, conn):
+        conn.execute("INSERT INTO meta (key, value) VALUES ('tracks_version', '1') "
+                     "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    def version(self):
+        """Counter bumped whenever a track is added or removed, across processes"""
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'tracks_version'").fetchone()
+        return int(row['value']) if row else 0
+
+    def add(self, name, start, points, media_ids=()):
+        """Store a parsed track; returns its id"""
+        arr = np.array([(lat, lon) for _, lat, lon, _ in points])
+        xy = np.array([mercator_xy(lat, lon) for lat, lon in arr])
+        importance = dp_importance(xy).astype(np.float32)
+        duration = (points[-1][0] - points[0][0]) / 1000 if len(points) > 1 else 0.0
+        end = start + timedelta(seconds=duration) if start else None
+        fmt = '%Y-%m-%d %H:%M:%S'
+        with self._conn() as conn:
+            cur = conn.execute(
+                'INSERT INTO tracks (name, start, end, duration_s, point_count, south, west, north, east, '
+                'points, importance, media_ids) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, start.strftime(fmt) if start else None, end.strftime(fmt) if end else None,
+                 duration, len(points), float(arr[:, 0].min()), float(arr[:, 1].min()),
+                 float(arr[:, 0].max()), float(arr[:, 1].max()),
+                 encode_points(points), zlib.compress(importance.tobytes()), json.dumps(sorted(media_ids))))
+            self._bump_version(conn)
+            return cur.lastrowid
+
+    def delete(self, track_id):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM tracks WHERE id = ?', (track_id,))
+            self._bump_version(conn)
+        with self._cache_lock:
+            self._cache.pop(track_id, None)
+
+    def _summaries(self, where='', params=()):
+        rows = []
+        for row in self._conn().execute(f'SELECT {SUMMARY_COLUMNS} FROM tracks {where} ORDER BY id', params):
+            row = dict(row)
+            row['media_ids'] = json.loads(row['media_ids'])
+            rows.append(row)
+        return rows
+
+    def get(self, track_id):
+        """Summary of one track, or None"""
+        rows = self._summaries('WHERE id = ?', (track_id,))
+        return rows[0] if rows else None
+
+    def tracks(self, bbox=None):
+        """Track summaries (no samples), optionally only those crossing bbox
+
+        A bbox with west > east crosses the antimeridian.
+        """
+        if not bbox:
+            return self._summaries()
+        clauses, params = [], []
+        for south, west, north, east in split_antimeridian(bbox):
+            clauses.append('(north >= ? AND south <= ? AND east >= ? AND west <= ?)')
+            params.extend([south, north, west, east])
+        return self._summaries('WHERE ' + ' OR '.join(clauses), params)
+
+    def _load(self, track_id):
+        version = self.version()
+        with self._cache_lock:
+            if version != self._cache_version:
+                self._cache, self._cache_version = {}, version
+            if track_id in self._cache:
+                return self._cache[track_id]
+        row = self._conn().execute('SELECT points, importance FROM tracks WHERE id = ?', (track_id,)).fetchone()
+        if row is None:
+            return None
+        loaded = decode_points(row['points']), np.frombuffer(zlib.decompress(row['importance']), dtype=np.float32)
+        with self._cache_lock:
+            # Don't fill a cache that a newer version has replaced meanwhile
+            if self._cache_version == version:
+                while len(self._cache) >= TRACK_CACHE_ENTRIES:
+                    # Oldest first
+                    self._cache.pop(next(iter(self._cache)))
+                self._cache[track_id] = loaded
+        return loaded
+
+    def points(self, track_id):
+        """Full-resolution (n, 4) array of t_ms, lat, lon, alt"""
+        loaded = self._load(track_id)
+        return None if loaded is None else loaded[0]
+
+    def simplified(self, track_id, zoom):
+        """[[lat, lon], ...] keeping only the vertices visible at zoom"""
+        loaded = self._load(track_id)
+        if loaded is None:
+            return []
+        points, importance = loaded
+        keep = importance >= zoom_tolerance(zoom)
+        return points[keep][:, 1:3].round(6).tolist()
+
+
+def link_media(store, start, duration_s):
+    """Ids of media captured during a flight"""
+    if start is None:
+        return []
+    fmt = '%Y-%m-%d %H:%M:%S'
+    end = start + timedelta(seconds=duration_s)
+    return [item['id'] for item in store.query(start=start.strftime(fmt), end=end.strftime(fmt))]
+
+
+def import_track(name, text, store, tracks, media_ids=None):
+    """Parse a log and store it, linked to media from the same flight; returns the track id"""
+    start, points = parse_track(name, text)
+    if media_ids is None:
+        duration = (points[-1][0] - points[0][0]) / 1000 if len(points) > 1 else 0.0
+        media_ids = link_media(store, start, duration)
+    title = os.path.splitext(os.path.basename(name))[0][:60]
+    return tracks.add(title, start, points, media_ids)
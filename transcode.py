@@ -0,0 +1,218 @@
+"""Background video transcoding: web-friendly proxies and poster frames
+
+Each uploaded video gets a job in a small SQLite queue (JOBS_DB), so pending
+work survives restarts. A pool of worker threads claims jobs and runs
+ffmpeg to produce:
+
+- a lower-bitrate H.264/AAC MP4 proxy (faststart, capped at PROXY_HEIGHT)
+- a JPEG poster frame
+
+Progress is parsed from ffmpeg's -progress output and stored on the job
+row. On success the media record gains `proxy_path` and `poster_path`;
+originals are never modified. A failed job is queued again when its video
+is next submitted (e.g. by enqueue_missing() at start-up), up to
+TRANSCODE_MAX_ATTEMPTS attempts in all.
+"""
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+
+from config import JOBS_DB, POSTER_WIDTH, PROXY_HEIGHT, TRANSCODE_MAX_ATTEMPTS, TRANSCODE_WORKERS, UPLOAD_DIR
+
+PROXY_DIR = os.path.join(UPLOAD_DIR, 'proxies')
+POSTER_DIR = os.path.join(UPLOAD_DIR, 'posters')
+
+
+class JobQueue:
+    """Persistent transcode job queue"""
+
+    def __init__(self, path=JOBS_DB, max_attempts=TRANSCODE_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS transcode_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    media_id INTEGER NOT NULL UNIQUE,
+                    source TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    progress REAL NOT NULL DEFAULT 0,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_status ON transcode_jobs(status, id);
+            ''')
+            # Queues created before attempts were counted
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(transcode_jobs)')}
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE transcode_jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            # Jobs interrupted by a restart go back on the queue
+            conn.execute("UPDATE transcode_jobs SET status = 'queued', progress = 0 WHERE status = 'running'")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, media_id, source):
+        """Queue a video once; re-queues it if the earlier job failed and has attempts left"""
+        now = time.time()
+        self._conn().execute('''
+            INSERT INTO transcode_jobs (media_id, source, created, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT(media_id) DO UPDATE SET
+                source = excluded.source, status = 'queued', progress = 0, error = NULL, updated = excluded.updated
+            WHERE transcode_jobs.status = 'failed' AND transcode_jobs.attempts < ?
+        ''', (media_id, source, now, now, self.max_attempts))
+
+    def claim(self):
+        """Atomically take the oldest queued job, or None"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT * FROM transcode_jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE transcode_jobs SET status = 'running', attempts = attempts + 1, updated = ? "
+                             "WHERE id = ?", (time.time(), row['id']))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return dict(row) if row else None
+
+    def set_progress(self, job_id, progress):
+        self._conn().execute('UPDATE transcode_jobs SET progress = ?, updated = ? WHERE id = ?',
+                             (progress, time.time(), job_id))
+
+    def finish(self, job_id, error=None):
+        status = 'failed' if error else 'done'
+        self._conn().execute(
+            'UPDATE transcode_jobs SET status = ?, progress = ?, error = ?, updated = ? WHERE id = ?',
+            (status, 0 if error else 1, error, time.time(), job_id))
+
+    def jobs(self):
+        """Queued and running jobs, and failed ones that will be retried
+
+        Jobs that have used up their attempts are left out.
+        """
+        sql = ("SELECT * FROM transcode_jobs WHERE status IN ('queued', 'running') "
+               "OR (status = 'failed' AND attempts < ?) ORDER BY id")
+        return [dict(row) for row in self._conn().execute(sql, (self.max_attempts,))]
+
+
+def probe_duration(path):
+    """Duration in seconds via ffprobe, or None"""
+    try:
+        out = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+            capture_output=True, text=True, timeout=60, check=True)
+        return float(out.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def make_proxy(source, dest, on_progress=None):
+    """Transcode source into a web-friendly MP4 at dest"""
+    duration = probe_duration(source)
+    tmp = f"{dest}.part.mp4"
+    cmd = [
+        'ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-i', source,
+        '-vf', f"scale=-2:'min({PROXY_HEIGHT},ih)'",
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', '96k',
+        '-movflags', '+faststart',
+        '-progress', 'pipe:1', '-nostats',
+        tmp,
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    for line in proc.stdout:
+        key, _, value = line.strip().partition('=')
+        if key == 'out_time_us' and duration and on_progress and value.isdigit():
+            on_progress(min(int(value) / 1e6 / duration, 0.99))
+    stderr = proc.stderr.read()
+    if proc.wait() != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise RuntimeError(stderr.strip() or f"ffmpeg exited with {proc.returncode}")
+    os.replace(tmp, dest)
+
+
+def make_poster(source, dest):
+    """Grab a poster frame one second in (or the first frame for short clips)"""
+    tmp = f"{dest}.part.jpg"
+    for offset in ('1', '0'):
+        result = subprocess.run(
+            ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-ss', offset, '-i', source,
+             '-frames:v', '1', '-vf', f'scale={POSTER_WIDTH}:-2', '-q:v', '4', tmp],
+            capture_output=True, text=True, timeout=300)
+        if result.returncode == 0 and os.path.exists(tmp) and os.path.getsize(tmp):
+            os.replace(tmp, dest)
+            return
+    raise RuntimeError(result.stderr.strip() or 'could not extract a poster frame')
+
+
+class TranscodeWorkerPool:
+    """Worker threads draining the job queue and updating media records"""
+
+    def __init__(self, store, queue=None, workers=TRANSCODE_WORKERS):
+        self.store = store
+        self.queue = queue or JobQueue()
+        self._wake = threading.Event()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f'transcode-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        store.subscribe(self._on_change)
+
+    def _on_change(self, event, items, version):
+        # New videos are queued as soon as their record is written
+        if event == 'insert':
+            for item in items:
+                if item['type'] == 'video' and item.get('filepath'):
+                    self.submit(item['id'], item['filepath'])
+
+    def submit(self, media_id, source):
+        self.queue.enqueue(media_id, source)
+        self._wake.set()
+
+    def enqueue_missing(self):
+        """Queue every video that has a file but no proxy yet"""
+        for item in self.store.query(types=['video']):
+            if item.get('filepath') and os.path.exists(item['filepath']) and not item.get('proxy_path'):
+                self.queue.enqueue(item['id'], item['filepath'])
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                self._wake.wait(timeout=5)
+                self._wake.clear()
+                continue
+            try:
+                self._process(job)
+                self.queue.finish(job['id'])
+            except Exception as e:
+                self.queue.finish(job['id'], error=str(e)[:500])
+
+    def _process(self, job):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError('ffmpeg is not installed')
+        os.makedirs(PROXY_DIR, exist_ok=True)
+        os.makedirs(POSTER_DIR, exist_ok=True)
+        proxy = os.path.join(PROXY_DIR, f"{job['media_id']}.mp4")
+        poster = os.path.join(POSTER_DIR, f"{job['media_id']}.jpg")
+        make_poster(job['source'], poster)
+        self.store.update(job['media_id'], poster_path=poster)
+        make_proxy(job['source'], proxy, lambda p: self.queue.set_progress(job['id'], p))
+        self.store.update(job['media_id'], proxy_path=proxy)
@@ -0,0 +1,85 @@
+"""Background cache warm-up and health/readiness probes
+
+A new app process starts cold: the store has to be opened (or imported from
+JSON), the spatial, cluster and dedup indexes and the flight statistics
+built, folium and pandas imported and thumbnails rendered. Warmup runs
+those as named tasks in a background thread, started when the process starts
+(server.py) or by the first script run, so the page only waits for what it
+needs right away and later reruns find everything cached.
+
+Two probes for orchestrators, served on the Streamlit port by server.py:
+- /healthz: 200 while the process is serving (liveness)
+- /readyz: 503 until every warm-up task has finished, then 200
+  (readiness), so traffic is only routed to a warm process
+
+Both return a JSON body with each task's state and duration. Task timings
+are also recorded as `warmup:<task>` stages on /metrics.
+"""
+import threading
+import time
+
+import metrics
+
+
+class Warmup:
+    """Runs (name, fn) tasks in order on a daemon thread"""
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self._lock = threading.Lock()
+        self._status = {name: {'state': 'pending'} for name, _ in self.tasks}
+        self._done = threading.Event()
+        self.seconds = None
+
+    def start(self):
+        threading.Thread(target=self._run, name='warmup', daemon=True).start()
+        return self
+
+    def _set(self, name, **fields):
+        with self._lock:
+            self._status[name] = fields
+
+    def _run(self):
+        start = time.perf_counter()
+        for name, fn in self.tasks:
+            self._set(name, state='running')
+            task_start = time.perf_counter()
+            try:
+                fn()
+                state, error = 'done', None
+            except Exception as e:
+                # The cache fills on first use instead; don't hold readiness back
+                print(f"Warm-up task {name} failed: {e}")
+                state, error = 'failed', str(e)
+            seconds = time.perf_counter() - task_start
+            metrics.observe(f'warmup:{name}', seconds)
+            self._set(name, state=state, seconds=round(seconds, 3), error=error)
+        self.seconds = time.perf_counter() - start
+        metrics.gauge('warmup_seconds', self.seconds)
+        print(f"Warm-up finished in {self.seconds:.1f}s")
+        self._done.set()
+
+    def finished(self, name=None):
+        """Whether task `name` (or, without a name, every task) has finished"""
+        if name is None:
+            return self._done.is_set()
+        with self._lock:
+            return self._status[name]['state'] in ('done', 'failed')
+
+    def status(self):
+        """{'ready', 'seconds', 'tasks': {name: {'state', 'seconds', 'error'}}}"""
+        with self._lock:
+            tasks = {name: dict(fields) for name, fields in self._status.items()}
+        return {'ready': self.finished(), 'seconds': self.seconds, 'tasks': tasks}
+
+
+def liveness(warmup):
+    """(status code, body) of /healthz"""
+    return 200, {'status': 'ok', 'ready': warmup.finished()}
+
+
+def readiness(warmup):
+    """(status code, body) of /readyz"""
+    status = warmup.status()
+    return 200 if status['ready'] else 503, status
+